@@ -0,0 +1,295 @@
+###############################################################################
+#   volumina: volume slicing and editing library
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the Lesser GNU General Public License
+# as published by the Free Software Foundation; either version 2.1
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# See the files LICENSE.lgpl2 and LICENSE.lgpl3 for full text of the
+# GNU Lesser General Public License version 2.1 and 3 respectively.
+# This information is also available on the ilastik web site at:
+#		   http://ilastik.org/license/
+###############################################################################
+"""
+Microbenchmarks of the pixel pipeline.
+
+Measures the per tile latency (p50/p95/p99) and the throughput (tiles per
+second) of the array to QImage conversions of the image requests, of
+slice and datasource requests, and of compositing tiles, for a range of
+dtypes and tile sizes, with and without vigra.
+
+    python scripts/pixelpipeline_benchmark.py -o results.json
+    python scripts/pixelpipeline_benchmark.py --compare results.json
+
+With --compare, cases whose median latency got worse than the baseline
+by more than --tolerance are reported and the exit code is 1.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import tempfile
+import argparse
+from functools import partial
+
+import numpy as np
+from PyQt4.QtCore import QRectF
+from PyQt4.QtGui import QColor
+
+from volumina.metrics import Histogram
+from volumina.pixelpipeline import imagesources
+from volumina.pixelpipeline.imagesources import GrayscaleImageRequest, \
+    AlphaModulatedImageRequest, ColortableImageRequest, RGBAImageRequest, \
+    GrayscaleImageSource
+from volumina.pixelpipeline.datasources import ArrayRequest, ArraySource, ConstantSource
+from volumina.pixelpipeline.slicesources import SliceSource
+from volumina.pixelpipeline.imagepump import StackedImageSources
+from volumina.slicingtools import SliceProjection
+from volumina.layerstack import LayerStackModel
+from volumina.layer import GrayscaleLayer
+from volumina.tiling import Tiling, TileProvider
+from volumina.colortables import create_default_8bit
+
+_has_h5py = True
+try:
+    import h5py
+except ImportError:
+    _has_h5py = False
+
+DTYPES = ('uint8', 'uint16', 'float32')
+TILE_SIZES = (64, 256, 512)
+
+#*******************************************************************************
+# t i m i n g                                                                  *
+#*******************************************************************************
+
+def measure(name, f, repeat, **params):
+    '''Call f() repeat times (after a warm up call) and return the result
+    record of the case.'''
+    f()
+    h = Histogram()
+    start = time.time()
+    for i in xrange(repeat):
+        t = time.time()
+        f()
+        h.record(time.time() - t)
+    total = time.time() - start
+    result = {'name': name,
+              'tiles_per_second': repeat / total if total > 0 else None,
+              'latency': h.toDict()}
+    result.update(params)
+    return result
+
+class _vigra(object):
+    '''Context manager enabling or disabling the vigra conversions.'''
+    def __init__(self, enabled):
+        self.enabled = enabled
+
+    def __enter__(self):
+        self._previous = imagesources._has_vigra
+        imagesources._has_vigra = self.enabled and self._previous
+
+    def __exit__(self, *args):
+        imagesources._has_vigra = self._previous
+
+def _array(dtype, size, rng):
+    if np.dtype(dtype).kind == 'f':
+        return rng.random_sample((size, size)).astype(dtype)
+    return rng.randint(0, np.iinfo(dtype).max, (size, size)).astype(dtype)
+
+def _colortable(colors):
+    # BGRA, like ColortableImageSource.updateColorTable
+    return np.asarray([(c.blue(), c.green(), c.red(), c.alpha())
+                       for c in map(QColor.fromRgba, colors)], dtype=np.uint8)
+
+def _normalize(a):
+    return (float(a.min()), float(a.max()))
+
+#*******************************************************************************
+# c a s e s                                                                    *
+#*******************************************************************************
+
+def imageRequestCases(tileSizes, vigraModes, rng):
+    '''(name, function, params) of the image request conversions.'''
+    full = slice(None)
+    for size in tileSizes:
+        for vigra in vigraModes:
+            params = dict(tile=size, vigra=vigra)
+            for dtype in DTYPES:
+                a = _array(dtype, size, rng)
+                n = _normalize(a)
+                yield ('grayscale', dict(params, dtype=dtype),
+                       lambda a=a, n=n: GrayscaleImageRequest(ArrayRequest(a, (full, full)), n).wait())
+                yield ('alphamodulated', dict(params, dtype=dtype),
+                       lambda a=a, n=n: AlphaModulatedImageRequest(ArrayRequest(a, (full, full)),
+                                                                   QColor(255, 0, 0), n).wait())
+
+            colortable = _colortable(create_default_8bit())
+            for dtype in ('uint8', 'uint32'):
+                labels = rng.randint(0, 255, (size, size)).astype(dtype)
+                yield ('colortable', dict(params, dtype=dtype),
+                       lambda a=labels: ColortableImageRequest(ArrayRequest(a, (full, full)),
+                                                               colortable, None).wait())
+                masked = np.ma.masked_array(labels, mask=rng.random_sample(labels.shape) < 0.1)
+                yield ('colortable-masked', dict(params, dtype=dtype),
+                       lambda a=masked: ColortableImageRequest(ArrayRequest(a, (full, full)),
+                                                               colortable, None).wait())
+
+            channels = [_array('uint8', size, rng) for i in range(4)]
+            def rgba(channels=channels, size=size):
+                requests = [ArrayRequest(c, (full, full)) for c in channels]
+                return RGBAImageRequest(*requests + [[size, size]]).wait()
+            yield ('rgba', dict(params, dtype='uint8'), rgba)
+
+def requestCases(tileSizes, rng):
+    '''(name, function, params) of the slice and datasource requests.'''
+    for size in tileSizes:
+        for dtype in DTYPES:
+            # (t, x, y, z, c) volume of four tiles per slice and 8 slices
+            volume = np.zeros((1, 2*size, 2*size, 8, 1), dtype=dtype)
+            volume[...] = _array(dtype, 2*size, rng)[None, :, :, None, None]
+            slicesource = SliceSource(ArraySource(volume), SliceProjection())
+            slicing = (slice(size // 2, size // 2 + size),) * 2
+            yield ('slicesource', dict(tile=size, dtype=dtype),
+                   lambda s=slicesource, sl=slicing: s.request(sl).wait())
+
+            arraysource = ArraySource(volume)
+            domain = (slice(0, 1), slice(0, size), slice(0, size), slice(3, 4), slice(0, 1))
+            yield ('arraysource', dict(tile=size, dtype=dtype),
+                   lambda s=arraysource, sl=domain: s.request(sl).wait())
+
+def h5Cases(tileSizes, rng, directory):
+    if not _has_h5py:
+        return
+    f = h5py.File(os.path.join(directory, 'benchmark.h5'), 'w')
+    for size in tileSizes:
+        for dtype in DTYPES:
+            volume = np.zeros((1, 2*size, 2*size, 8, 1), dtype=dtype)
+            volume[...] = _array(dtype, 2*size, rng)[None, :, :, None, None]
+            name = '%s-%d' % (dtype, size)
+            chunked = f.create_dataset(name, data=volume, chunks=(1, 64, 64, 1, 1))
+            domain = (slice(0, 1), slice(0, size), slice(0, size), slice(3, 4), slice(0, 1))
+            yield ('h5py', dict(tile=size, dtype=dtype),
+                   lambda s=ArraySource(chunked), sl=domain: s.request(sl).wait())
+
+def compositingCases(tileSizes, layerCounts=(1, 4, 8)):
+    '''(name, function, params) of TileProvider._renderTile.'''
+    for size in tileSizes:
+        for nlayers in layerCounts:
+            lsm = LayerStackModel()
+            sims = StackedImageSources(lsm)
+            for i in range(nlayers):
+                ds = ConstantSource(10 * i)
+                layer = GrayscaleLayer(ds, normalize=False)
+                layer.opacity = 0.5
+                lsm.append(layer)
+                sims.register(layer, GrayscaleImageSource(ds, layer))
+            tiling = Tiling((size, size), blockSize=size)
+            tp = TileProvider(tiling, sims)
+            tp.requestRefresh(QRectF(0, 0, size, size))
+            tp.waitForTiles()
+            yield ('composite', dict(tile=size, layers=nlayers),
+                   partial(tp._renderTile, tp._current_stack_id, 0))
+
+def run(args):
+    rng = np.random.RandomState(42)
+    vigraModes = (True, False) if imagesources._has_vigra else (False,)
+    results = []
+    directory = tempfile.mkdtemp()
+
+    def add(name, params, f):
+        params = dict(params)
+        caseName = '/'.join([name] + ['%s=%s' % kv for kv in sorted(params.items())])
+        if args.filter and args.filter not in caseName:
+            return
+        try:
+            with _vigra(params.get('vigra', True)):
+                results.append(measure(caseName, f, args.repeat, path=name, **params))
+        except NotImplementedError:
+            # e.g. colortables without vigra
+            results.append(dict(params, name=caseName, path=name, skipped='not implemented'))
+        if args.verbose:
+            r = results[-1]
+            if 'latency' in r:
+                sys.stderr.write("%-60s %8.1f tiles/s  p50 %8.3f ms\n" % (
+                    caseName, r['tiles_per_second'], 1000 * r['latency']['p50']))
+            else:
+                sys.stderr.write("%-60s skipped\n" % caseName)
+
+    try:
+        cases = [imageRequestCases(args.tile_sizes, vigraModes, rng),
+                 requestCases(args.tile_sizes, rng),
+                 h5Cases(args.tile_sizes, rng, directory),
+                 compositingCases(args.tile_sizes)]
+        for generator in cases:
+            for name, params, f in generator:
+                add(name, params, f)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    return {'meta': {'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                     'python': platform.python_version(),
+                     'platform': platform.platform(),
+                     'numpy': np.__version__,
+                     'vigra': imagesources._has_vigra,
+                     'h5py': _has_h5py,
+                     'repeat': args.repeat},
+            'results': results}
+
+def compare(results, baseline, tolerance):
+    '''Return the cases whose median latency regressed by more than
+    tolerance (a fraction) with respect to baseline.'''
+    old = dict((r['name'], r) for r in baseline['results'] if 'latency' in r)
+    regressions = []
+    for r in results['results']:
+        if 'latency' not in r or r['name'] not in old:
+            continue
+        before = old[r['name']]['latency']['p50']
+        after = r['latency']['p50']
+        if before and after > before * (1.0 + tolerance):
+            regressions.append((r['name'], before, after))
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the volumina pixel pipeline.")
+    parser.add_argument('-o', '--output', help="write the results as JSON to this file (default: stdout)")
+    parser.add_argument('--repeat', type=int, default=50, help="timed calls per case")
+    parser.add_argument('--tile-sizes', type=int, nargs='+', default=list(TILE_SIZES))
+    parser.add_argument('--filter', help="only run cases whose name contains this string")
+    parser.add_argument('--compare', help="baseline JSON file of an earlier run")
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help="allowed relative increase of the median latency (default 0.2)")
+    parser.add_argument('-v', '--verbose', action='store_true')
+    args = parser.parse_args(argv)
+
+    results = run(args)
+    text = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text)
+    else:
+        print text
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        for name, before, after in regressions:
+            sys.stderr.write("REGRESSION %s: p50 %.3f ms -> %.3f ms\n" % (name, 1000 * before, 1000 * after))
+        if regressions:
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
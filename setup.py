@@ -45,5 +45,6 @@ setup(name='volumina',
       url='https://github.com/Ilastik/volumina',
       packages=packages,
       package_data=package_data,
+      entry_points={'console_scripts': ['volumina-render = volumina.offscreen:main']},
       setup_requires=['nose>=1.0']
      )
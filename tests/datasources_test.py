@@ -21,9 +21,17 @@
 ###############################################################################
 import unittest as ut
 import os
+import shutil
+import tempfile
+import time
+import threading
 from abc import ABCMeta, abstractmethod
 import volumina._testing
-from volumina.pixelpipeline.datasources import ArraySource, RelabelingArraySource
+from volumina.pixelpipeline.datasources import ArraySource, RelabelingArraySource, \
+                                               DiskCacheSource
+from volumina.pixelpipeline.tilestore import TileStore
+from volumina.pixelpipeline import sharedcache
+from volumina.pixelpipeline.sharedcache import SharedArrayCache
 import numpy as np
 from volumina.slicingtools import sl, slicing2shape
 try:
@@ -62,9 +70,9 @@ class GenericArraySourceTest:
     def testSetDirty( self ):
         self.signal_emitted = False
 
-        def slot( sl ):
+        def slot( slicing ):
             self.signal_emitted = True
-            self.assertTrue( sl == self.slicing )
+            self.assertTrue( slicing == self.slicing )
 
         self.source.isDirty.connect(slot)
         self.source.setDirty( self.slicing )
@@ -124,9 +132,9 @@ class RelabelingArraySourceTest( ut.TestCase, GenericArraySourceTest ):
         self.signal_emitted = False
         self.slicing = (slice(0,5),slice(None), slice(None), slice(None), slice(None))
 
-        def slot( sl ):
+        def slot( slicing ):
             self.signal_emitted = True
-            self.assertTrue( sl == self.slicing )
+            self.assertTrue( slicing == self.slicing )
 
         self.source.isDirty.connect(slot)
         self.source.setDirty( self.slicing )
@@ -137,5 +145,166 @@ class RelabelingArraySourceTest( ut.TestCase, GenericArraySourceTest ):
         del self.signal_emitted
         del self.slicing
 
+class DiskCacheSourceTest( ut.TestCase, GenericArraySourceTest ):
+    def setUp( self ):
+        GenericArraySourceTest.setUp(self)
+        self.directory = tempfile.mkdtemp()
+        self.store = TileStore(self.directory, 2**20)
+        self.raw = np.random.randint(0, 255, (1,64,64,1,1)).astype(np.uint8)
+        self.source = DiskCacheSource( ArraySource(self.raw), 'raw', store=self.store )
+
+        self.samesource = DiskCacheSource( ArraySource(self.raw), 'raw', store=self.store )
+        self.othersource = DiskCacheSource( ArraySource(np.array(self.raw)), 'other', store=self.store )
+
+    def tearDown( self ):
+        shutil.rmtree(self.directory)
+
+    def testReadFromDisk( self ):
+        expected = self.raw[self.slicing].copy()
+        self.source.request(self.slicing).wait()
+        self.raw[:] = 0
+
+        # a new session with the same store directory
+        store = TileStore(self.directory, 2**20)
+        self.assertEqual(len(store), 1)
+        source = DiskCacheSource( ArraySource(self.raw), 'raw', store=store )
+        self.assertTrue(np.all(source.request(self.slicing).wait() == expected))
+
+    def testDirtyInvalidates( self ):
+        other = (slice(0,1), slice(40,50), slice(40,50), slice(0,1), slice(0,1))
+        self.source.request(self.slicing).wait()
+        self.source.request(other).wait()
+        self.assertEqual(len(self.store), 2)
+
+        self.source.setDirty((slice(None), slice(15,30), slice(None), slice(None), slice(None)))
+        self.assertEqual(len(self.store), 1)
+        self.raw[:] = 0
+        self.assertTrue(np.all(self.source.request(self.slicing).wait() == 0))
+
+    def testOutdatedRequestIsNotStored( self ):
+        request = self.source.request(self.slicing)
+        self.source.setDirty(self.slicing)
+        request.wait()
+        self.assertEqual(len(self.store), 0)
+
+    def testNewVersionPurgesOldOne( self ):
+        self.source.request(self.slicing).wait()
+        self.othersource.request(self.slicing).wait()
+        DiskCacheSource( ArraySource(self.raw), 'raw', version=1, store=self.store )
+        self.assertEqual(len(self.store), 1)
+
+    def testEviction( self ):
+        store = TileStore(self.directory, 3000)
+        source = DiskCacheSource( ArraySource(self.raw), 'small', store=store )
+        for i in range(5):
+            source.request((slice(0,1), slice(0,32), slice(i,i+32), slice(0,1), slice(0,1))).wait()
+        self.assertTrue(store.usedBytes() <= 3000)
+        self.assertEqual(len(store), 2)
+
+    def testUntrustedFiles( self ):
+        self.source.request(self.slicing).wait()
+        path, = self.store._files.keys()
+        nsdir = os.path.dirname(path)
+        self.assertEqual(os.stat(nsdir).st_mode & 0o077, 0)
+
+        # pickled objects are never loaded
+        np.save(path, np.array([object()], dtype=object))
+        self.assertTrue(self.store.get(os.path.basename(nsdir), self.slicing) is None)
+        self.assertEqual(len(self.store), 0)
+
+        # only temporary files that are not written anymore are deleted
+        young, old = os.path.join(nsdir, 'a.tmp'), os.path.join(nsdir, 'b.tmp')
+        for tmp in (young, old):
+            open(tmp, 'wb').close()
+        expired = time.time() - 2 * TileStore.TMP_GRACE
+        os.utime(old, (expired, expired))
+        TileStore(self.directory, 2**20)
+        self.assertTrue(os.path.exists(young))
+        self.assertFalse(os.path.exists(old))
+
+class CountingArray( object ):
+    '''Array-like (e.g. a h5py dataset) counting its reads.'''
+    def __init__( self, array ):
+        self.array = array
+        self.shape = array.shape
+        self.dtype = array.dtype
+        self.reads = 0
+
+    def __getitem__( self, slicing ):
+        self.reads += 1
+        return self.array[slicing].copy()
+
+class BlockingRequest( object ):
+    def __init__( self, result ):
+        self.result = result
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.waits = 0
+
+    def wait( self ):
+        self.waits += 1
+        self.started.set()
+        self.release.wait()
+        return self.result
+
+class SharedArrayCacheTest( ut.TestCase ):
+    def setUp( self ):
+        self.saved = sharedcache.shared_array_cache
+        self.cache = sharedcache.shared_array_cache = SharedArrayCache(2**20)
+        self.data = CountingArray(np.random.randint(0, 255, (1,64,64,1,1)).astype(np.uint8))
+        self.slicing = (slice(0,1), slice(10,20), slice(10,20), slice(0,1), slice(0,1))
+
+    def tearDown( self ):
+        sharedcache.shared_array_cache = self.saved
+
+    def testSharedBetweenSources( self ):
+        source1 = ArraySource(self.data)
+        source2 = ArraySource(self.data)
+        a = sharedcache.cachedRequest(source1, self.slicing).wait()
+        b = sharedcache.cachedRequest(source2, self.slicing).wait()
+        self.assertEqual(self.data.reads, 1)
+        self.assertTrue(np.all(a == self.data.array[self.slicing]))
+        self.assertTrue(a is b)
+        self.assertEqual(self.cache.usedBytes(), a.nbytes)
+
+        # in-memory arrays are not shared
+        sharedcache.cachedRequest(ArraySource(self.data.array), self.slicing).wait()
+        self.assertEqual(len(self.cache), 1)
+
+    def testDirtyInvalidates( self ):
+        source = ArraySource(self.data)
+        sharedcache.cachedRequest(source, self.slicing).wait()
+        source.setDirty((slice(None), slice(0,5), slice(None), slice(None), slice(None)))
+        self.assertEqual(len(self.cache), 1)
+        source.setDirty((slice(None), slice(15,30), slice(None), slice(None), slice(None)))
+        self.assertEqual(len(self.cache), 0)
+        sharedcache.cachedRequest(source, self.slicing).wait()
+        self.assertEqual(self.data.reads, 2)
+
+    def testConcurrentRequestsFetchOnce( self ):
+        request = BlockingRequest(np.zeros((1,10,10,1,1), dtype=np.uint8))
+        results = []
+        def fetch():
+            results.append(self.cache.fetch('key', self.slicing, request))
+        threads = [threading.Thread(target=fetch) for i in range(3)]
+        for t in threads:
+            t.start()
+        request.release.set()
+        for t in threads:
+            t.join()
+        self.assertEqual(request.waits, 1)
+        self.assertEqual(len(results), 3)
+        self.assertTrue(all(r is request.result for r in results))
+
+    def testOutdatedFetchIsNotStored( self ):
+        request = BlockingRequest(np.zeros((1,10,10,1,1), dtype=np.uint8))
+        t = threading.Thread(target=self.cache.fetch, args=('key', self.slicing, request))
+        t.start()
+        request.started.wait()
+        self.cache.invalidate('key', self.slicing)
+        request.release.set()
+        t.join()
+        self.assertEqual(len(self.cache), 0)
+
 if __name__ == '__main__':
     ut.main()
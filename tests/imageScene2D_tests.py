@@ -22,6 +22,7 @@
 import unittest as ut
 import time, datetime
 
+from PyQt4.QtCore import QRectF
 from PyQt4.QtGui import QImage, QPainter, QApplication, QStyleOptionGraphicsItem
 
 from qimage2ndarray import byte_view
@@ -36,6 +37,20 @@ from volumina.layerstack import LayerStackModel
 from volumina.layer import GrayscaleLayer
 import volumina.pixelpipeline.imagesourcefactories as imsfac
 
+class _UnstridedSource( ConstantSource ):
+    '''Records the requested slicings, like a datasource which reads the
+    full resolution bounding box of strided requests (e.g. lazyflow).'''
+    def __init__( self, constant ):
+        super(_UnstridedSource, self).__init__(constant)
+        self.slicings = []
+
+    def supportsStridedReads( self ):
+        return False
+
+    def request( self, slicing, through=None ):
+        self.slicings.append(slicing)
+        return super(_UnstridedSource, self).request(slicing, through)
+
 class DirtyIndicatorTest( ut.TestCase ):
     @classmethod
     def setUpClass(cls):
@@ -135,6 +150,39 @@ class ImageScene2DTest( ut.TestCase ):
         s.stackedImageSources = sims
         self.assertEqual(id(s.stackedImageSources), id(sims))
 
+    def testBlockSize( self ):
+        s = ImageScene2D(PositionModel(), (0,3,4), preemptive_fetch_number=0)
+        s.dataShape = (3000, 2000)
+        self.assertEqual(s.blockSize(), 256)
+        s.setBlockSize(512)
+        self.assertEqual(s.blockSize(), 512)
+        s.dataShape = (3000, 1000)
+        self.assertEqual(s.blockSize(), 512)
+        s.setBlockSize(None)
+        self.assertEqual(s.blockSize(), 512) # the current size is kept
+
+    def testBowWave( self ):
+        posModel = PositionModel()
+        posModel.shape5D = [3,10,10,50,1]
+        posModel.slicingPos = [0,0,20]
+        s = ImageScene2D(posModel, (0,3,4), preemptive_fetch_number=3)
+
+        # at rest: the next slices ahead, one behind and the next time step
+        self.assertEqual(s._bowWave(3), [(0,21,0), (0,22,0), (0,23,0), (0,19,0), (1,20,0)])
+        self.assertEqual(s._bowWave(0), [])
+
+        # scrolling at 25 slices/s: look one second ahead
+        now = time.time()
+        s._velocity[1].update(1, now=now-0.2)
+        s._velocity[1].update(5, now=now-0.1)
+        self.assertAlmostEqual(s._velocity[1].speed(now), 25.0)
+        bowWave = s._bowWave(3)
+        self.assertEqual(bowWave[:25], [(0,z,0) for z in range(21,46)])
+        self.assertEqual(bowWave[25:], [(0,19,0), (1,20,0)])
+
+        # the velocity decays once the user stops
+        self.assertEqual(s._velocity[1].speed(now+s._velocity[1].IDLE), 0.0)
+
 class ImageScene2D_RenderTest( ut.TestCase ):
 
     @classmethod
@@ -198,5 +246,27 @@ class ImageScene2D_RenderTest( ut.TestCase ):
         self.assertTrue(np.all(aimg[:,:,0:3] == self.GRAY))
         self.assertTrue(np.all(aimg[:,:,3] == 255))
 
+    def testLevelOfDetailNeedsStridedReads( self ):
+        ds = _UnstridedSource(self.GRAY)
+        layer = GrayscaleLayer( ds )
+        layer.set_normalize(0, False)
+        self.layerstack.append(layer)
+        self.sims.register(layer, imsfac.createImageSource( layer, [ds] ))
+        self.scene.dataShape = (4000,4000)
+        self.assertEqual(self.scene.levelOfDetailEnabled(), True)
+
+        # zoomed out by a factor of 40: the full resolution extent
+        # requested per tile is bounded by the tile size nevertheless
+        img = QImage(100,100,QImage.Format_ARGB32_Premultiplied)
+        p = QPainter(img)
+        self.scene.render(p, QRectF(0,0,100,100), QRectF(0,0,4000,4000))
+        p.end()
+        self.assertTrue(len(ds.slicings) > 0)
+        bound = self.scene.blockSize() + 2*self.scene._tiling.overlap
+        for slicing in ds.slicings:
+            for s in slicing:
+                self.assertTrue(s.step in (None, 1))
+                self.assertTrue(s.stop - s.start <= bound)
+
 if __name__ == '__main__':
     ut.main()
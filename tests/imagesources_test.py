@@ -38,8 +38,9 @@ import qimage2ndarray
 #volumina
 import volumina._testing
 from volumina.pixelpipeline.imagesources import GrayscaleImageSource, AlphaModulatedImageSource, RGBAImageSource, \
-    ColortableImageSource
+    ColortableImageSource, get_raw_array_cache
 from volumina.pixelpipeline.datasources import ConstantSource, ArraySource
+from volumina.pixelpipeline.imagepool import ImagePool
 from volumina.layer import GrayscaleLayer, AlphaModulatedLayer, RGBALayer, ColortableLayer
 
 import threading
@@ -75,6 +76,22 @@ class _ArraySource2d( ArraySource ):
     def request( self, slicing, through=None):
         return super(_ArraySource2d, self).request( slicing )
 
+class _CountingArraySource2d( _ArraySource2d ):
+    '''Counts the requests that actually read the array, and returns
+    copies as if the array was read from disk.'''
+    def __init__( self, array ):
+        super(_CountingArraySource2d, self).__init__( array )
+        self.fetches = 0
+
+    def request( self, slicing, through=None ):
+        req = super(_CountingArraySource2d, self).request( slicing, through )
+        wait = req.wait
+        def countingWait():
+            self.fetches += 1
+            return wait().copy()
+        req.wait = countingWait
+        return req
+
 class ImageSourcesTestBase( ut.TestCase ):
     """
     A common base class for all ImageSource tests.
@@ -136,6 +153,43 @@ class GrayscaleImageSourceTest( ImageSourcesTestBase ):
         self.ims.setDirty((slice(34,37), slice(12,34)))
         self.ims.isDirty.disconnect( checkDirtyRect )
 
+    def testRawArrayCache( self ):
+        ars = _CountingArraySource2d(self.raw)
+        layer = GrayscaleLayer( ars )
+        ims = GrayscaleImageSource( ars, layer )
+        rect = QRect(0,0,64,64)
+        ims.request(rect, ((2,0),)).wait()
+        self.assertEqual(ars.fetches, 1)
+
+        # a new normalization is rendered from the cached array
+        layer.set_normalize(0, (0,100))
+        ims.request(rect, ((2,0),)).wait()
+        self.assertEqual(ars.fetches, 1)
+
+        # other slices are cached separately
+        ims.request(rect, ((2,1),)).wait()
+        self.assertEqual(ars.fetches, 2)
+
+        # changed data is read again
+        ims.setDirty((slice(0,8), slice(0,8)))
+        ims.request(rect, ((2,0),)).wait()
+        self.assertEqual(ars.fetches, 3)
+        ims.request(QRect(64,64,64,64), ((2,0),)).wait()
+        ims.setDirty((slice(0,8), slice(0,8)))
+        ims.request(QRect(64,64,64,64), ((2,0),)).wait()
+        self.assertEqual(ars.fetches, 4)
+
+        # without the position of the slice nothing is cached
+        ims.request(rect).wait()
+        ims.request(rect).wait()
+        self.assertEqual(ars.fetches, 6)
+
+        # neither are views of in-memory arrays
+        cache = get_raw_array_cache()
+        n = len(cache)
+        self.ims.request(rect, ((2,0),)).wait()
+        self.assertEqual(len(cache), n)
+
 class GrayscaleImageSourceTest2( ImageSourcesTestBase ):
     def setUp( self ):
         super( GrayscaleImageSourceTest2, self ).setUp()
@@ -317,10 +371,40 @@ class ColortableImageSourceTest( ImageSourcesTestBase ):
                 img.setPixel(i, 4, QColor(0,0,255).rgba())
                 img.setPixel(i, 5, QColor(0,0,255).rgba())
             assert img.size() == result.size()
-            assert img == result
+            # label images are stored with 8 bit per pixel
+            assert result.format() == QImage.Format_Indexed8
+            assert img == result.convertToFormat(QImage.Format_ARGB32)
 
         imr.notify(check, codon="unique")
 
+    def testPaletteChanged( self ):
+        changes = []
+        self.ims.paletteChanged.connect( lambda: changes.append('palette') )
+        self.ims.isDirty.connect( lambda rect: changes.append('dirty') )
+
+        # the layer notifies the image source
+        self.layer.colorTable = [QColor(255,255,0).rgba()] + self.ctable[1:]
+        self.assertEqual(changes, ['palette'])
+        self.assertEqual(self.ims.palette()[0], QColor(255,255,0).rgba())
+        img = self.ims.request(QRect(0,0,7,6)).wait()
+        self.assertEqual(img.pixel(0, 0), QColor(255,255,0).rgba())
+
+        # indexed images are not valid for a colortable of another length
+        self.layer.colorTable = self.ctable[:2]
+        self.assertEqual(changes, ['palette', 'dirty'])
+
+    def testLargeColortable( self ):
+        # more than 256 colors do not fit an 8 bit index
+        ctable = [QColor(i % 256, 0, 0).rgba() for i in range(257)]
+        ctable[256] = QColor(0,0,255).rgba()
+        self.layer.colorTable = ctable
+        self.seg[4:6,:] = 256
+        img = self.ims.request(QRect(0,0,7,6)).wait()
+        self.assertEqual(img.format(), QImage.Format_ARGB32)
+        self.assertEqual(img.pixel(0, 0), ctable[0])
+        self.assertEqual(img.pixel(0, 2), ctable[1])
+        self.assertEqual(img.pixel(0, 4), QColor(0,0,255).rgba())
+
     def testSetDirty( self ):
         def checkAllDirty( rect ):
             self.assertTrue( rect.isEmpty() )
@@ -456,6 +540,50 @@ class RGBAImageSourceTest( ImageSourcesTestBase ):
         self.assertFalse( ims_notopaque.isOpaque() )
         
 
+#*******************************************************************************
+# I m a g e P o o l T e s t                                                    *
+#*******************************************************************************
+
+class ImagePoolTest( ut.TestCase ):
+    def testReuse( self ):
+        img = QImage(16, 8, QImage.Format_ARGB32_Premultiplied)
+        pool = ImagePool(10*img.byteCount())
+        pool.release(img)
+        self.assertEqual(len(pool), 1)
+
+        # the buffer is still used by img
+        other = pool.acquire(16, 8, QImage.Format_ARGB32_Premultiplied)
+        self.assertEqual(len(pool), 1)
+        other.fill(0)
+        img.fill(0xffffffff)
+        self.assertEqual(other.pixel(0, 0), 0)
+
+        bits = int(img.constBits())
+        del img
+        reused = pool.acquire(16, 8, QImage.Format_ARGB32_Premultiplied)
+        self.assertEqual(int(reused.constBits()), bits)
+        self.assertEqual(len(pool), 0)
+        self.assertEqual(pool.usedBytes(), 0)
+
+        # size and format must match
+        pool.release(reused)
+        del reused
+        self.assertEqual(pool.acquire(8, 16, QImage.Format_ARGB32_Premultiplied).size().width(), 8)
+        self.assertEqual(pool.acquire(16, 8, QImage.Format_ARGB32).format(), QImage.Format_ARGB32)
+        self.assertEqual(len(pool), 1)
+
+    def testBudget( self ):
+        nbytes = QImage(16, 8, QImage.Format_ARGB32).byteCount()
+        pool = ImagePool(2*nbytes)
+        for i in range(3):
+            pool.release(QImage(16, 8, QImage.Format_ARGB32))
+        self.assertEqual(len(pool), 2)
+        self.assertEqual(pool.usedBytes(), 2*nbytes)
+        pool.release(QImage(64, 64, QImage.Format_ARGB32))
+        self.assertEqual(len(pool), 2)
+        pool.clear()
+        self.assertEqual(pool.usedBytes(), 0)
+
 #*******************************************************************************
 # i f   _ _ n a m e _ _   = =   " _ _ m a i n _ _ "                            *
 #*******************************************************************************
@@ -0,0 +1,101 @@
+###############################################################################
+#   volumina: volume slicing and editing library
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the Lesser GNU General Public License
+# as published by the Free Software Foundation; either version 2.1
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# See the files LICENSE.lgpl2 and LICENSE.lgpl3 for full text of the
+# GNU Lesser General Public License version 2.1 and 3 respectively.
+# This information is also available on the ilastik web site at:
+#		   http://ilastik.org/license/
+###############################################################################
+import json
+import threading
+import unittest
+from StringIO import StringIO
+
+from volumina.metrics import MetricsRegistry, Histogram, labelled, \
+                             currentLabel, TRANSFORM, QUEUE_WAIT
+
+class HistogramTest(unittest.TestCase):
+    def testPercentiles(self):
+        h = Histogram()
+        self.assertEqual(h.percentile(50), None)
+        for ms in range(1, 101):
+            h.record(ms / 1000.0)
+        self.assertEqual(h.count, 100)
+        self.assertAlmostEqual(h.mean(), 0.0505)
+        # buckets are about 19% wide
+        self.assertAlmostEqual(h.percentile(50), 0.050, delta=0.005)
+        self.assertAlmostEqual(h.percentile(95), 0.095, delta=0.01)
+        self.assertAlmostEqual(h.percentile(99), 0.099, delta=0.01)
+        self.assertEqual(h.percentile(100), 0.1)
+        self.assertEqual(h.percentile(0), 0.001)
+
+    def testOutOfRange(self):
+        h = Histogram()
+        h.record(0)
+        h.record(1e6)
+        self.assertEqual(h.percentile(50), 0)
+        self.assertEqual(h.percentile(100), 1e6)
+
+class MetricsRegistryTest(unittest.TestCase):
+    def testLabels(self):
+        m = MetricsRegistry()
+        m.record(TRANSFORM, 0.01, 'raw')
+        with labelled('labels'):
+            self.assertEqual(currentLabel(), 'labels')
+            m.record(TRANSFORM, 0.02)
+            m.increment('tiles_rendered')
+        self.assertEqual(currentLabel(), '')
+        m.record(QUEUE_WAIT, 0.5)
+
+        self.assertEqual(m.counter('tiles_rendered', 'labels'), 1)
+        self.assertEqual(m.counter('tiles_rendered', 'raw'), 0)
+        self.assertAlmostEqual(m.percentile(TRANSFORM, 50, 'raw'), 0.01, delta=0.001)
+        self.assertAlmostEqual(m.percentile(TRANSFORM, 50, 'labels'), 0.02, delta=0.002)
+        self.assertAlmostEqual(m.percentile(QUEUE_WAIT, 50, ''), 0.5, delta=0.05)
+
+        snapshot = m.snapshot()
+        self.assertEqual(sorted(snapshot['histograms'][TRANSFORM].keys()),
+                         ['labels', 'raw'])
+        self.assertEqual(snapshot['histograms'][TRANSFORM]['raw']['count'], 1)
+
+        f = StringIO()
+        m.dump(f)
+        self.assertEqual(json.loads(f.getvalue()), json.loads(m.toJSON()))
+
+        m.reset()
+        self.assertEqual(m.snapshot(), {'counters': {}, 'histograms': {}})
+
+    def testThreadLabelsAreIndependent(self):
+        m = MetricsRegistry()
+        def work():
+            with labelled('other'):
+                m.increment('n')
+        with labelled('main'):
+            t = threading.Thread(target=work)
+            t.start()
+            t.join()
+            m.increment('n')
+        self.assertEqual(m.counter('n', 'main'), 1)
+        self.assertEqual(m.counter('n', 'other'), 1)
+
+    def testDisabled(self):
+        m = MetricsRegistry(enabled=False)
+        m.increment('n')
+        m.record(TRANSFORM, 1.0)
+        self.assertEqual(m.snapshot(), {'counters': {}, 'histograms': {}})
+
+if __name__=='__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+###############################################################################
+#   volumina: volume slicing and editing library
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the Lesser GNU General Public License
+# as published by the Free Software Foundation; either version 2.1
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# See the files LICENSE.lgpl2 and LICENSE.lgpl3 for full text of the
+# GNU Lesser General Public License version 2.1 and 3 respectively.
+# This information is also available on the ilastik web site at:
+#		   http://ilastik.org/license/
+###############################################################################
+import os
+import shutil
+import tempfile
+import unittest as ut
+import numpy as np
+from PyQt4.QtGui import QApplication, QImage
+
+from volumina.layerstack import LayerStackModel
+from volumina.layer import GrayscaleLayer
+from volumina.pixelpipeline.datasources import ArraySource
+from volumina.offscreen import OffscreenRenderer, main
+
+class OffscreenRendererTest( ut.TestCase ):
+    @classmethod
+    def setUpClass(cls):
+        if QApplication.instance():
+            cls.app = QApplication.instance()
+        else:
+            cls.app = QApplication([], False)
+
+    def setUp( self ):
+        x, y, z = np.mgrid[0:40, 0:30, 0:20]
+        self.data = (2*x + 3*y + 5*z).astype(np.uint8)[np.newaxis, ..., np.newaxis]
+        lsm = LayerStackModel()
+        lsm.append(GrayscaleLayer(ArraySource(self.data), normalize=False))
+        self.renderer = OffscreenRenderer(lsm, self.data.shape, blockSize=16)
+
+    def assertGray( self, rgba, expected ):
+        self.assertEqual(rgba.shape, expected.shape + (4,))
+        for i in range(3):
+            self.assertTrue(np.all(rgba[..., i] == expected))
+        self.assertTrue(np.all(rgba[..., 3] == 255))
+
+    def testSlices( self ):
+        a = self.data[0, ..., 0]
+        self.assertEqual(self.renderer.sliceShape('z'), (40, 30))
+        self.assertGray(self.renderer.render('z', 5, timeout=10), a[:, :, 5].T)
+        self.assertGray(self.renderer.render('x', 3, timeout=10), a[3, :, :].T)
+        self.assertGray(self.renderer.render(1, 7, timeout=10), a[:, 7, :].T)
+
+    def testRegionAndLevel( self ):
+        a = self.data[0, ..., 0]
+        rgba = self.renderer.render('z', 5, region=(10, 5, 20, 10), timeout=10)
+        self.assertGray(rgba, a[10:30, 5:15, 5].T)
+        rgba = self.renderer.render('z', 5, level=1, timeout=10)
+        self.assertGray(rgba, a[::2, ::2, 5].T)
+
+    def testInvalidArguments( self ):
+        self.assertRaises(ValueError, self.renderer.render, 'c', 0)
+        self.assertRaises(ValueError, self.renderer.render, 'z', 20)
+        self.assertRaises(ValueError, self.renderer.render, 'z', 0, (100, 100, 5, 5))
+
+    def testCommandLine( self ):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'raw.npy')
+            np.save(path, self.data[0, ..., 0])
+            output = os.path.join(directory, 'z%d.png')
+            self.assertEqual(main([path, '--axis', 'z', '--slice', '0:2', '-o', output]), 0)
+            for i in range(2):
+                img = QImage(output % i)
+                self.assertEqual((img.width(), img.height()), (40, 30))
+        finally:
+            shutil.rmtree(directory)
+
+if __name__ == '__main__':
+    ut.main()
@@ -20,19 +20,26 @@
 #		   http://ilastik.org/license/
 ###############################################################################
 # time to wait (in seconds) for rendering to finish
+import os
+import shutil
+import tempfile
 import unittest as ut
 import numpy as np
-from PyQt4.QtCore import QRectF, QPoint, QRect
-from PyQt4.QtGui import QTransform
+from PyQt4.QtCore import QObject, QRectF, QPoint, QPointF, QRect, QSize
+from PyQt4.QtGui import QTransform, QImage
 from qimage2ndarray import byte_view
+from concurrent.futures import Future
 
-from volumina.tiling import TileProvider, Tiling
+from volumina.metrics import get_metrics
+from volumina.tiling import TileProvider, Tiling, TileCacheMemory, _TilesCache, RenderTask, \
+                           RenderTaskExecutor, SystemMemory, LRUStackPolicy, DistanceStackPolicy, \
+                           _layerImage, _recolored, get_tile_cache_memory
 from volumina.layerstack import LayerStackModel
 from volumina.layer import GrayscaleLayer
 from volumina.pixelpipeline.datasources import ConstantSource, ArraySource
 from volumina.pixelpipeline.imagesources import GrayscaleImageSource
 from volumina.pixelpipeline.imagepump import StackedImageSources, ImagePump
-from volumina.slicingtools import SliceProjection
+from volumina.slicingtools import SliceProjection, slicing2shape
 
 
 class TilingTest ( ut.TestCase ):
@@ -64,6 +71,633 @@ class TilingTest ( ut.TestCase ):
         with self.assertRaises(AssertionError):
             t.data2scene = trans
 
+    def testImageTransform( self ):
+        t = Tiling((300, 100), blockSize=256)
+        self.assertEqual(t.dataRects[0], QRect(0, 0, 256, 100))
+        # the image sources render the transpose of the data
+        self.assertEqual(t.imageSize(0), QSize(100, 256))
+        self.assertEqual(t.imageTransform(0).map(QPointF(100, 256)), QPointF(256, 100))
+        self.assertEqual(t.imageTransform(1).map(QPointF(0, 0)), QPointF(256, 0))
+
+        # swapping the axes of the view only changes the transform
+        t.data2scene = QTransform(0, 1, 1, 0, 0, 0)
+        self.assertEqual(t.dataRects[0], QRect(0, 0, 256, 100))
+        self.assertEqual(t.imageSize(0), QSize(100, 256))
+        self.assertEqual(t.imageRects[0], QRect(0, 0, 100, 256))
+        self.assertEqual(t.imageTransform(0).mapRect(QRectF(0, 0, 100, 256)),
+                         QRectF(t.imageRects[0]))
+
+        # downsampled images are stretched over their data rectangle
+        t = Tiling((300, 100), blockSize=128, level=1)
+        self.assertEqual(t.imageSize(0), QSize(50, 128))
+        self.assertEqual(t.imageTransform(0).map(QPointF(50, 128)), QPointF(256, 100))
+
+    def testGigapixelSlice( self ):
+        # no per tile state is built up front
+        t = Tiling((100000, 100000), blockSize=256)
+        self.assertEqual(len(t), 391*391)
+        self.assertEqual(len(t.tileRects), len(t))
+        self.assertEqual(t.imageRects[-1], QRect(99840, 99840, 160, 160))
+        self.assertAlmostEqual(t.boundingRectF().right(), 100000 + 1e-3)
+
+        self.assertEqual(t.containsF(QPointF(300, 10)), 1)
+        self.assertEqual(t.containsF(QPointF(99999, 99999)), len(t) - 1)
+        self.assertEqual(t.containsF(QPointF(-5, 10)), None)
+        self.assertEqual(t.intersected(QRectF(300, 300, 300, 10)), [392, 393])
+
+        # containsF and intersected respect the data2scene transform
+        t.data2scene = QTransform.fromScale(2, 2)
+        self.assertEqual(t.containsF(QPointF(600, 20)), 1)
+        self.assertEqual(t.intersected(QRectF(600, 600, 600, 20)), [392, 393])
+        self.assertEqual(t.imageRects[1], QRect(512, 0, 512, 512))
+
+    def testLevel( self ):
+        t = Tiling((1000, 600), blockSize=100, level=2)
+        self.assertEqual(len(t), 3*2)
+        self.assertEqual(t.imageRects[0], QRect(0, 0, 400, 400))
+        self.assertEqual(t.imageSize(0), QSize(100, 100))
+        self.assertEqual(t.imageSize(5), QSize(50, 50))
+
+    def testLevelForScale( self ):
+        self.assertEqual(Tiling.levelForScale(2.0, (20000, 20000)), 0)
+        self.assertEqual(Tiling.levelForScale(1.0, (20000, 20000)), 0)
+        self.assertEqual(Tiling.levelForScale(0.5, (20000, 20000)), 1)
+        self.assertEqual(Tiling.levelForScale(0.3, (20000, 20000)), 1)
+        self.assertEqual(Tiling.levelForScale(0.25, (20000, 20000)), 2)
+        # the coarsest level consists of a single tile
+        self.assertEqual(Tiling.levelForScale(1e-6, (20000, 20000)), 7)
+        self.assertEqual(Tiling.levelForScale(1e-6, (100, 100)), 0)
+
+    def testSuggestedBlockSize( self ):
+        suggest = Tiling.suggestedBlockSize
+        self.assertEqual(suggest((1000, 1000)), 256)
+        # small slices are covered by a single tile
+        self.assertEqual(suggest((300, 200)), 256)
+        self.assertEqual(suggest((100, 100), [(512, 512)]), 128)
+        self.assertEqual(suggest((10, 10)), Tiling.MIN_BLOCKSIZE)
+        # tiles cover whole chunks
+        self.assertEqual(suggest((5000, 5000), [(64, 64), (300, 100)]), 512)
+        self.assertEqual(suggest((5000, 5000), [(0, 0)]), 256)
+        self.assertEqual(suggest((5000, 5000), [(4096, 4096)]), Tiling.MAX_BLOCKSIZE)
+        # cheap tiles grow, expensive ones shrink
+        self.assertEqual(suggest((5000, 5000), timePerTile=0.001), 1024)
+        self.assertEqual(suggest((5000, 5000), timePerTile=0.5), 128)
+        self.assertEqual(suggest((5000, 5000), timePerTile=0.1), 256)
+        self.assertEqual(suggest((5000, 5000), timePerTile=0.1, blockSize=512), 512)
+
+
+class TileCacheMemoryTest( ut.TestCase ):
+    def setUp( self ):
+        self.sims = StackedImageSources( LayerStackModel() )
+        self.img = QImage(10, 10, QImage.Format_ARGB32_Premultiplied)
+        self.nbytes = self.img.byteCount()
+
+    def testLRUEviction( self ):
+        memory = TileCacheMemory(3*self.nbytes)
+        cache = _TilesCache('s0', self.sims, memory=memory)
+        with cache:
+            for tile_id in range(3):
+                cache.updateTileIfNecessary('s0', 'l', tile_id, 1.0, QImage(self.img))
+            self.assertEqual(memory.usedBytes(), 3*self.nbytes)
+
+            # use tile 0, so that tile 1 becomes the least recently used
+            self.assertFalse(cache.layer('s0', 'l', 0) is None)
+            cache.updateTileIfNecessary('s0', 'l', 3, 1.0, QImage(self.img))
+
+            self.assertEqual(memory.usedBytes(), 3*self.nbytes)
+            self.assertEqual(cache.memoryUsage(), 3*self.nbytes)
+            self.assertTrue(cache.layer('s0', 'l', 1) is None)
+            self.assertTrue(cache.layerDirty('s0', 'l', 1))
+            self.assertFalse(cache.layer('s0', 'l', 0) is None)
+            self.assertFalse(cache.layerDirty('s0', 'l', 0))
+
+    def testBudgetIsShared( self ):
+        memory = TileCacheMemory(2*self.nbytes)
+        cache1 = _TilesCache('s0', self.sims, memory=memory)
+        cache2 = _TilesCache('s0', self.sims, memory=memory)
+        with cache1:
+            cache1.updateTileIfNecessary('s0', 'l', 0, 1.0, QImage(self.img))
+        with cache2:
+            cache2.updateTileIfNecessary('s0', 'l', 0, 1.0, QImage(self.img))
+            cache2.updateTileIfNecessary('s0', 'l', 1, 1.0, QImage(self.img))
+        self.assertEqual(memory.usedBytes(), 2*self.nbytes)
+        self.assertEqual(cache1.memoryUsage(), 0)
+        self.assertEqual(cache2.memoryUsage(), 2*self.nbytes)
+
+    def testPeekWithoutClaiming( self ):
+        memory = TileCacheMemory(2*self.nbytes)
+        cache = _TilesCache('s0', self.sims, memory=memory)
+        with cache:
+            cache.updateTileIfNecessary('s0', 'l', 0, 1.0, QImage(self.img))
+            cache.updateTileIfNecessary('s0', 'l', 1, 1.0, QImage(self.img))
+
+        # peeking does not claim the cache; its LRU touch is applied on
+        # the next claim, such that tile 1 is evicted rather than tile 0
+        self.assertFalse(cache.peekLayer('s0', 'l', 0) is None)
+        self.assertEqual(cache.peekTile('s0', 0), (None, 0.))
+        with cache:
+            cache.updateTileIfNecessary('s0', 'l', 2, 1.0, QImage(self.img))
+            self.assertTrue(cache.layer('s0', 'l', 1) is None)
+            self.assertFalse(cache.layer('s0', 'l', 0) is None)
+        self.assertRaises(KeyError, cache.peekTile, 's1', 0)
+
+    def testStackEvictionReleasesMemory( self ):
+        memory = TileCacheMemory(100*self.nbytes)
+        cache = _TilesCache('s0', self.sims, maxstacks=1, memory=memory)
+        with cache:
+            cache.updateTileIfNecessary('s0', 'l', 0, 1.0, QImage(self.img))
+            cache.addStack('s1')
+        self.assertEqual(memory.usedBytes(), 0)
+        self.assertEqual(len(memory), 0)
+
+    def testPrefetchedImagesAreEvictedFirst( self ):
+        memory = TileCacheMemory(3*self.nbytes)
+        cache = _TilesCache('s0', self.sims, memory=memory)
+        with cache:
+            cache.addStack('p1', prefetched=True)
+            cache.updateTileIfNecessary('p1', 'l', 0, 1.0, QImage(self.img))
+            cache.updateTileIfNecessary('s0', 'l', 0, 1.0, QImage(self.img))
+            cache.updateTileIfNecessary('s0', 'l', 1, 1.0, QImage(self.img))
+            self.assertEqual(memory.speculativeBytes(), self.nbytes)
+
+            # the prefetched image goes first, although it is not the
+            # least recently used one
+            cache.updateTileIfNecessary('s0', 'l', 2, 1.0, QImage(self.img))
+            self.assertTrue(cache.layer('p1', 'l', 0) is None)
+            self.assertFalse(cache.layer('s0', 'l', 0) is None)
+            self.assertEqual(memory.speculativeBytes(), 0)
+
+            # once visited, a prefetched stack is treated like any other
+            cache.updateTileIfNecessary('p1', 'l', 0, 2.0, QImage(self.img))
+            cache.touchStack('p1')
+            self.assertEqual(memory.speculativeBytes(), 0)
+            cache.updateTileIfNecessary('s0', 'l', 3, 1.0, QImage(self.img))
+            self.assertFalse(cache.layer('p1', 'l', 0) is None)
+        self.assertEqual(memory.usedBytes(), 3*self.nbytes)
+
+    def testPrefetchedImagesDoNotDisplaceViewedOnes( self ):
+        memory = TileCacheMemory(2*self.nbytes)
+        cache = _TilesCache('s0', self.sims, memory=memory)
+        with cache:
+            cache.addStack('p1', prefetched=True)
+            cache.updateTileIfNecessary('s0', 'l', 0, 1.0, QImage(self.img))
+            cache.updateTileIfNecessary('s0', 'l', 1, 1.0, QImage(self.img))
+            cache.updateTileIfNecessary('p1', 'l', 0, 1.0, QImage(self.img))
+            self.assertFalse(cache.layer('s0', 'l', 0) is None)
+            self.assertFalse(cache.layer('s0', 'l', 1) is None)
+            self.assertEqual(memory.usedBytes(), 3*self.nbytes)
+
+            # the next viewed image restores the budget
+            cache.updateTileIfNecessary('s0', 'l', 2, 1.0, QImage(self.img))
+            self.assertTrue(cache.layer('p1', 'l', 0) is None)
+            self.assertEqual(memory.usedBytes(), 2*self.nbytes)
+
+    def testUnvisitedStacksAreDroppedFirst( self ):
+        cache = _TilesCache('s0', self.sims, maxstacks=3,
+                            memory=TileCacheMemory(100*self.nbytes))
+        with cache:
+            cache.addStack('s1')
+            cache.addStack('p1', prefetched=True)
+            cache.addStack('p2', prefetched=True)
+            self.assertFalse('p1' in cache)
+            self.assertTrue('s0' in cache)
+            cache.touchStack('p2')
+            cache.addStack('s2')
+            self.assertFalse('s0' in cache)
+            self.assertTrue('p2' in cache)
+
+    def testDistanceStackPolicy( self ):
+        sources = object()
+        def stack(z, t=0):
+            return (sources, ((0, t), (1, z), (2, 0)))
+        cache = _TilesCache(stack(10), self.sims, maxstacks=4,
+                            memory=TileCacheMemory(100*self.nbytes),
+                            policy=DistanceStackPolicy())
+        with cache:
+            # sweep 10 -> 13 -> 9
+            for z in (11, 12, 13):
+                cache.addStack(stack(z))
+            cache.touchStack(stack(11))
+            cache.touchStack(stack(10))
+            cache.addStack(stack(9))
+            # 13 is farthest from 9, although 12 was used less recently
+            self.assertFalse(stack(13) in cache)
+            self.assertTrue(stack(12) in cache)
+
+            # frequently visited stacks count as closer
+            cache.touchStack(stack(12))
+            cache.touchStack(stack(10))
+            cache.touchStack(stack(12))
+            cache.touchStack(stack(9))
+            cache.addStack(stack(8))
+            self.assertTrue(stack(12) in cache)
+            self.assertFalse(stack(11) in cache)
+
+        # steps along each axis are weighted
+        policy = DistanceStackPolicy(weights=(10.0, 1.0, 1.0))
+        position = dict(stack(8)[1])
+        self.assertEqual(policy.distance(position, stack(8), stack(6, t=1)), 12.0)
+        self.assertEqual(policy.distance(position, stack(8), ('other', stack(8)[1])), float('inf'))
+
+    def testLRUStackPolicy( self ):
+        cache = _TilesCache('s0', self.sims, maxstacks=2,
+                            memory=TileCacheMemory(100*self.nbytes),
+                            policy=LRUStackPolicy())
+        with cache:
+            cache.addStack('s1')
+            cache.touchStack('s0')
+            cache.addStack('s2')
+            self.assertFalse('s1' in cache)
+            self.assertTrue('s0' in cache)
+
+class SystemMemoryTest( ut.TestCase ):
+    def setUp( self ):
+        self.tmpdir = tempfile.mkdtemp()
+        self.meminfo = os.path.join(self.tmpdir, 'meminfo')
+
+    def tearDown( self ):
+        shutil.rmtree(self.tmpdir)
+
+    def writeMeminfo( self, text ):
+        with open(self.meminfo, 'w') as f:
+            f.write(text)
+
+    def testUnderPressure( self ):
+        self.writeMeminfo('MemTotal:       1000 kB\nMemFree:          20 kB\n'
+                          'MemAvailable:     50 kB\nCached:          500 kB\n')
+        memory = SystemMemory(0.1, meminfo=self.meminfo)
+        self.assertAlmostEqual(memory.availableFraction(), 0.05)
+        self.assertTrue(memory.underPressure())
+
+    def testWithoutMemAvailable( self ):
+        self.writeMeminfo('MemTotal:       1000 kB\nMemFree:          20 kB\n'
+                          'Buffers:         80 kB\nCached:          300 kB\n')
+        memory = SystemMemory(0.1, meminfo=self.meminfo)
+        self.assertAlmostEqual(memory.availableFraction(), 0.4)
+        self.assertFalse(memory.underPressure())
+
+    def testNoMeminfo( self ):
+        memory = SystemMemory(0.1, meminfo=self.meminfo)
+        self.assertEqual(memory.availableFraction(), None)
+        self.assertFalse(memory.underPressure())
+
+
+class TilesCacheTest( ut.TestCase ):
+    def testLayerGenerations( self ):
+        sims = StackedImageSources( LayerStackModel() )
+        img = QImage(10, 10, QImage.Format_ARGB32_Premultiplied)
+        cache = _TilesCache('s0', sims, maxstacks=2,
+                            memory=TileCacheMemory(100*img.byteCount()))
+        with cache:
+            cache.addStack('s1')
+            for stack_id in ('s0', 's1'):
+                for tile_id in range(4):
+                    self.assertTrue(cache.layerDirty(stack_id, 'l', tile_id))
+                    cache.updateTileIfNecessary(stack_id, 'l', tile_id, 1.0, QImage(img))
+                    self.assertFalse(cache.layerDirty(stack_id, 'l', tile_id))
+                    self.assertTrue(cache.tileDirty(stack_id, tile_id))
+
+            cache.setLayerDirtyAllTiles('l')
+            for stack_id in ('s0', 's1'):
+                for tile_id in range(4):
+                    self.assertTrue(cache.layerDirty(stack_id, 'l', tile_id))
+                    self.assertFalse(cache.layer(stack_id, 'l', tile_id) is None)
+
+            # timestamps survive the invalidation: outdated results are rejected
+            cache.updateTileIfNecessary('s0', 'l', 0, 0.5, QImage(img))
+            self.assertTrue(cache.layerDirty('s0', 'l', 0))
+            cache.updateTileIfNecessary('s0', 'l', 0, 2.0, QImage(img))
+            self.assertFalse(cache.layerDirty('s0', 'l', 0))
+            self.assertEqual(cache.layerTimestamp('s0', 'l', 0), 2.0)
+
+            # state is kept for any layers and tiles
+            self.assertTrue(cache.layerDirty('s1', 'k', 10))
+            cache.setLayerDirty('s1', 'k', 10, False)
+            self.assertFalse(cache.layerDirty('s1', 'k', 10))
+            self.assertTrue(cache.layerDirty('s0', 'k', 10))
+            self.assertFalse(cache.layerDirty('s0', 'l', 0))
+
+            # stack eviction
+            cache.addStack('s2')
+            self.assertFalse('s0' in cache)
+            self.assertRaises(KeyError, cache.tileDirty, 's0', 0)
+
+            # a new stack holds no per tile state
+            stack = cache._stacks['s2']
+            self.assertEqual((stack.layerGeneration, stack.layerTimestamp, stack.cleanTiles),
+                             ({}, {}, set()))
+            self.assertTrue(cache.tileDirty('s2', 10**6))
+
+    def testLayerPreview( self ):
+        sims = StackedImageSources( LayerStackModel() )
+        img = QImage(10, 10, QImage.Format_ARGB32_Premultiplied)
+        preview, full = QImage(img), QImage(img)
+        cache = _TilesCache('s0', sims,
+                            memory=TileCacheMemory(100*img.byteCount()))
+        with cache:
+            cache.setTileDirty('s0', 0, False)
+            cache.setLayerPreview('s0', 'l', 0, preview)
+            self.assertTrue(cache.layer('s0', 'l', 0) is preview)
+            self.assertTrue(cache.layerDirty('s0', 'l', 0))
+            self.assertTrue(cache.tileDirty('s0', 0))
+            self.assertTrue((0, 0) in cache._stacks['s0'].layerPreview)
+
+            # the full resolution tile replaces the preview ...
+            cache.updateTileIfNecessary('s0', 'l', 0, 1.0, full)
+            self.assertTrue(cache.layer('s0', 'l', 0) is full)
+            self.assertFalse((0, 0) in cache._stacks['s0'].layerPreview)
+            # ... and is not replaced by a late preview
+            cache.setLayerPreview('s0', 'l', 0, preview)
+            self.assertTrue(cache.layer('s0', 'l', 0) is full)
+
+            cache.setLayerDirtyAllTiles('l')
+            cache.setLayerPreview('s0', 'l', 0, preview)
+            self.assertTrue((0, 0) in cache._stacks['s0'].layerPreview)
+            cache.setLayerDirtyAllTiles('l')
+            self.assertFalse((0, 0) in cache._stacks['s0'].layerPreview)
+
+    def testPartialUpdate( self ):
+        sims = StackedImageSources( LayerStackModel() )
+        # the image of a tile is the transpose of its data rectangle
+        tileRect = QRect(0, 0, 6, 4)
+        img = QImage(4, 6, QImage.Format_ARGB32_Premultiplied)
+        img.fill(0xff000000)
+        cache = _TilesCache('s0', sims,
+                            memory=TileCacheMemory(100*img.byteCount()))
+        def update( layer_id, timestamp, rect, patch ):
+            base, updated = cache.patchedLayer('s0', layer_id, 0, tileRect, rect, patch)
+            return cache.updateTileRectIfNecessary('s0', layer_id, 0, timestamp,
+                                                   rect, base, updated)
+        with cache:
+            cache.updateTileIfNecessary('s0', 'l', 0, 1.0, img)
+            cache.setLayerDirtyRectAllStacks('l', 0, QRect(2, 1, 2, 2))
+            cache.setLayerDirtyRectAllStacks('l', 0, QRect(3, 1, 2, 1))
+            self.assertTrue(cache.layerDirty('s0', 'l', 0))
+            self.assertEqual(cache.layerDirtyRect('s0', 'l', 0), QRect(2, 1, 3, 2))
+        # the dirty state can be read without claiming the cache
+        self.assertTrue(cache.peekLayerDirty('s0', 'l', 0))
+        self.assertEqual(cache.peekLayerDirtyRect('s0', 'l', 0), QRect(2, 1, 3, 2))
+        self.assertTrue(cache.peekLayerDirty('s0', 'unknown', 0))
+        self.assertTrue(cache.peekLayerDirtyRect('s0', 'unknown', 0) is None)
+
+        with cache:
+            patch = QImage(2, 3, QImage.Format_ARGB32_Premultiplied)
+            patch.fill(0xffffffff)
+            self.assertTrue(update('l', 2.0, QRect(2, 1, 3, 2), patch))
+            self.assertFalse(cache.layerDirty('s0', 'l', 0))
+            self.assertTrue(cache.layerDirtyRect('s0', 'l', 0) is None)
+            updated = cache.layer('s0', 'l', 0)
+            self.assertFalse(updated is img)
+            self.assertEqual(updated.pixel(1, 2), 0xffffffff)
+            self.assertEqual(updated.pixel(2, 4), 0xffffffff)
+            self.assertEqual(updated.pixel(0, 0), 0xff000000)
+            self.assertEqual(updated.pixel(3, 5), 0xff000000)
+            self.assertEqual(img.pixel(1, 2), 0xff000000)
+
+            # a patch not covering the dirty region leaves the tile dirty
+            cache.setLayerDirtyRectAllStacks('l', 0, QRect(0, 0, 2, 2))
+            self.assertTrue(update('l', 3.0, QRect(0, 0, 1, 1), QImage(1, 1, img.format())))
+            self.assertTrue(cache.layerDirty('s0', 'l', 0))
+
+            # a patch of an image replaced meanwhile is dropped
+            base, updated = cache.patchedLayer('s0', 'l', 0, tileRect,
+                                               QRect(0, 0, 2, 2), QImage(2, 2, img.format()))
+            cache.setLayer('s0', 'l', 0, QImage(img))
+            self.assertFalse(cache.updateTileRectIfNecessary('s0', 'l', 0, 3.5,
+                             QRect(0, 0, 2, 2), base, updated))
+            self.assertEqual(cache.layerDirtyRect('s0', 'l', 0), QRect(0, 0, 2, 2))
+
+            # the whole tile must be rendered after a full invalidation ...
+            cache.setLayerDirtyAllTiles('l')
+            self.assertTrue(cache.layerDirtyRect('s0', 'l', 0) is None)
+            self.assertFalse(update('l', 4.0, QRect(0, 0, 1, 1), QImage(1, 1, img.format())))
+            # ... and when there is no image to update
+            cache.setLayerDirtyRectAllStacks('k', 0, QRect(0, 0, 1, 1))
+            self.assertTrue(cache.layerDirty('s0', 'k', 0))
+            self.assertTrue(cache.layerDirtyRect('s0', 'k', 0) is None)
+
+            # an indexed image can't take an ARGB32 patch, so the whole
+            # tile is requested next
+            indexed = QImage(4, 6, QImage.Format_Indexed8)
+            indexed.setColorTable([0xff000000])
+            indexed.fill(0)
+            cache.updateTileIfNecessary('s0', 'm', 0, 1.0, indexed)
+            cache.setLayerDirtyRectAllStacks('m', 0, QRect(0, 0, 2, 2))
+            self.assertFalse(update('m', 2.0, QRect(0, 0, 2, 2), patch))
+            self.assertTrue(cache.layerDirty('s0', 'm', 0))
+            self.assertTrue(cache.layerDirtyRect('s0', 'm', 0) is None)
+
+    def testLayerPalette( self ):
+        sims = StackedImageSources( LayerStackModel() )
+        img = QImage(10, 10, QImage.Format_Indexed8)
+        img.setColorTable([0xff000000, 0xffff0000])
+        img.fill(1)
+        cache = _TilesCache('s0', sims, maxstacks=2,
+                            memory=TileCacheMemory(100*img.byteCount()))
+        with cache:
+            cache.addStack('s1')
+            for stack_id in ('s0', 's1'):
+                cache.updateTileIfNecessary(stack_id, 'l', 0, 1.0, QImage(img))
+                cache.setTileDirty(stack_id, 0, False)
+            nbytes = cache._nbytes
+
+            # the palette is recorded, each stack is recolored on its own
+            cache.setLayerPalette('l', [0xff000000, 0xff00ff00])
+            self.assertEqual(cache.layer('s0', 'l', 0).pixel(3, 3), 0xffff0000)
+            self.assertFalse(cache.tileDirty('s0', 0))
+            for stack_id in ('s0', 's1'):
+                stale, allIndexed = cache.staleLayers(stack_id)
+                self.assertTrue(allIndexed)
+                self.assertEqual(len(stale), 1)
+                cache.replaceLayers(stack_id, _recolored(stale))
+                recolored = cache.layer(stack_id, 'l', 0)
+                self.assertEqual(recolored.format(), QImage.Format_Indexed8)
+                self.assertEqual(recolored.pixel(3, 3), 0xff00ff00)
+                self.assertFalse(cache.layerDirty(stack_id, 'l', 0))
+                self.assertTrue(cache.tileDirty(stack_id, 0))
+            self.assertEqual(cache._nbytes, nbytes)
+            self.assertEqual(cache.staleLayers('s0'), ([], True))
+
+            # images in other formats must be rendered anew
+            cache.updateTileIfNecessary('s1', 'l', 0, 2.0,
+                                        QImage(10, 10, QImage.Format_ARGB32_Premultiplied))
+            cache.setLayerPalette('l', [0xff000000, 0xff0000ff])
+            self.assertFalse(cache.layerDirty('s1', 'l', 0))
+            self.assertEqual(cache.staleLayers('s1'), ([], False))
+            self.assertTrue(cache.layerDirty('s1', 'l', 0))
+
+            # a recolored copy of an image replaced meanwhile is dropped
+            stale, allIndexed = cache.staleLayers('s0')
+            cache.updateTileIfNecessary('s0', 'l', 0, 2.0, QImage(img))
+            cache.replaceLayers('s0', _recolored(stale))
+            self.assertEqual(cache.layer('s0', 'l', 0).pixel(3, 3), 0xffff0000)
+
+    def testLayerImage( self ):
+        class Palette(object):
+            def palette(self):
+                return [0xff000000, 0xff00ff00]
+        indexed = QImage(5, 3, QImage.Format_Indexed8)
+        indexed.setColorTable([0xff000000, 0xffff0000])
+        indexed.fill(1)
+
+        # tiles are cached as rendered, with the current palette
+        img = _layerImage(Palette(), indexed, QTransform())
+        self.assertTrue(img is indexed)
+        self.assertEqual(img.pixel(0, 0), 0xff00ff00)
+
+        # previews are scaled up
+        img = _layerImage(Palette(), QImage(indexed), QTransform.fromScale(2, 2))
+        self.assertEqual(img.size(), QSize(10, 6))
+        self.assertEqual(img.format(), QImage.Format_Indexed8)
+
+
+class RenderTaskCancellationTest( ut.TestCase ):
+    def setUp( self ):
+        self.sims = StackedImageSources( LayerStackModel() )
+        self.tp = TileProvider(Tiling((100,100), blockSize=50), self.sims)
+
+    def _task( self, prefetch, timestamp, tile_nr=0, ims=None, generation=None ):
+        stack_id = self.tp._current_stack_id
+        return RenderTask(Future(), prefetch, timestamp, self.tp, ims,
+                          QTransform(), tile_nr, stack_id, None, self.tp._cache,
+                          generation)
+
+    def testPriority( self ):
+        regular, prefetch = self._task(False, 1.0), self._task(True, 2.0)
+        self.assertTrue(regular < prefetch)
+        self.assertFalse(prefetch < regular)
+        older, newer = self._task(False, 1.0), self._task(False, 2.0)
+        self.assertTrue(newer < older)
+        self.assertFalse(older < newer)
+
+    def testStackChangeCancelsStaleTasks( self ):
+        regular = self._task(False, 1.0)
+        self.sims.stackId = ('other', ())
+        self.assertTrue(regular.future.cancelled())
+        self.assertEqual(len(self.tp._tasks), 0)
+
+    def testQueueSizeIsBounded( self ):
+        self.tp._request_queue_size = 2
+        older, newer = self._task(False, 1.0, 0), self._task(False, 2.0, 1)
+        # regular tasks are not displaced by prefetching
+        self.assertFalse(self.tp._makeRoomForTask(prefetch=True))
+        self.assertEqual(len(self.tp._tasks), 2)
+        # but the oldest one makes room for a new regular task
+        self.assertTrue(self.tp._makeRoomForTask(prefetch=False))
+        self.assertTrue(older.future.cancelled())
+        self.assertFalse(newer.future.cancelled())
+        self.assertEqual(len(self.tp._tasks), 1)
+
+    def testInFlightDeduplication( self ):
+        ims = QObject()
+        generation = self.tp._dataGeneration(ims, 0)
+        task = self._task(False, 1.0, 0, ims, generation)
+        self.assertTrue(self.tp._isInFlight(task.key, prefetch=False))
+        self.assertTrue(self.tp._isInFlight(task.key, prefetch=True))
+
+        # once the data becomes dirty, the tile is requested anew
+        self.tp._bumpDataGeneration(ims, 0)
+        key = task.key[:3] + (self.tp._dataGeneration(ims, 0),) + task.key[4:]
+        self.assertFalse(self.tp._isInFlight(key, prefetch=False))
+        self.tp._bumpDataGeneration(ims)
+        self.assertNotEqual(self.tp._dataGeneration(ims, 0), key[3])
+
+        # a queued prefetch task is replaced when the tile must be shown
+        prefetch = self._task(True, 1.0, 1, ims, generation)
+        self.assertFalse(self.tp._isInFlight(prefetch.key, prefetch=False))
+        self.assertTrue(prefetch.future.cancelled())
+
+    def testResizeDuringRender( self ):
+        ims = QObject()
+        generation = self.tp._dataGeneration(ims, 0)
+        task = self._task(False, 1.0, 0, ims, generation)
+        self.assertTrue(task.future.set_running_or_notify_cancel())
+        self.assertTrue(self.tp._isInFlight(task.key, prefetch=False))
+
+        # the running task renders into the old cache, so the tile must be
+        # requested again for the new one
+        self.tp._onSizeChanged()
+        self.assertFalse(task.future.cancelled())
+        self.assertFalse(self.tp._isInFlight(task.key, prefetch=False))
+
+    def testPrefetchTaskCount( self ):
+        prefetch = self._task(True, 1.0, 0)
+        self._task(True, 1.0, 1)
+        self._task(False, 1.0, 2)
+        self.assertEqual(self.tp._prefetchTasks, 2)
+        self.assertTrue(prefetch.cancel())
+        self.assertEqual(self.tp._prefetchTasks, 1)
+
+        # no prefetching if the pending tiles would not fit into the cache
+        self.tp._cache._memory = TileCacheMemory(4 * 50**2)
+        self.assertFalse(self.tp._prefetchAllowed())
+
+
+class _TimedLayer( object ):
+    def __init__( self, seconds ):
+        self.averageTimePerTile = seconds
+
+class _QueuedTask( object ):
+    def __init__( self, seconds=0.0 ):
+        self.future = Future()
+        self.ims = QObject()
+        self.ims._layer = _TimedLayer(seconds)
+
+class RenderTaskExecutorTest( ut.TestCase ):
+    def testSuggestedWorkers( self ):
+        pool = RenderTaskExecutor(2, autosize=True, min_workers=1, max_auto_workers=8)
+        # no resizing before the first measurement
+        self.assertEqual(pool.suggestedWorkers(), None)
+        self.assertEqual(pool.tilesPerSecond(), None)
+        pool.recordTaskTime(0.1)
+        self.assertAlmostEqual(pool.tilesPerSecond(), 20.0)
+        self.assertEqual(pool.suggestedWorkers(), 1)
+
+        tasks = [_QueuedTask() for i in range(100)]
+        for task in tasks:
+            pool._taskQueued(task)
+        self.assertEqual(pool.suggestedWorkers(), 8)
+        pool._timePerTask = 0.01
+        self.assertEqual(pool.suggestedWorkers(), 4)
+
+        # cancelled and finished tasks are no backlog
+        for task in tasks[:25]:
+            task.future.cancel()
+        for task in tasks[25:50]:
+            task.future.set_running_or_notify_cancel()
+            task.future.set_result(None)
+        self.assertEqual(pool.queuedTasks(), 50)
+        self.assertEqual(pool.suggestedWorkers(), 2)
+
+        # the time per tile of a timed layer is used instead of the average
+        for i in range(10):
+            pool._taskQueued(_QueuedTask(0.05))
+        self.assertEqual(pool.queuedTasks(), 60)
+        self.assertEqual(pool.suggestedWorkers(), 4)
+
+    def testResize( self ):
+        pool = RenderTaskExecutor(2, autosize=True)
+        pool.resize(3)
+        self.assertFalse(pool.autosize)
+        self.assertEqual(pool.maxWorkers(), 3)
+        pool.resize(None)
+        self.assertTrue(pool.autosize)
+        pool.shutdown()
+
+
+class _RecordingSource( ConstantSource ):
+    '''Records the number of pixels read per request.'''
+    def __init__( self, constant, strided ):
+        super(_RecordingSource, self).__init__(constant)
+        self.strided = strided
+        self.pixels = []
+
+    def supportsStridedReads( self ):
+        return self.strided
+
+    def request( self, slicing, through=None ):
+        self.pixels.append(np.prod(slicing2shape(slicing)))
+        return super(_RecordingSource, self).request(slicing, through)
 
 class TileProviderTest( ut.TestCase ):
     def setUp( self ):
@@ -134,6 +768,114 @@ class TileProviderTest( ut.TestCase ):
             self.assertTrue(np.all(aimg[:,:,0:3] == self.GRAY2))
             self.assertTrue(np.all(aimg[:,:,3] == 255))
 
+    def testIncrementalCompositing( self ):
+        tiling = Tiling((900,400), blockSize=100)
+        tp = TileProvider(tiling, self.sims)
+        rect = QRectF(100,100,200,200)
+        tile_no = tiling.intersected(rect)[0]
+        self.layer3.opacity = 0.5
+        for opacity in (0.1, 0.6, 0.9):
+            self.layer2.opacity = opacity
+            tp.requestRefresh(rect)
+            tp.waitForTiles(rect)
+            self.assertTrue(tp._splitLayer is self.ims2)
+            self.assertTrue(tile_no in tp._splitTiles)
+
+            stack_id = tp._current_stack_id
+            incremental = byte_view(tp._renderTile(stack_id, tile_no)).astype(int)
+            tp._setSplitLayer(None)
+            full = byte_view(tp._renderTile(stack_id, tile_no)).astype(int)
+            tp._setSplitLayer(self.ims2)
+            self.assertTrue(np.abs(incremental - full).max() <= 1)
+
+    def testSplitCompositesCountAgainstBudget( self ):
+        tiling = Tiling((900,400), blockSize=100)
+        tp = TileProvider(tiling, self.sims)
+        rect = QRectF(100,100,200,200)
+        tile_no = tiling.intersected(rect)[0]
+        memory = get_tile_cache_memory()
+        entry = (tp._splitRef, tile_no)
+        self.layer2.opacity = 0.6
+        tp.requestRefresh(rect)
+        tp.waitForTiles(rect)
+        partials = tp._splitTiles[tile_no]
+        self.assertTrue(entry in memory._entries)
+
+        # partials evicted from the budget are composited anew
+        tp.evictLater(tile_no)
+        tp._renderTile(tp._current_stack_id, tile_no)
+        self.assertFalse(tp._splitTiles[tile_no] is partials)
+
+        tp._onOrderChanged()
+        self.assertEqual(tp._splitTiles, {})
+        self.assertFalse(entry in memory._entries)
+
+    def testDirectLayerFrameBudget( self ):
+        self.layer3.name = 'direct'
+        self.ims3.direct = True
+        tiling = Tiling((900,400), blockSize=100)
+        tp = TileProvider(tiling, self.sims)
+        rect = QRectF(100,100,200,200)
+        deferred = lambda: get_metrics().counter('direct_tiles_deferred', 'direct')
+
+        # within the budget, direct tiles are rendered synchronously
+        tp._frameBudget = 60.0
+        before = deferred()
+        tp.requestRefresh(rect)
+        self.assertEqual(deferred(), before)
+        with tp._cache:
+            for tile_no in tiling.intersected(rect):
+                self.assertFalse(tp._cache.layerDirty(tp._current_stack_id, self.ims3, tile_no))
+        tp.waitForTiles(rect)
+
+        # otherwise they are handed to the render pool
+        self.sims.stackId = ('other', ())
+        tp._frameBudget = 0.0
+        self.layer3.averageTimePerTile = 0.01
+        tp.requestRefresh(rect)
+        self.assertEqual(deferred(), before + len(tiling.intersected(rect)))
+        tp.waitForTiles(rect)
+        self.assertTrue(tp._frameDeadline is None)
+
+    def testPreviewReadsLessData( self ):
+        tiling = Tiling((900,400), blockSize=100)
+        rect = QRectF(10,10,50,50)
+        for strided in (True, False):
+            ds = _RecordingSource(self.GRAY3, strided)
+            layer = GrayscaleLayer( ds, normalize = False )
+            layer.averageTimePerTile = 10.0
+            lsm = LayerStackModel()
+            lsm.append(layer)
+            sims = StackedImageSources( lsm )
+            sims.register( layer, GrayscaleImageSource( ds, layer ) )
+            tp = TileProvider(tiling, sims)
+            tp._previewLevels = 2
+            tp.requestRefresh(rect)
+            tp.waitForTiles(rect)
+            if strided:
+                # the full resolution tile and a preview of 1/16 the pixels
+                self.assertEqual(sorted(ds.pixels), [100*100/16, 100*100])
+            else:
+                # a preview would cost as much as the tile itself
+                self.assertEqual(ds.pixels, [100*100])
+
+    def testAppearanceChangeInvalidatesOtherStacksLazily( self ):
+        tiling = Tiling((900,400), blockSize=100)
+        tp = TileProvider(tiling, self.sims)
+        rect = QRectF(100,100,200,200)
+        tile_no = tiling.intersected(rect)[0]
+        tp.requestRefresh(rect)
+        tp.waitForTiles(rect)
+        first = tp._current_stack_id
+
+        self.sims.stackId = ('other', ())
+        self.layer3.opacity = 0.5
+        with tp._cache:
+            self.assertFalse(tp._cache.tileDirty(first, tile_no))
+        self.sims.stackId = first
+        with tp._cache:
+            self.assertTrue(tp._cache.tileDirty(first, tile_no))
+
 
 class DirtyPropagationTest( ut.TestCase ):
 
@@ -153,6 +895,23 @@ class DirtyPropagationTest( ut.TestCase ):
         self.lsm = LayerStackModel()
         self.pump = ImagePump( self.lsm, SliceProjection(), sync_along=(0,1,2) )
 
+    def testDownsampledLevel( self ):
+        data = (np.indices((1, 900, 400, 1, 1))[1] % 256).astype(np.uint8)
+        layer = GrayscaleLayer( ArraySource(data), normalize=False )
+        self.lsm.append(layer)
+        tiling = Tiling((900,400), blockSize=100, level=1)
+        tp = TileProvider(tiling, self.pump.stackedImageSources)
+
+        tp.requestRefresh(QRectF(0,0,200,200))
+        tp.waitForTiles(QRectF(0,0,200,200))
+        tiles = list(tp.getTiles(QRectF(0,0,200,200)))
+        self.assertEqual(len(tiles), 1)
+        aimg = byte_view(tiles[0].qimg)
+        self.assertEqual(aimg.shape[:2], (100, 100))
+        # tiles are cached in data orientation, so image row i shows data
+        # x = 2*i at level 1
+        self.assertTrue(np.all(aimg[:,:,0] == 2*np.arange(100)[:,np.newaxis]))
+
     def testEverythingDirtyPropagation( self ):
         self.lsm.append(self.layer2)
         tiling = Tiling((900,400), blockSize=100)
@@ -25,6 +25,20 @@ import io, os
 default_config = """
 [pixelpipeline]
 verbose: false
+tile_cache_megabytes: 1024
+render_threads: 0
+metrics: true
+progressive_threshold_ms: 1000
+progressive_levels: 2
+direct_frame_budget_ms: 30
+prefetch_cache_percent: 25
+prefetch_min_available_percent: 10
+stack_eviction: distance
+disk_cache_directory:
+disk_cache_megabytes: 4096
+shared_cache_megabytes: 256
+image_pool_megabytes: 64
+raw_cache_megabytes: 128
 """
 
 cfg = ConfigParser.SafeConfigParser()
@@ -26,12 +26,45 @@ from PyQt4.QtGui import QGraphicsScene, QTransform, QPen, QColor, QBrush, QPolyg
                         QGraphicsItemGroup, QGraphicsLineItem, QGraphicsTextItem, QGraphicsPolygonItem, \
                         QGraphicsRectItem
 
-from volumina.tiling import Tiling, TileProvider, TiledImageLayer
+from volumina.tiling import Tiling, TileProvider, TiledImageLayer, get_render_pool
 from volumina.layerstack import LayerStackModel
 from volumina.pixelpipeline.imagepump import StackedImageSources
 
 import datetime
 import threading
+import time
+
+#*******************************************************************************
+# S c r o l l V e l o c i t y                                                  *
+#*******************************************************************************
+class ScrollVelocity(object):
+    """
+    Smoothed speed (in slices per second) at which the user moves along an
+    axis, estimated from the times of the position changes. The speed is
+    zero after the position did not change for IDLE seconds.
+    """
+    SMOOTHING = 0.5
+    IDLE = 1.0
+
+    def __init__(self):
+        self._last = None
+        self._speed = 0.0
+
+    def update(self, steps, now=None):
+        now = time.time() if now is None else now
+        if self._last is not None and now - self._last < self.IDLE:
+            speed = abs(steps) / max(now - self._last, 1e-3)
+            self._speed += self.SMOOTHING * (speed - self._speed)
+        else:
+            # first move after a pause: the speed is not known yet
+            self._speed = 0.0
+        self._last = now
+
+    def speed(self, now=None):
+        now = time.time() if now is None else now
+        if self._last is None or now - self._last >= self.IDLE:
+            return 0.0
+        return self._speed
 
 #*******************************************************************************
 # D i r t y I n d i c a t o r                                                  *
@@ -188,8 +221,6 @@ class ImageScene2D(QGraphicsScene):
         t3 = QTransform.fromTranslate(*trans)
 
         self.data2scene = t1 * t2 * t3
-        if self._tileProvider:
-            self._tileProvider.axesSwapped = self._swapped
         self.axesChanged.emit(self._rotation, self._swapped)
 
     def rot90(self, transform, rect, direction):
@@ -217,8 +248,10 @@ class ImageScene2D(QGraphicsScene):
     def _finishViewMatrixChange(self):
         self.scene2data, isInvertible = self.data2scene.inverted()
         self._setSceneRect()
-        self._tiling.data2scene = self.data2scene
-        self._tileProvider._onSizeChanged()
+        # the cached tiles do not depend on the orientation of the view,
+        # they are merely painted differently (see Tiling.imageTransform)
+        for tileProvider in self._tileProviders():
+            tileProvider.tiling.data2scene = self.data2scene
         QGraphicsScene.invalidate(self, self.sceneRect())
 
     @property
@@ -263,13 +296,63 @@ class ImageScene2D(QGraphicsScene):
         if cache_size != self._tileProvider._cache_size:
             self._tileProvider = TileProvider(self._tiling, self._stackedImageSources, cache_size=cache_size)
             self._tileProvider.sceneRectChanged.connect(self.invalidateViewports)
+            self._lodTileProviders = {}
 
     def cacheSize(self):
         return self._tileProvider._cache_size
 
+    def setBlockSize(self, blockSize):
+        """
+        Use tiles of blockSize x blockSize pixels. If blockSize is None,
+        the tile size is chosen from the slice shape, the chunk shapes of
+        the data sources and the measured rendering time of the layers
+        (see Tiling.suggestedBlockSize) whenever the scene is reset.
+        """
+        self._blockSize = blockSize
+        self.reset()
+        self._finishViewMatrixChange()
+
+    def blockSize(self):
+        return self._tiling.blockSize
+
+    def _suggestedBlockSize(self):
+        if self._blockSize is not None:
+            return self._blockSize
+        if self._tiling is not None:
+            current = self._tiling.blockSize
+        else:
+            current = 256
+        # chunk shapes in slice coordinates, i.e. without the along axes
+        axes = [i for i in xrange(5) if i not in self._along]
+        chunkShapes = []
+        timePerTile = 0.0
+        for layer in self._stackedImageSources.getRegisteredLayers():
+            for datasource in filter(None, layer.datasources):
+                chunkShape = getattr(datasource, 'chunkShape', lambda: None)()
+                if chunkShape is not None and len(chunkShape) == 5:
+                    chunkShapes.append(tuple(chunkShape[i] for i in axes))
+            timePerTile = max(timePerTile, layer.averageTimePerTile)
+        return Tiling.suggestedBlockSize(self._dataShape, chunkShapes,
+                                         timePerTile or None, current)
+
     def setPrefetchingEnabled(self, enable):
         self._prefetching_enabled = enable
 
+    def setLevelOfDetailEnabled(self, enable):
+        """
+        If enabled (the default), zoomed out views are drawn from
+        downsampled tiles of a coarser pyramid level (see Tiling), so that
+        the amount of requested data is bounded by the screen resolution.
+        Views showing a layer which cannot read downsampled data cheaply
+        (see ImageSource.supportsStridedReads) are always drawn at full
+        resolution.
+        """
+        self._lod_enabled = enable
+        self.invalidate()
+
+    def levelOfDetailEnabled(self):
+        return self._lod_enabled
+
     def setPreemptiveFetchNumber(self, n):
         if n > self.cacheSize() - 1:
             self._n_preemptive = self.cacheSize() - 1
@@ -291,11 +374,14 @@ class ImageScene2D(QGraphicsScene):
         """
         self.resetAxes(finish=False)
 
-        self._tiling = Tiling(self._dataShape, self.data2scene, name=self.name)
+        self._tiling = Tiling(self._dataShape, self.data2scene,
+                              blockSize=self._suggestedBlockSize(), name=self.name)
         self._brushingLayer  = TiledImageLayer(self._tiling)
 
         self._tileProvider = TileProvider(self._tiling, self._stackedImageSources)
         self._tileProvider.sceneRectChanged.connect(self.invalidateViewports)
+        # tile providers for pyramid levels > 0, created on demand
+        self._lodTileProviders = {}
 
         if self._dirtyIndicator:
             self.removeItem(self._dirtyIndicator)
@@ -307,10 +393,12 @@ class ImageScene2D(QGraphicsScene):
 
     def __init__(self, posModel, along, preemptive_fetch_number=5,
                  parent=None, name="Unnamed Scene",
-                 swapped_default=False):
+                 swapped_default=False, blockSize=None):
         """
         * preemptive_fetch_number -- number of prefetched slices; 0 turns the feature off
         * swapped_default -- whether axes should be swapped by default.
+        * blockSize -- tile size; by default it is chosen whenever the scene is reset,
+                       see setBlockSize()
 
         """
         QGraphicsScene.__init__(self, parent=parent)
@@ -335,9 +423,13 @@ class ImageScene2D(QGraphicsScene):
         #        If we could fix their timing, maybe it would be worth it.
         self._showTileProgress = False
 
+        self._tiling = None
+        self._blockSize = blockSize
         self._tileProvider = None
+        self._lodTileProviders = {}
         self._dirtyIndicator = None
         self._prefetching_enabled = False
+        self._lod_enabled = True
         
         self._swappedDefault = swapped_default
         self.reset()
@@ -345,6 +437,7 @@ class ImageScene2D(QGraphicsScene):
         # BowWave preemptive caching
         self.setPreemptiveFetchNumber(preemptive_fetch_number)
         self._course = (1,1) # (along, pos or neg direction)
+        self._velocity = [ScrollVelocity() for i in xrange(3)] # per along axis
         self._time = self._posModel.time
         self._channel = self._posModel.channel
         self._posModel.timeChanged.connect(self._onTimeChanged)
@@ -391,23 +484,55 @@ class ImageScene2D(QGraphicsScene):
         if self._showTileProgress:
             self._dirtyIndicator.setVisible(settled)
 
+    def _tileProviders(self):
+        return [self._tileProvider] + self._lodTileProviders.values()
+
+    def _tileProviderForLevel(self, level):
+        if level == 0:
+            return self._tileProvider
+        if level not in self._lodTileProviders:
+            tiling = Tiling(self._dataShape, self.data2scene, blockSize=self._tiling.blockSize,
+                            name="%s (level %d)" % (self.name, level), level=level)
+            tileProvider = TileProvider(tiling, self._stackedImageSources,
+                                        cache_size=self._tileProvider._cache_size)
+            tileProvider.sceneRectChanged.connect(self.invalidateViewports)
+            self._lodTileProviders[level] = tileProvider
+        return self._lodTileProviders[level]
+
+    def _stridedReadsSupported(self):
+        return all(ims.supportsStridedReads()
+                   for visible, opacity, ims in self._stackedImageSources if visible)
+
+    def _levelOfDetail(self, painter):
+        if not self._lod_enabled or not self._stridedReadsSupported():
+            return 0
+        # scale of the world transform, independent of rotations
+        scale = math.sqrt(abs(painter.worldTransform().determinant()))
+        return Tiling.levelForScale(scale, self._dataShape, self._tiling.blockSize)
+
     def drawBackground(self, painter, sceneRectF):
         if self._tileProvider is None:
             return
 
-        tiles = self._tileProvider.getTiles(sceneRectF)
+        level = self._levelOfDetail(painter)
+        tileProvider = self._tileProviderForLevel(level)
+        tiles = tileProvider.getTiles(sceneRectF)
         allComplete = True
+        sceneTransform = painter.worldTransform()
         for tile in tiles:
             #We always draw the tile, even though it might not be up-to-date
             #In ilastik's live mode, the user sees the old result while adding
             #new brush strokes on top
             #See also ilastik issue #132 and tests/lazy_test.py
             if tile.qimg is not None:
-                painter.drawImage(tile.rectF, tile.qimg)
+                # the tile is transposed, rotated and scaled while painting
+                painter.setWorldTransform(tile.transform * sceneTransform)
+                painter.drawImage(0, 0, tile.qimg)
             if tile.progress < 1.0:
                 allComplete = False
-            if self._showTileProgress:
+            if self._showTileProgress and level == 0:
                 self._dirtyIndicator.setTileProgress(tile.id, tile.progress)
+        painter.setWorldTransform(sceneTransform)
 
         if allComplete:
             if self.dirty:
@@ -422,8 +547,12 @@ class ImageScene2D(QGraphicsScene):
 
         # preemptive fetching
         if self._prefetching_enabled:
-            for through in self._bowWave(self._n_preemptive):
-                self._tileProvider.prefetch(sceneRectF, through)
+            visibleLayers = sum(1 for visible in self._stackedImageSources.viewVisible() if visible)
+            tilesPerSlice = len(tileProvider.tiling.intersected(sceneRectF)) * max(1, visibleLayers)
+            # prefetch tasks submitted later are rendered first (see
+            # RenderTask.__lt__), so the most urgent slices are submitted last
+            for through in reversed(self._bowWave(self._n_preemptive, tilesPerSlice)):
+                tileProvider.prefetch(sceneRectF, through)
 
     def joinRenderingAllTiles(self, viewport_only=True):
         """
@@ -443,34 +572,76 @@ class ImageScene2D(QGraphicsScene):
             self._allTilesCompleteEvent.wait()
 
 
-    def _bowWave(self, n):
+    # seconds of scrolling the prefetched slices should cover
+    PREFETCH_HORIZON = 1.0
+    # number of slices prefetched behind the current one
+    PREFETCH_HALO = 1
+
+    def _bowWave(self, n, tilesPerSlice=None):
+        '''Through values of the slices to prefetch, most urgent first.
+
+        At rest, the n slices ahead along the last moved axis are
+        prefetched. While scrolling, the lookahead grows to the slices
+        reached within PREFETCH_HORIZON seconds, but is limited to the
+        number of slices (of tilesPerSlice tiles each) the render pool can
+        render in that time, starting beyond the slices the user reaches
+        before the pool could finish them. These are followed by
+        PREFETCH_HALO slices behind the current one and the neighboring
+        time steps. At most cacheSize()-1 slices are returned.
+
+        '''
+        if n <= 0:
+            return []
         shape5d = self._posModel.shape5D
         sl5d = self._posModel.slicingPos5D
         through = [sl5d[self._along[i]] for i in xrange(3)]
         t_max = [shape5d[self._along[i]] for i in xrange(3)]
+        a, direction = self._course
+
+        first, last = 1, n
+        speed = self._velocity[a].speed()
+        if speed > 0:
+            last = max(n, int(math.ceil(speed * self.PREFETCH_HORIZON)))
+            tilesPerSecond = get_render_pool().tilesPerSecond()
+            if tilesPerSecond is not None and tilesPerSlice:
+                slicesPerSecond = tilesPerSecond / float(tilesPerSlice)
+                first = max(1, int(speed / slicesPerSecond))
+                affordable = max(1, int(slicesPerSecond * self.PREFETCH_HORIZON))
+                last = min(last, first + affordable - 1)
 
         BowWave = []
-
-        a = self._course[0]
-        for d in xrange(1,n+1):
-            m = through[a] + d * self._course[1]
-            if m < t_max[a] and m >= 0:
+        def add(axis, m):
+            if 0 <= m < t_max[axis]:
                 t = list(through)
-                t[a] = m
-                BowWave.append(tuple(t))
-        return BowWave
+                t[axis] = m
+                t = tuple(t)
+                if t not in BowWave:
+                    BowWave.append(t)
+
+        for d in xrange(first, last+1):
+            add(a, through[a] + d * direction)
+        for d in xrange(1, self.PREFETCH_HALO+1):
+            add(a, through[a] - d * direction)
+        if a != 0:
+            add(0, through[0] + 1)
+            add(0, through[0] - 1)
+        return BowWave[:max(0, self.cacheSize() - 1)]
 
     def _onSlicingPositionChanged(self, new, old):
-        if (new[self._along[1] - 1] - old[self._along[1] - 1]) < 0:
+        steps = new[self._along[1] - 1] - old[self._along[1] - 1]
+        if steps < 0:
             self._course = (1, -1)
         else:
             self._course = (1, 1)
+        if steps != 0:
+            self._velocity[1].update(steps)
 
     def _onChannelChanged(self, new):
         if (new - self._channel) < 0:
             self._course = (2, -1)
         else:
             self._course = (2, 1)
+        self._velocity[2].update(new - self._channel)
         self._channel = new
 
     def _onTimeChanged(self, new):
@@ -478,4 +649,5 @@ class ImageScene2D(QGraphicsScene):
             self._course = (0, -1)
         else:
             self._course = (0, 1)
+        self._velocity[0].update(new - self._time)
         self._time = new
@@ -189,11 +189,10 @@ class Layer( QObject ):
         for datasource in filter(None, self._datasources):
             datasource.numberOfChannelsChanged.connect( self._updateNumberOfChannels )
 
-        if self.direct:
-            #in direct mode, we calculate the average time per tile for debug purposes
-            #this is useful to identify which of your layers cause slowness
-            self.averageTimePerTile = 0.0
-            self._numTiles = 0
+        #we calculate the average time per tile for debug purposes
+        #this is useful to identify which of your layers cause slowness
+        self.averageTimePerTile = 0.0
+        self._numTiles = 0
 
         self.visibleChanged.connect(self.changed)
         self.opacityChanged.connect(self.changed)
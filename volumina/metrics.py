@@ -0,0 +1,246 @@
+###############################################################################
+#   volumina: volume slicing and editing library
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the Lesser GNU General Public License
+# as published by the Free Software Foundation; either version 2.1
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# See the files LICENSE.lgpl2 and LICENSE.lgpl3 for full text of the
+# GNU Lesser General Public License version 2.1 and 3 respectively.
+# This information is also available on the ilastik web site at:
+#		   http://ilastik.org/license/
+###############################################################################
+"""
+Counters and latency histograms of the pixel pipeline.
+
+Measurements are keyed by a name (the pipeline stage, e.g. 'transform')
+and a label, which is the name of the layer the measurement belongs to.
+The label of the layer that is currently rendered by a thread is set
+with labelled(), such that code deep down in the pipeline (e.g. the image
+requests) can record measurements without knowing about layers:
+
+    with labelled(layer.name):
+        img = request.wait()
+
+Use get_metrics().snapshot() to query the registry from Python, or
+get_metrics().dump(path) to write it to a JSON file.
+"""
+import bisect
+import json
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+from volumina.config import cfg
+
+#: Stages of the pixel pipeline for which latencies are recorded
+DATASOURCE_WAIT = 'datasource_wait'   # waiting for the array request
+TO_QIMAGE = 'to_qimage'               # converting the array to a QImage
+TRANSFORM = 'transform'               # QImage.transformed
+COMPOSITE = 'composite'               # blending the layer tiles
+QUEUE_WAIT = 'queue_wait'             # render task waiting for a worker
+
+#: Label of measurements that belong to no particular layer
+UNLABELLED = ''
+
+#*******************************************************************************
+# H i s t o g r a m                                                            *
+#*******************************************************************************
+
+class Histogram(object):
+    """
+    Latency histogram with logarithmically spaced buckets.
+
+    Bucket boundaries grow by a factor of 2**(1/4), so percentiles are
+    accurate to about 10% between 1 microsecond and a couple of minutes,
+    using constant memory regardless of the number of samples.
+    """
+    MIN = 1e-6
+    GROWTH = 2 ** 0.25
+    NBUCKETS = 112
+    BOUNDS = [MIN * GROWTH ** i for i in range(NBUCKETS)]
+
+    def __init__(self):
+        self.counts = [0] * (self.NBUCKETS + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def record(self, seconds):
+        self.counts[bisect.bisect_left(self.BOUNDS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if self.min is None or seconds < self.min:
+            self.min = seconds
+        if self.max is None or seconds > self.max:
+            self.max = seconds
+
+    def mean(self):
+        if not self.count:
+            return None
+        return self.total / self.count
+
+    def percentile(self, p):
+        '''Latency in seconds below which p percent of the samples fall,
+        or None if nothing was recorded.'''
+        if not self.count:
+            return None
+        rank = max(1, int(math.ceil(p / 100.0 * self.count)))
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank:
+                break
+        # report the geometric center of the bucket, clamped to the
+        # observed range
+        if i == 0:
+            value = self.min
+        elif i == self.NBUCKETS:
+            value = self.max
+        else:
+            value = math.sqrt(self.BOUNDS[i - 1] * self.BOUNDS[i])
+        return min(max(value, self.min), self.max)
+
+    def toDict(self):
+        return {'count': self.count,
+                'total': self.total,
+                'mean': self.mean(),
+                'min': self.min,
+                'max': self.max,
+                'p50': self.percentile(50),
+                'p95': self.percentile(95),
+                'p99': self.percentile(99)}
+
+#*******************************************************************************
+# M e t r i c s R e g i s t r y                                                *
+#*******************************************************************************
+
+class MetricsRegistry(object):
+    """
+    Thread-safe registry of counters and latency histograms, each keyed
+    by (name, label).
+    """
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+
+    def increment(self, name, label=None, n=1):
+        if not self.enabled:
+            return
+        key = (name, _label(label))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + n
+
+    def record(self, name, seconds, label=None):
+        if not self.enabled:
+            return
+        key = (name, _label(label))
+        with self._lock:
+            h = self._histograms.get(key)
+            if h is None:
+                h = self._histograms[key] = Histogram()
+            h.record(seconds)
+
+    @contextmanager
+    def timed(self, name, label=None):
+        '''Record the time spent in the with block.'''
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.record(name, time.time() - start, label)
+
+    def counter(self, name, label=None):
+        with self._lock:
+            return self._counters.get((name, _label(label)), 0)
+
+    def percentile(self, name, p, label=None):
+        with self._lock:
+            h = self._histograms.get((name, _label(label)))
+            return h.percentile(p) if h is not None else None
+
+    def snapshot(self):
+        '''Return all measurements as nested dicts:
+
+        {'counters':   {name: {label: count}},
+         'histograms': {name: {label: {'count':.., 'p50':.., ...}}}}
+
+        Latencies are given in seconds.
+        '''
+        counters = {}
+        histograms = {}
+        with self._lock:
+            for (name, label), n in self._counters.items():
+                counters.setdefault(name, {})[label] = n
+            for (name, label), h in self._histograms.items():
+                histograms.setdefault(name, {})[label] = h.toDict()
+        return {'counters': counters, 'histograms': histograms}
+
+    def toJSON(self, **kwargs):
+        return json.dumps(self.snapshot(), **kwargs)
+
+    def dump(self, f):
+        '''Write the snapshot as JSON to f, a file name or file object.'''
+        if isinstance(f, basestring):
+            with open(f, 'w') as fobj:
+                fobj.write(self.toJSON(indent=2, sort_keys=True))
+        else:
+            f.write(self.toJSON(indent=2, sort_keys=True))
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+def _label(label):
+    if label is None:
+        label = currentLabel()
+    return unicode(label)
+
+#*******************************************************************************
+# t h r e a d   l a b e l s                                                    *
+#*******************************************************************************
+
+_local = threading.local()
+
+def currentLabel():
+    '''Label set by the innermost labelled() block of this thread.'''
+    return getattr(_local, 'label', UNLABELLED)
+
+@contextmanager
+def labelled(label):
+    '''Attribute measurements made in the with block (by this thread) to
+    label, unless they specify a label explicitly.'''
+    previous = currentLabel()
+    _local.label = label
+    try:
+        yield
+    finally:
+        _local.label = previous
+
+def layerLabel(ims):
+    '''Label of the layer an image source belongs to.'''
+    layer = getattr(ims, '_layer', None)
+    if layer is None:
+        return UNLABELLED
+    return unicode(layer.name)
+
+metrics = None
+def get_metrics():
+    global metrics
+    if metrics is None:
+        metrics = MetricsRegistry(cfg.getboolean('pixelpipeline', 'metrics'))
+    return metrics
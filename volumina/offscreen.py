@@ -0,0 +1,293 @@
+###############################################################################
+#   volumina: volume slicing and editing library
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the Lesser GNU General Public License
+# as published by the Free Software Foundation; either version 2.1
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# See the files LICENSE.lgpl2 and LICENSE.lgpl3 for full text of the
+# GNU Lesser General Public License version 2.1 and 3 respectively.
+# This information is also available on the ilastik web site at:
+#		   http://ilastik.org/license/
+###############################################################################
+"""
+Render slices of a layer stack without a view or an event loop.
+
+    renderer = OffscreenRenderer(layerStackModel, shape=(1, 512, 512, 64, 1))
+    rgba = renderer.render('z', 10)                  # whole slice z=10
+    rgba = renderer.render('x', 3, region=(0, 0, 100, 50), level=1)
+
+The renderer uses the same pixel pipeline as ImageScene2D (an ImagePump per
+axis and TileProviders on the shared render pool), so the result is what a
+view shows, with the abscissa of the slice running horizontally.
+
+The module can also be run to write PNGs of .npy or .h5 volumes:
+
+    python -m volumina.offscreen raw.npy --labels seg.npy --axis z --slice 0:10 -o z%03d.png
+"""
+import sys
+import math
+import time
+import threading
+import argparse
+
+import numpy
+from PyQt4.QtCore import Qt, QRect, QRectF, QCoreApplication
+from PyQt4.QtGui import QImage, QPainter
+from qimage2ndarray import rgb_view, alpha_view
+
+from volumina.tiling import Tiling, TileProvider
+from volumina.slicingtools import SliceProjection
+from volumina.pixelpipeline.imagepump import ImagePump
+
+_has_h5py = True
+try:
+    import h5py
+except ImportError:
+    _has_h5py = False
+
+#*******************************************************************************
+# O f f s c r e e n R e n d e r e r                                            *
+#*******************************************************************************
+
+class OffscreenRenderer(object):
+    '''OffscreenRenderer.__init__()
+
+    Arguments:
+    layerStackModel -- the layers to render
+    shape           -- 5d (t, x, y, z, c) shape of the data
+    blockSize       -- tile size (default 256)
+
+    Slices are selected by an axis ('x', 'y' or 'z', or its index 0, 1
+    or 2 as in VolumeEditor.imageViews) and a position along that axis.
+
+    '''
+    AXES = 'xyz'
+    # waiting for tiles wakes up at least this often (in seconds) to
+    # deliver queued signals, e.g. dirty notifications of MinMaxSources
+    POLL_INTERVAL = 0.05
+
+    def __init__(self, layerStackModel, shape, blockSize=256):
+        assert len(shape) == 5, "shape must be 5d (t, x, y, z, c)"
+        self.layerStackModel = layerStackModel
+        self.shape = tuple(shape)
+        self.blockSize = blockSize
+        self._pumps = {}          # axis -> ImagePump
+        self._tileProviders = {}  # (axis, level) -> TileProvider
+        self._changed = threading.Event()
+
+    def sliceShape(self, axis):
+        '''(width, height) of the slices along axis.'''
+        projection = self._projection(self._axis(axis))
+        return (self.shape[projection.abscissa], self.shape[projection.ordinate])
+
+    def renderImage(self, axis, position, region=None, level=0, t=0, c=0,
+                    timeout=None):
+        '''Render a slice and return a QImage.
+
+        axis     -- 'x', 'y' or 'z' (or 0, 1, 2)
+        position -- slice index along axis
+        region   -- (x, y, width, height) in slice coordinates (default:
+                    the whole slice)
+        level    -- pyramid level; the image is downsampled by 2**level
+        t, c     -- time step and channel
+        timeout  -- seconds to wait for the tiles (default: no limit);
+                    a RuntimeError is raised if they are not done by then
+
+        '''
+        axis = self._axis(axis)
+        spatial = axis + 1
+        if not 0 <= position < self.shape[spatial]:
+            raise ValueError("position %d out of range [0, %d)" % (position, self.shape[spatial]))
+        w, h = self.sliceShape(axis)
+        rect = QRect(0, 0, w, h)
+        if region is not None:
+            rect = rect.intersected(QRect(*region))
+            if rect.isEmpty():
+                raise ValueError("region %r is outside of the slice" % (region,))
+
+        self._pump(axis).syncedSliceSources.through = [t, position, c]
+        tiles = self._waitForTiles(self._tileProvider(axis, level), QRectF(rect), timeout)
+
+        f = 2**level
+        img = QImage(int(math.ceil(rect.width() / float(f))),
+                     int(math.ceil(rect.height() / float(f))),
+                     QImage.Format_ARGB32_Premultiplied)
+        # the background of the composited tiles
+        img.fill(0xffffffff)
+        p = QPainter(img)
+        p.scale(1.0 / f, 1.0 / f)
+        p.translate(-rect.x(), -rect.y())
+        sceneTransform = p.worldTransform()
+        for tile in tiles:
+            if tile.qimg is not None:
+                p.setWorldTransform(tile.transform * sceneTransform)
+                p.drawImage(0, 0, tile.qimg)
+        p.end()
+        return img
+
+    def render(self, axis, position, region=None, level=0, t=0, c=0,
+               timeout=None):
+        '''Like renderImage(), but return a (height, width, 4) uint8
+        RGBA array.'''
+        img = self.renderImage(axis, position, region, level, t, c, timeout)
+        img = img.convertToFormat(QImage.Format_ARGB32)
+        return numpy.dstack((rgb_view(img), alpha_view(img)))
+
+    def _axis(self, axis):
+        if isinstance(axis, basestring):
+            axis = self.AXES.index(axis.lower())
+        if axis not in range(3):
+            raise ValueError("invalid axis %r" % (axis,))
+        return axis
+
+    @staticmethod
+    def _projection(axis):
+        # the same projections as VolumeEditor._initImagePumps
+        return [SliceProjection(abscissa=2, ordinate=3, along=[0,1,4]),
+                SliceProjection(abscissa=1, ordinate=3, along=[0,2,4]),
+                SliceProjection(abscissa=1, ordinate=2, along=[0,3,4])][axis]
+
+    def _pump(self, axis):
+        if axis not in self._pumps:
+            self._pumps[axis] = ImagePump(self.layerStackModel, self._projection(axis))
+        return self._pumps[axis]
+
+    def _tileProvider(self, axis, level):
+        key = (axis, level)
+        if key not in self._tileProviders:
+            tiling = Tiling(self.sliceShape(axis), blockSize=self.blockSize,
+                            name="offscreen %s (level %d)" % (self.AXES[axis], level),
+                            level=level)
+            tileProvider = TileProvider(tiling, self._pump(axis).stackedImageSources)
+            # emitted by the render threads when a layer tile is done
+            tileProvider.sceneRectChanged.connect(self._onTileChanged, type=Qt.DirectConnection)
+            self._tileProviders[key] = tileProvider
+        return self._tileProviders[key]
+
+    def _onTileChanged(self, rect):
+        self._changed.set()
+
+    def _waitForTiles(self, tileProvider, rectF, timeout):
+        deadline = time.time() + timeout if timeout is not None else None
+        while True:
+            self._changed.clear()
+            app = QCoreApplication.instance()
+            if app is not None:
+                app.processEvents()
+            tiles = list(tileProvider.getTiles(rectF))
+            if all(tile.progress >= 1.0 for tile in tiles):
+                return tiles
+            if deadline is not None and time.time() > deadline:
+                raise RuntimeError("tiles not rendered within %s seconds" % timeout)
+            self._changed.wait(self.POLL_INTERVAL)
+
+#*******************************************************************************
+# c o m m a n d   l i n e                                                      *
+#*******************************************************************************
+
+def _loadVolume(path):
+    '''Load a .npy file or an hdf5 dataset (path/to/file.h5/dataset) as a
+    5d (t, x, y, z, c) array. 2d and 3d data are taken to be (x, y) and
+    (x, y, z).'''
+    for ext in ('.h5/', '.hdf5/'):
+        if ext in path:
+            if not _has_h5py:
+                raise RuntimeError("h5py is needed to read %s" % path)
+            filename, dataset = path.split(ext, 1)
+            with h5py.File(filename + ext[:-1], 'r') as f:
+                a = f[dataset][...]
+            break
+    else:
+        a = numpy.load(path)
+    if a.ndim == 2:
+        a = a[numpy.newaxis, :, :, numpy.newaxis, numpy.newaxis]
+    elif a.ndim == 3:
+        a = a[numpy.newaxis, :, :, :, numpy.newaxis]
+    elif a.ndim != 5:
+        raise ValueError("%s: expected 2d, 3d or 5d (t, x, y, z, c) data, got shape %r" % (path, a.shape))
+    return a
+
+def _slices(spec):
+    '''"3" -> [3], "0:10" -> [0, ..., 9], "0:10:2" -> [0, 2, ..., 8]'''
+    if ':' in spec:
+        return range(*[int(i) for i in spec.split(':')])
+    return [int(spec)]
+
+def main(argv=None):
+    from volumina.layerstack import LayerStackModel
+    from volumina.layer import GrayscaleLayer, ColortableLayer
+    from volumina.pixelpipeline.datasources import ArraySource
+    from volumina.colortables import create_default_16bit
+
+    parser = argparse.ArgumentParser(
+        description="Render slices of volumes to PNG files without a display.")
+    parser.add_argument('raw', nargs='*', help="grayscale volumes (.npy, or file.h5/dataset)")
+    parser.add_argument('--labels', action='append', default=[],
+                        help="label volume, shown with a colortable on top of the grayscale ones")
+    parser.add_argument('--axis', default='z', choices=list(OffscreenRenderer.AXES))
+    parser.add_argument('--slice', default='0', help="slice index, or range start:stop[:step]")
+    parser.add_argument('--t', type=int, default=0, help="time step")
+    parser.add_argument('--c', type=int, default=0, help="channel")
+    parser.add_argument('--region', help="x,y,width,height in slice coordinates")
+    parser.add_argument('--level', type=int, default=0, help="downsample by 2**level")
+    parser.add_argument('--timeout', type=float, default=None)
+    parser.add_argument('-o', '--output', default='slice%04d.png',
+                        help="output file; must contain a %%d format if several slices are rendered")
+    args = parser.parse_args(argv)
+    if not args.raw and not args.labels:
+        parser.error("nothing to render")
+    slices = _slices(args.slice)
+    if len(slices) > 1 and '%' not in args.output:
+        parser.error("--output needs a %d format to write several slices")
+    region = tuple(int(i) for i in args.region.split(',')) if args.region else None
+
+    # queued signals of the pixel pipeline need an application object,
+    # which must stay alive until the slices are rendered
+    app = QCoreApplication.instance() or QCoreApplication(sys.argv)
+    try:
+        layerStack = LayerStackModel()
+        shape = None
+        for path in args.raw:
+            a = _loadVolume(path)
+            if a.dtype == numpy.uint8:
+                normalize = (0, 255)
+            else:
+                normalize = (float(a.min()), float(a.max()))
+            layer = GrayscaleLayer(ArraySource(a), normalize=normalize)
+            layer.name = path
+            layerStack.append(layer)
+            shape = shape or a.shape
+        colortable = create_default_16bit()
+        colortable[0] = 0 # transparent background
+        for path in args.labels:
+            a = _loadVolume(path)
+            layer = ColortableLayer(ArraySource(a), colortable)
+            layer.name = path
+            layerStack.append(layer)
+            shape = shape or a.shape
+
+        renderer = OffscreenRenderer(layerStack, shape)
+        for position in slices:
+            img = renderer.renderImage(args.axis, position, region, args.level,
+                                       args.t, args.c, args.timeout)
+            filename = args.output % position if '%' in args.output else args.output
+            if not img.save(filename):
+                sys.stderr.write("could not write %s\n" % filename)
+                return 1
+        return 0
+    finally:
+        # deliver what the pipeline still queued while the application exists
+        app.processEvents()
+
+if __name__ == '__main__':
+    sys.exit(main())
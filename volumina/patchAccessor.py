@@ -102,10 +102,21 @@ class PatchAccessor():
         ex = min(ex, self._cX)
         ey = min(ey, self._cY)
 
-        nums = []
-        for y in range(sy,ey):
-            nums += range(y*self._cX+sx, y*self._cX+ex)
-        return nums
+        rows = numpy.arange(sy, ey) * self._cX
+        cols = numpy.arange(sx, ex)
+        return (rows[:, numpy.newaxis] + cols).ravel().tolist()
+
+    def getPatchNumber(self, x, y):
+        """
+        Number of the patch containing the point (x, y), or None if the
+        point lies outside of the shape. Points on the far border of the
+        shape belong to the last patch.
+        """
+        if not (0 <= x <= self.size_x and 0 <= y <= self.size_y) or self.patchCount == 0:
+            return None
+        px = min(int(x // self._blockSize), self._cX - 1)
+        py = min(int(y // self._blockSize), self._cY - 1)
+        return py*self._cX + px
 
 if __name__ == "__main__":
     pa = PatchAccessor(1000,1000, 100)
@@ -115,3 +126,6 @@ if __name__ == "__main__":
     assert pa.patchRectF(1) == QRectF(100,0,100,100)
     
     assert pa.getPatchesForRect( 50, 50, 150, 150 ) == [0, 1, 10, 11]
+    assert pa.getPatchNumber( 150, 250 ) == 21
+    assert pa.getPatchNumber( 1000, 1000 ) == 99
+    assert pa.getPatchNumber( -1, 0 ) is None
@@ -27,8 +27,12 @@ from PyQt4.QtCore import QObject, pyqtSignal, QTimer
 from asyncabcs import RequestABC, SourceABC, IndeterminateRequestError
 import volumina
 from volumina.slicingtools import is_pure_slicing, slicing2shape, \
-    is_bounded, make_bounded, index2slice, sl
+    is_bounded, make_bounded, index2slice, sl, is_strided, unstrided
 from volumina.config import cfg
+from volumina.metrics import get_metrics
+from volumina.pixelpipeline import tilestore
+from volumina.pixelpipeline.tilestore import get_tile_store
+from volumina.pixelpipeline.sharedcache import cachedRequest, invalidateShared, identityToken
 import numpy as np
 
 _has_lazyflow = True
@@ -43,6 +47,13 @@ try:
 except ImportError:
     _has_vigra = False
 
+def supportsStridedReads(datasource):
+    '''Whether a strided (i.e. downsampled) request to datasource reads
+    only the requested elements, instead of the full resolution bounding
+    box. Datasources take part by implementing supportsStridedReads();
+    others are assumed to read the bounding box.'''
+    return getattr(datasource, 'supportsStridedReads', lambda: False)()
+
 #*******************************************************************************
 # A r r a y R e q u e s t                                                      *
 #*******************************************************************************
@@ -99,6 +110,21 @@ class ArraySource( QObject ):
     def dtype(self):
         return self._array.dtype.type
 
+    def chunkShape(self):
+        # e.g. the chunks of a h5py dataset; None for numpy arrays
+        return getattr(self._array, 'chunks', None)
+
+    def supportsStridedReads(self):
+        # numpy and h5py read only the selected elements of a strided slicing
+        return True
+
+    def cacheKey(self):
+        # requests to in-memory arrays return views, which are not worth
+        # sharing (see cachedRequest)
+        if isinstance(self._array, np.ndarray):
+            return None
+        return identityToken(self._array)
+
     def request( self, slicing ):
         if not is_pure_slicing(slicing):
             raise Exception('ArraySource: slicing is not pure')
@@ -110,6 +136,7 @@ class ArraySource( QObject ):
     def setDirty( self, slicing):
         if not is_pure_slicing(slicing):
             raise Exception('dirty region: slicing is not pure')
+        invalidateShared(self, slicing)
         self.isDirty.emit( slicing )
 
     def __eq__( self, other ):
@@ -153,6 +180,10 @@ class RelabelingArraySource( ArraySource ):
         super(RelabelingArraySource, self).__init__(array)
         self.originalData = array
         self._relabeling = None
+
+    def cacheKey(self):
+        # results depend on the relabeling
+        return None
     
     def setRelabeling( self, relabeling ):
         """Sets new relabeling vector. It should have a len(relabling) == max(your data)+1
@@ -219,6 +250,12 @@ if _has_lazyflow:
             shape = op.Output.meta.shape
             if shape is not None:
                 slicing = make_bounded(slicing, shape)
+            # lazyflow can't handle strided rois, so strided (i.e. downsampled)
+            # requests fetch the bounding box and apply the steps afterwards;
+            # this is why LazyflowSource.supportsStridedReads() is False
+            self._steps = None
+            if is_strided(slicing):
+                slicing, self._steps = unstrided(slicing)
             self._req = op.Output[slicing]
             self._slicing = slicing
             self._shape = slicing2shape(slicing)
@@ -229,6 +266,8 @@ if _has_lazyflow:
             a = self._req.wait()
             assert(isinstance(a, np.ndarray))
             assert(a.shape == self._shape), "LazyflowRequest.wait() [name=%s]: we requested shape %s (slicing: %s), but lazyflow delivered shape %s" % (self._objectName, self._shape, self._slicing, a.shape)
+            if self._steps is not None:
+                a = a[self._steps]
             return a
             
         @translate_lf_exceptions
@@ -236,6 +275,8 @@ if _has_lazyflow:
             a = self._req.result
             assert(isinstance(a, np.ndarray))
             assert(a.shape == self._shape), "LazyflowRequest.getResult() [name=%s]: we requested shape %s (slicing: %s), but lazyflow delivered shape %s" % (self._objectName, self._shape, self._slicing, a.shape)
+            if self._steps is not None:
+                a = a[self._steps]
             return a
     
         def cancel( self ):
@@ -309,6 +350,21 @@ if _has_lazyflow:
             dtype = self._orig_outslot.meta.dtype
             assert dtype is not None, "Your LazyflowSource doesn't have a dtype! Is your lazyflow slot properly configured in setupOutputs()?"
             return dtype
+
+        def chunkShape(self):
+            blockshape = self._op5.Output.meta.ideal_blockshape
+            if blockshape is None or len(blockshape) != 5:
+                return None
+            # 0 means no preference along that axis
+            return tuple(blockshape)
+
+        def supportsStridedReads(self):
+            # a strided request computes the whole bounding box at full
+            # resolution, see LazyflowRequest
+            return False
+
+        def cacheKey(self):
+            return identityToken(self._orig_outslot)
         
         @translate_lf_exceptions
         def request( self, slicing ):
@@ -327,6 +383,7 @@ if _has_lazyflow:
         def setDirty( self, slicing):
             if not is_pure_slicing(slicing):
                 raise Exception('dirty region: slicing is not pure')
+            invalidateShared(self, slicing)
             self.isDirty.emit( slicing )
     
         def __eq__( self, other ):
@@ -435,6 +492,9 @@ class ConstantSource( QObject ):
     def id( self ):
         return id(self)
 
+    def supportsStridedReads(self):
+        return True
+
     def request( self, slicing, through=None ):
         assert is_pure_slicing(slicing)
         assert is_bounded(slicing)
@@ -472,6 +532,9 @@ class MinMaxUpdateRequest( object ):
         self._result = rawData
         self._update_func(rawData)
         return self._result
+
+    def cancel( self ):
+        self._rawRequest.cancel()
     
     # callback( result = result, **kwargs )
     def notify( self, callback, **kwargs ):
@@ -531,9 +594,15 @@ class MinMaxSource( QObject ):
             
     def dtype(self):
         return self._rawSource.dtype()
+
+    def chunkShape(self):
+        return getattr(self._rawSource, 'chunkShape', lambda: None)()
+
+    def supportsStridedReads(self):
+        return supportsStridedReads(self._rawSource)
     
     def request( self, slicing ):
-        rawRequest = self._rawSource.request(slicing)
+        rawRequest = cachedRequest(self._rawSource, slicing)
         return MinMaxUpdateRequest( rawRequest, self._getMinMax )
 
     def setDirty( self, slicing ):
@@ -590,3 +659,132 @@ class MinMaxSource( QObject ):
 
 assert issubclass(MinMaxSource, SourceABC)
 
+
+#*******************************************************************************
+# D i s k C a c h e S o u r c e                                                *
+#*******************************************************************************
+
+class DiskCacheRequest( object ):
+    def __init__( self, source, slicing ):
+        self._source = source
+        self._slicing = slicing
+        self._generation = source._generation
+        self._rawRequest = None
+        self._result = None
+
+    def wait( self ):
+        # the store is read here rather than in __init__, as requests are
+        # created in the GUI thread but waited for by the render threads
+        if self._result is None:
+            label = self._source.objectName()
+            result = self._source._store.get(self._source._namespace, self._slicing)
+            if result is not None:
+                get_metrics().increment('disk_cache_hits', label)
+            else:
+                get_metrics().increment('disk_cache_misses', label)
+                self._rawRequest = cachedRequest(self._source._rawSource, self._slicing)
+                result = self._rawRequest.wait()
+                self._source._put(self._slicing, result, self._generation)
+            self._result = result
+        return self._result
+
+    def getResult(self):
+        return self._result
+
+    def cancel( self ):
+        if self._rawRequest is not None:
+            self._rawRequest.cancel()
+
+    def submit( self ):
+        pass
+
+    # callback( result = result, **kwargs )
+    def notify( self, callback, **kwargs ):
+        t = threading.Thread(target=self._doNotify, args=( callback, kwargs ))
+        t.start()
+
+    def _doNotify( self, callback, kwargs ):
+        result = self.wait()
+        callback(result, **kwargs)
+
+assert issubclass(DiskCacheRequest, RequestABC)
+
+class DiskCacheSource( QObject ):
+    """
+    A datasource decorator that keeps the arrays requested from a slow
+    datasource (e.g. a LazyflowSource computing predictions) in an
+    on-disk TileStore, such that revisiting a region reads the data from
+    disk instead of recomputing it, also in later sessions.
+
+    cacheId identifies the data across sessions (e.g. a project file name
+    and layer name), version its state: data stored for other versions
+    of cacheId is deleted. Dirty notifications of the raw source delete
+    the stored arrays they intersect.
+    """
+    isDirty = pyqtSignal( object )
+    numberOfChannelsChanged = pyqtSignal(int)
+
+    def __init__( self, rawSource, cacheId, version=0, store=None, parent=None ):
+        super(DiskCacheSource, self).__init__(parent)
+        self._rawSource = rawSource
+        self._rawSource.isDirty.connect( self.setDirty )
+        self._rawSource.numberOfChannelsChanged.connect( self.numberOfChannelsChanged )
+        self._store = store if store is not None else get_tile_store()
+        prefix = tilestore.namespace(cacheId) + '-'
+        self._namespace = tilestore.namespace(cacheId, version)
+        self._store.purge(prefix, keep=self._namespace)
+        # incremented on every dirty notification, such that requests
+        # started before do not store outdated data
+        self._generation = 0
+        self._lock = threading.Lock()
+        self.setObjectName(rawSource.objectName())
+
+    @property
+    def numberOfChannels(self):
+        return self._rawSource.numberOfChannels
+
+    def clean_up(self):
+        self._rawSource.clean_up()
+
+    @property
+    def dataSlot(self):
+        return getattr(self._rawSource, 'dataSlot', None)
+
+    def dtype(self):
+        return self._rawSource.dtype()
+
+    def chunkShape(self):
+        return getattr(self._rawSource, 'chunkShape', lambda: None)()
+
+    def supportsStridedReads(self):
+        return supportsStridedReads(self._rawSource)
+
+    def request( self, slicing ):
+        if not is_pure_slicing(slicing):
+            raise Exception('DiskCacheSource: slicing is not pure')
+        return DiskCacheRequest(self, slicing)
+
+    def setDirty( self, slicing ):
+        with self._lock:
+            self._generation += 1
+            self._store.invalidate(self._namespace, slicing)
+        self.isDirty.emit(slicing)
+
+    def _put( self, slicing, result, generation ):
+        # masks are not stored by np.save
+        if isinstance(result, np.ma.MaskedArray):
+            return
+        with self._lock:
+            if generation == self._generation:
+                self._store.put(self._namespace, slicing, result)
+
+    def __eq__( self, other ):
+        if other is None:
+            return False
+        return isinstance( other, DiskCacheSource ) and \
+               self._rawSource == other._rawSource
+
+    def __ne__( self, other ):
+        return not ( self == other )
+
+assert issubclass(DiskCacheSource, SourceABC)
@@ -0,0 +1,110 @@
+###############################################################################
+#   volumina: volume slicing and editing library
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the Lesser GNU General Public License
+# as published by the Free Software Foundation; either version 2.1
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# See the files LICENSE.lgpl2 and LICENSE.lgpl3 for full text of the
+# GNU Lesser General Public License version 2.1 and 3 respectively.
+# This information is also available on the ilastik web site at:
+#		   http://ilastik.org/license/
+###############################################################################
+import threading
+from collections import OrderedDict
+
+from PyQt4.QtGui import QImage
+
+from volumina.config import cfg
+from volumina.metrics import get_metrics
+
+#*******************************************************************************
+# I m a g e P o o l                                                            *
+#*******************************************************************************
+
+class ImagePool(object):
+    """
+    Process-wide pool of image buffers, keyed by size and format.
+
+    The image sources and the tile providers acquire the images they render
+    into from the pool instead of allocating them, and the tile caches
+    release the images they drop. The contents of an acquired image are
+    undefined, i.e. it must be filled or painted over completely.
+
+    QImages are implicitly shared: the pool keeps a shallow copy of a
+    released image and hands it out again only once all other copies are
+    gone, so that nobody still painting or displaying it can observe the
+    reuse. Buffers in the pool are dropped in LRU order beyond maxbytes.
+    """
+    def __init__(self, maxbytes):
+        self.maxbytes = maxbytes
+        self._lock = threading.Lock()
+        # (width, height, format) -> released images, LRU first
+        self._free = OrderedDict()
+        self._bytes = 0
+
+    def __len__(self):
+        with self._lock:
+            return sum(len(images) for images in self._free.itervalues())
+
+    def usedBytes(self):
+        return self._bytes
+
+    def acquire(self, width, height, format):
+        '''An image of the given size and format with undefined contents.'''
+        key = (width, height, format)
+        with self._lock:
+            images = self._free.get(key, ())
+            for i in xrange(len(images) - 1, -1, -1):
+                if images[i].isDetached():
+                    img = images.pop(i)
+                    self._bytes -= img.byteCount()
+                    if not images:
+                        del self._free[key]
+                    get_metrics().increment('image_pool_hits')
+                    return img
+        get_metrics().increment('image_pool_misses')
+        return QImage(width, height, format)
+
+    def release(self, img):
+        '''Offer the buffer of img for reuse; img itself stays valid.'''
+        if img is None or img.isNull():
+            return
+        nbytes = img.byteCount()
+        if nbytes > self.maxbytes:
+            return
+        key = (img.width(), img.height(), img.format())
+        with self._lock:
+            images = self._free.pop(key, [])
+            images.append(QImage(img))
+            self._free[key] = images
+            self._bytes += nbytes
+            while self._bytes > self.maxbytes:
+                oldest = next(self._free.iterkeys())
+                old = self._free[oldest].pop(0)
+                if not self._free[oldest]:
+                    del self._free[oldest]
+                self._bytes -= old.byteCount()
+
+    def clear(self):
+        with self._lock:
+            self._free.clear()
+            self._bytes = 0
+
+image_pool = None
+
+def get_image_pool():
+    global image_pool
+    if image_pool is None:
+        megabytes = cfg.getint('pixelpipeline', 'image_pool_megabytes')
+        image_pool = ImagePool(megabytes * 2**20)
+    return image_pool
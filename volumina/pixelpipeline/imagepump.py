@@ -51,6 +51,7 @@ class StackedImageSources( QObject ):
 
     """    
     layerDirty = pyqtSignal(object, object)
+    paletteChanged = pyqtSignal(object) # image source, see ColortableImageSource
     visibleChanged = pyqtSignal(object, bool)
     opacityChanged = pyqtSignal(object, float)
     sizeChanged  = pyqtSignal()
@@ -116,7 +117,7 @@ class StackedImageSources( QObject ):
 
         # we need to store partial functions to which we connect
         # for later disconnection
-        self._curryRegistry = {'I':{}, "O":{}, "V":{}, "Id":{}}
+        self._curryRegistry = {'I':{}, "O":{}, "V":{}, "Id":{}, "P":{}}
 
         # Each layer has a single image source, which has been set-up according
         # to the layer's specification.
@@ -186,6 +187,9 @@ class StackedImageSources( QObject ):
         imageSource.isDirty.connect( self._curryRegistry['I'][imageSource] ) 
         layer.opacityChanged.connect( self._curryRegistry['O'][layer] )
         layer.visibleChanged.connect( self._curryRegistry['V'][layer] )
+        if hasattr(imageSource, 'paletteChanged'):
+            self._curryRegistry['P'][imageSource] = partial(self.paletteChanged.emit, imageSource)
+            imageSource.paletteChanged.connect( self._curryRegistry['P'][imageSource] )
 
         self._updateOcclusionInfo()
         self.sizeChanged.emit()
@@ -271,6 +275,8 @@ class StackedImageSources( QObject ):
         del self._curryRegistry['I'][ims]
         del self._curryRegistry['O'][layer]
         del self._curryRegistry['V'][layer]
+        if ims in self._curryRegistry['P']:
+            ims.paletteChanged.disconnect( self._curryRegistry['P'].pop(ims) )
 
         del self._imsToLayer[ims]
         del self._layerToIms[layer]
@@ -33,7 +33,7 @@ def createImageSource( layer, datasources2d ):
     src = AlphaModulatedImageSource( datasources2d[0], layer )
     src.setObjectName(layer.name)
     layer.nameChanged.connect(lambda x: src.setObjectName(str(x)))
-    layer.tintColorChanged.connect(lambda: src.setDirty((slice(None,None), slice(None,None))))
+    layer.tintColorChanged.connect(src.setAppearanceDirty)
     return src
 
 @multimethod(GrayscaleLayer, list)
@@ -74,5 +74,5 @@ def createImageSource( layer, datasources2d ):
     src = RGBAImageSource( ds[0], ds[1], ds[2], ds[3], layer, guarantees_opaqueness = guarantees_opaqueness )
     src.setObjectName(layer.name)
     layer.nameChanged.connect(lambda x: src.setObjectName(str(x)))
-    layer.normalizeChanged.connect(lambda: src.setDirty((slice(None,None), slice(None,None))))
+    layer.normalizeChanged.connect(src.setAppearanceDirty)
     return src
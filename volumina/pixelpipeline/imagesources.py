@@ -20,6 +20,7 @@
 #		   http://ilastik.org/license/
 ###############################################################################
 #Python
+import itertools
 import logging
 import time
 import warnings
@@ -38,6 +39,10 @@ from qimage2ndarray import gray2qimage, array2qimage, alpha_view, rgb_view, byte
 from asyncabcs import SourceABC, RequestABC
 from volumina.slicingtools import is_bounded, slicing2rect, rect2slicing, slicing2shape, is_pure_slicing
 from volumina.config import cfg
+from volumina.metrics import get_metrics, DATASOURCE_WAIT, TO_QIMAGE
+from volumina.pixelpipeline.imagepool import get_image_pool
+from volumina.pixelpipeline.sharedcache import SharedArrayCache, SharedCacheRequest
+from volumina.pixelpipeline.datasources import supportsStridedReads
 import numpy as np
 
 _has_vigra = True
@@ -46,6 +51,27 @@ try:
 except ImportError:
     _has_vigra = False
 
+def _recordTimes(tWAIT, tImg):
+    '''Record the timings (in msec) of an image request in the pipeline metrics.'''
+    metrics = get_metrics()
+    metrics.record(DATASOURCE_WAIT, tWAIT / 1000.0)
+    if tImg is not None:
+        metrics.record(TO_QIMAGE, tImg / 1000.0)
+
+raw_array_cache = None
+
+def get_raw_array_cache():
+    '''Cache of the 2D arrays that image sources render, see ImageSource._cachedRequest.'''
+    global raw_array_cache
+    if raw_array_cache is None:
+        megabytes = cfg.getint('pixelpipeline', 'raw_cache_megabytes')
+        raw_array_cache = SharedArrayCache(megabytes * 2**20, name='raw_cache')
+    return raw_array_cache
+
+# never reused, such that a new image source cannot see the cached
+# arrays of a deleted one
+_cacheTokens = itertools.count()
+
 #*******************************************************************************
 # I m a g e S o u r c e                                                        *
 #*******************************************************************************
@@ -57,6 +83,11 @@ class ImageSource( QObject ):
     isDirty -- a rectangular region has changed; transmits
                an empty QRect if the whole image is dirty
 
+    The arrays requested through _cachedRequest are kept in the raw
+    array cache, such that a change of the appearance only (see
+    setAppearanceDirty) renders the images again without fetching
+    the data. setDirty drops the cached arrays of the dirty region.
+
     '''
 
     isDirty = pyqtSignal( QRect )
@@ -69,10 +100,48 @@ class ImageSource( QObject ):
         super(ImageSource, self).__init__( parent = parent )
         self._opaque = guarantees_opaqueness
         self.direct = direct
+        self._cacheToken = next(_cacheTokens)
+        self._cacheChannels = 1
+
+    def request( self, rect, along_through=None, level=0 ):
+        '''Request the image of a rectangular region of the slice.
+
+        rect          -- QRect in data coordinates
+        along_through -- see SliceSource.request()
+        level         -- pyramid level; the region is read from the datasource
+                         with a stride of 2**level in both directions, i.e. the
+                         resulting image is downsampled by nearest-neighbour
+                         sampling (which is also safe for label data)
 
-    def request( self, rect, along_through=None ):
+        '''
         raise NotImplementedError
 
+    def supportsStridedReads( self ):
+        '''Whether requests at pyramid levels > 0 read only the downsampled
+        data. Otherwise they cost as much as the full resolution request,
+        and should not be made (see ImageScene2D and TileProvider).'''
+        return False
+
+    def _slicing( self, qrect, level=0 ):
+        return rect2slicing(qrect, step=2**level if level else None)
+
+    def _cachedRequest( self, arraySource, slicing, along_through, channel=0 ):
+        '''arraySource.request(slicing, along_through), kept in the raw array cache.
+
+        Without along_through the position of the slice is unknown, and
+        the request is not cached.
+
+        '''
+        request = arraySource.request(slicing, along_through)
+        cache = get_raw_array_cache()
+        if along_through is None or cache.maxbytes <= 0:
+            return request
+        # the through position is part of the key; since invalidation
+        # only compares the axes present in the dirty slicing, a 2D
+        # dirty region drops the arrays of all slices
+        key = tuple(slicing) + tuple(slice(v, v+1) for axis, v in along_through)
+        return SharedCacheRequest(cache, (self._cacheToken, channel), key, request)
+
     def setDirty( self, slicing ):
         '''Mark a region of the image as dirty.
 
@@ -84,11 +153,24 @@ class ImageSource( QObject ):
         '''
         if not is_pure_slicing(slicing):
             raise Exception('dirty region: slicing is not pure')
+        cache = get_raw_array_cache()
+        for channel in range(self._cacheChannels):
+            cache.invalidate((self._cacheToken, channel), slicing)
         if not is_bounded( slicing ):
             self.isDirty.emit(QRect()) # empty rect == everything is dirty
         else:
             self.isDirty.emit(slicing2rect( slicing ))
 
+    def setAppearanceDirty( self ):
+        '''Mark the whole image as dirty while the data is unchanged.
+
+        Use this when only the mapping of the data to colors changes
+        (e.g. normalization, colortable or tint color): the images are
+        rendered again from the cached arrays.
+
+        '''
+        self.isDirty.emit(QRect()) # empty rect == everything is dirty
+
     def isOpaque( self ):
         '''Image is opaque everywhere (i.e. no pixel has an alpha value != 255).
 
@@ -119,9 +201,12 @@ class GrayscaleImageSource( ImageSource ):
         
         self._arraySource2D.isDirty.connect(self.setDirty)
         if hasattr(self._layer, "normalizeChanged"):
-            self._layer.normalizeChanged.connect(lambda: self.setDirty((slice(None,None), slice(None,None))))
+            self._layer.normalizeChanged.connect(self.setAppearanceDirty)
+
+    def supportsStridedReads( self ):
+        return supportsStridedReads(self._arraySource2D)
 
-    def request( self, qrect, along_through=None ):
+    def request( self, qrect, along_through=None, level=0 ):
         if cfg.getboolean('pixelpipeline', 'verbose'):
             volumina.printLock.acquire()
             print Fore.RED + "  GrayscaleImageSource '%s' requests (x=%d, y=%d, w=%d, h=%d)" \
@@ -130,8 +215,8 @@ class GrayscaleImageSource( ImageSource ):
             volumina.printLock.release()
             
         assert isinstance(qrect, QRect)
-        s = rect2slicing(qrect)
-        req = self._arraySource2D.request(s, along_through)
+        s = self._slicing(qrect, level)
+        req = self._cachedRequest(self._arraySource2D, s, along_through)
         return GrayscaleImageRequest( req, self._layer.normalize[0], direct=self.direct )
 assert issubclass(GrayscaleImageSource, SourceABC)
 
@@ -147,6 +232,9 @@ class GrayscaleImageRequest( object ):
         
     def wait(self):
         return self.toImage()
+
+    def cancel(self):
+        self._arrayreq.cancel()
         
     def toImage( self ):
         t = time.time()
@@ -187,7 +275,7 @@ class GrayscaleImageRequest( object ):
             else:
                 n = np.asarray(self._normalize, dtype=a.dtype)
             tImg = time.time()
-            img = QImage(a.shape[1], a.shape[0], QImage.Format_ARGB32_Premultiplied)
+            img = get_image_pool().acquire(a.shape[1], a.shape[0], QImage.Format_ARGB32_Premultiplied)
             if not a.flags['C_CONTIGUOUS']:
                 a = a.copy()
             vigra.colors.gray2qimage_ARGB32Premultiplied(a, byte_view(img), n)
@@ -205,6 +293,7 @@ class GrayscaleImageRequest( object ):
             ret = img.convertToFormat(QImage.Format_ARGB32_Premultiplied)
             tImg = 1000.0*(time.time()-tImg)
         
+        _recordTimes(tWAIT, tImg)
         if self.logger.getEffectiveLevel() >= logging.DEBUG:
             tTOT = 1000.0*(time.time()-t)
             self.logger.debug("toImage (%dx%d, normalize=%r) took %f msec. (array req: %f, wait: %f, img: %f)" % (img.width(), img.height(), normalize, tTOT, tAR, tWAIT, tImg))
@@ -234,7 +323,10 @@ class AlphaModulatedImageSource( ImageSource ):
 
         self._arraySource2D.isDirty.connect(self.setDirty)
 
-    def request( self, qrect, along_through=None ):
+    def supportsStridedReads( self ):
+        return supportsStridedReads(self._arraySource2D)
+
+    def request( self, qrect, along_through=None, level=0 ):
         if cfg.getboolean('pixelpipeline', 'verbose'):
             volumina.printLock.acquire()
             print Fore.RED + "  AlphaModulatedImageSource '%s' requests (x=%d, y=%d, w=%d, h=%d)" \
@@ -243,8 +335,8 @@ class AlphaModulatedImageSource( ImageSource ):
             volumina.printLock.release()
             
         assert isinstance(qrect, QRect)
-        s = rect2slicing(qrect)
-        req = self._arraySource2D.request(s, along_through)
+        s = self._slicing(qrect, level)
+        req = self._cachedRequest(self._arraySource2D, s, along_through)
         return AlphaModulatedImageRequest( req, self._layer.tintColor, self._layer.normalize[0] )
 assert issubclass(AlphaModulatedImageSource, SourceABC)
 
@@ -261,6 +353,9 @@ class AlphaModulatedImageRequest( object ):
     def wait(self):
         return self.toImage()
 
+    def cancel(self):
+        self._arrayreq.cancel()
+
     def toImage( self ):
         t = time.time()
        
@@ -279,7 +374,7 @@ class AlphaModulatedImageRequest( object ):
             if not a.flags.contiguous:
                 a = a.copy()
             tImg = time.time()
-            img = QImage(a.shape[1], a.shape[0], QImage.Format_ARGB32_Premultiplied)
+            img = get_image_pool().acquire(a.shape[1], a.shape[0], QImage.Format_ARGB32_Premultiplied)
             tintColor = np.asarray([self._tintColor.redF(), self._tintColor.greenF(), self._tintColor.blueF()], dtype=np.float32);
             normalize = np.asarray(self._normalize, dtype=a.dtype)
             if normalize[0] > normalize[1]:
@@ -300,6 +395,7 @@ class AlphaModulatedImageRequest( object ):
             img = img.convertToFormat(QImage.Format_ARGB32_Premultiplied)        
             tImg = 1000.0*(time.time()-tImg)
        
+        _recordTimes(tWAIT, tImg)
         if self.logger.getEffectiveLevel() >= logging.DEBUG:
             tTOT = 1000.0*(time.time()-t)
             self.logger.debug("toImage (%dx%d, normalize=%r) took %f msec. (array req: %f, wait: %f, img: %f)" % (img.width(), img.height(), normalize, tTOT, tAR, tWAIT, tImg))
@@ -321,8 +417,18 @@ assert issubclass(AlphaModulatedImageRequest, RequestABC)
 #*******************************************************************************
 
 class ColortableImageSource( ImageSource ):
+    '''Image source of label layers.
+
+    Unmasked integer data is rendered into indexed 8-bit images if the
+    colortable has at most 256 entries. Their palette can be exchanged
+    without rendering them anew: a change of the colortable that keeps
+    its length is announced by paletteChanged rather than isDirty.
+
+    '''
     loggingName = __name__ + ".ColortableImageSource"
     logger = logging.getLogger(loggingName)
+
+    paletteChanged = pyqtSignal()
     
     def __init__( self, arraySource2D, layer ):
         """ colorTable: a list of QRgba values """
@@ -333,14 +439,16 @@ class ColortableImageSource( ImageSource ):
         self._arraySource2D.isDirty.connect(self.setDirty)
 
         self._layer = layer
+        self._colorTable = None
         self.updateColorTable()
         self._layer.colorTableChanged.connect(self.updateColorTable)
         if hasattr(self._layer, "normalizeChanged"):
-            self._layer.normalizeChanged.connect(lambda: self.setDirty((slice(None,None), slice(None,None))))
+            self._layer.normalizeChanged.connect(self.setAppearanceDirty)
 
     def updateColorTable(self):
         layerColorTable = self._layer.colorTable
-        self._colorTable = np.zeros((len(layerColorTable), 4), dtype=np.uint8)
+        oldColorTable = self._colorTable
+        colorTable = np.zeros((len(layerColorTable), 4), dtype=np.uint8)
 
         for i, c in enumerate(layerColorTable):
             #note that we use qimage2ndarray.byte_view() on a QImage with Format_ARGB32 below.
@@ -350,14 +458,28 @@ class ColortableImageSource( ImageSource ):
                 color = c
             else: 
                 color = QColor.fromRgba(c)
-            self._colorTable[i,0] = color.blue()
-            self._colorTable[i,1] = color.green()
-            self._colorTable[i,2] = color.red()
-            self._colorTable[i,3] = color.alpha() 
-        
-        self.isDirty.emit(QRect()) # empty rect == everything is dirty
+            colorTable[i,0] = color.blue()
+            colorTable[i,1] = color.green()
+            colorTable[i,2] = color.red()
+            colorTable[i,3] = color.alpha() 
+        self._colorTable = colorTable
+        self._palette = [(int(a) << 24) | (int(r) << 16) | (int(g) << 8) | int(b)
+                         for b, g, r, a in colorTable]
+
+        if oldColorTable is not None and len(oldColorTable) == len(colorTable):
+            # indexed images stay valid
+            self.paletteChanged.emit()
+        else:
+            self.setAppearanceDirty()
+
+    def palette(self):
+        '''The colortable as a list of QRgb values (see QImage.setColorTable).'''
+        return self._palette
         
-    def request( self, qrect, along_through=None ):
+    def supportsStridedReads( self ):
+        return supportsStridedReads(self._arraySource2D)
+
+    def request( self, qrect, along_through=None, level=0 ):
         if cfg.getboolean('pixelpipeline', 'verbose'):
             volumina.printLock.acquire()
             print Fore.RED + "  ColortableImageSource '%s' requests (x=%d, y=%d, w=%d, h=%d) = %r" \
@@ -366,25 +488,30 @@ class ColortableImageSource( ImageSource ):
             volumina.printLock.release()
             
         assert isinstance(qrect, QRect)
-        s = rect2slicing(qrect)
-        req = self._arraySource2D.request(s, along_through)
-        return ColortableImageRequest( req, self._colorTable, self._layer.normalize[0], self.direct )
+        s = self._slicing(qrect, level)
+        req = self._cachedRequest(self._arraySource2D, s, along_through)
+        return ColortableImageRequest( req, self._colorTable, self._layer.normalize[0], self.direct,
+                                       self._palette )
 assert issubclass(ColortableImageSource, SourceABC)
 
 class ColortableImageRequest( object ):
     loggingName = __name__ + ".ColortableImageRequest"
     logger = logging.getLogger(loggingName)
     
-    def __init__( self, arrayrequest, colorTable, normalize, direct=False ):
+    def __init__( self, arrayrequest, colorTable, normalize, direct=False, palette=None ):
         self._mutex = QMutex()
         self._arrayreq = arrayrequest
         self._colorTable = colorTable
         self.direct = direct
         self._normalize = normalize
         assert normalize is None or len(normalize) == 2
+        self._palette = palette
 
     def wait(self):
         return self.toImage()
+
+    def cancel(self):
+        self._arrayreq.cancel()
         
     def toImage( self ):
         t = time.time()
@@ -413,11 +540,21 @@ class ColortableImageRequest( object ):
             elif len(self._colorTable) <= 2**32:
                 a = np.asanyarray( a, dtype=np.uint32 )
 
-        # Use vigra if possible (much faster)
         tImg = None
-        if _has_vigra and hasattr(vigra.colors, 'applyColortable'):
+        if self._palette is not None and 0 < len(self._colorTable) <= 2**8 \
+           and not np.ma.is_masked(a) \
+           and (issubclass(a.dtype.type, np.integer) or a.dtype == np.bool_):
+            # a quarter of the memory of an ARGB32 image. QImage has no
+            # 16 bit indexed format, so larger colortables fall through to
+            # ARGB32 below.
+            tImg = time.time()
+            img = self._indexedImage(np.asarray(a))
+            tImg = 1000.0*(time.time()-tImg)
+
+        # Use vigra if possible (much faster)
+        elif _has_vigra and hasattr(vigra.colors, 'applyColortable'):
             tImg = time.time()
-            img = QImage(a.shape[1], a.shape[0], QImage.Format_ARGB32)
+            img = get_image_pool().acquire(a.shape[1], a.shape[0], QImage.Format_ARGB32)
             if not issubclass( a.dtype.type, np.integer ):
                 raise NotImplementedError()
                 #FIXME: maybe this should be done in a better way using an operator before the colortable request which properly handles 
@@ -474,11 +611,23 @@ class ColortableImageRequest( object ):
             img = colortable[a]
             img = array2qimage(img)
             
+        _recordTimes(tWAIT, tImg)
         if self.logger.getEffectiveLevel() >= logging.DEBUG:
             tTOT = 1000.0*(time.time()-t)
             self.logger.debug("toImage (%dx%d) took %f msec. (array req: %f, wait: %f, img: %f)" % (img.width(), img.height(), tTOT, tAR, tWAIT, tImg))
 
         return img 
+
+    def _indexedImage( self, a ):
+        n = len(self._colorTable)
+        if a.dtype != np.uint8 or n < 2**8:
+            # labels beyond the colortable wrap around, as in
+            # vigra.colors.applyColortable
+            a = np.remainder(a, n).astype(np.uint8)
+        img = get_image_pool().acquire(a.shape[1], a.shape[0], QImage.Format_Indexed8)
+        img.setColorTable(self._palette)
+        byte_view(img)[:,:,0] = a
+        return img
             
     def notify( self, callback, **kwargs ):
         self._arrayreq.notify(self._onNotify, package = (callback, kwargs))
@@ -511,10 +660,14 @@ class RGBAImageSource( ImageSource ):
 
         super(RGBAImageSource, self).__init__( guarantees_opaqueness = guarantees_opaqueness )
         self._channels = channels
+        self._cacheChannels = len(channels)
         for arraySource in self._channels:
             arraySource.isDirty.connect(self.setDirty)
 
-    def request( self, qrect, along_through=None ):
+    def supportsStridedReads( self ):
+        return all(supportsStridedReads(channel) for channel in self._channels)
+
+    def request( self, qrect, along_through=None, level=0 ):
         if cfg.getboolean('pixelpipeline', 'verbose'):
             volumina.printLock.acquire()
             print Fore.RED + "  RGBAImageSource '%s' requests (x=%d, y=%d, w=%d, h=%d)" \
@@ -523,11 +676,9 @@ class RGBAImageSource( ImageSource ):
             volumina.printLock.release()
             
         assert isinstance(qrect, QRect)
-        s = rect2slicing( qrect )
-        r = self._channels[0].request(s, along_through)
-        g = self._channels[1].request(s, along_through)
-        b = self._channels[2].request(s, along_through)
-        a = self._channels[3].request(s, along_through)
+        s = self._slicing(qrect, level)
+        r, g, b, a = [self._cachedRequest(channel, s, along_through, i)
+                      for i, channel in enumerate(self._channels)]
         shape = list( slicing2shape(s) )
         assert len(shape) == 2
         assert all([x > 0 for x in shape])
@@ -545,9 +696,19 @@ class RGBAImageRequest( object ):
         self._requestsFinished = 4 * [False,]
 
     def wait(self):
+        tWAIT = time.time()
         for req in self._requests:
             req.wait()
-        return self.toImage()
+        tWAIT = 1000.0*(time.time()-tWAIT)
+        tImg = time.time()
+        img = self.toImage()
+        tImg = 1000.0*(time.time()-tImg)
+        _recordTimes(tWAIT, tImg)
+        return img
+
+    def cancel(self):
+        for req in self._requests:
+            req.cancel()
 
     def toImage( self ):
         for i, req in enumerate(self._requests):
@@ -584,9 +745,12 @@ assert issubclass(RGBAImageRequest, RequestABC)
 
 class RandomImageSource( ImageSource ):
     '''Random noise image for testing and debugging.'''
-    def request( self, qrect, along_through=None ):
+    def supportsStridedReads( self ):
+        return True
+
+    def request( self, qrect, along_through=None, level=0 ):
         assert isinstance(qrect, QRect)
-        s = rect2slicing(qrect)
+        s = self._slicing(qrect, level)
         shape = slicing2shape( s )
         return RandomImageRequest( shape )
 assert issubclass(RandomImageSource, SourceABC)
@@ -600,6 +764,9 @@ class RandomImageRequest( object ):
         assert d.ndim == 2
         img = gray2qimage(d)
         return img.convertToFormat(QImage.Format_ARGB32_Premultiplied)
+
+    def cancel(self):
+        pass
             
     def notify( self, callback, **kwargs ):
         img = self.wait()
@@ -0,0 +1,260 @@
+###############################################################################
+#   volumina: volume slicing and editing library
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the Lesser GNU General Public License
+# as published by the Free Software Foundation; either version 2.1
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# See the files LICENSE.lgpl2 and LICENSE.lgpl3 for full text of the
+# GNU Lesser General Public License version 2.1 and 3 respectively.
+# This information is also available on the ilastik web site at:
+#		   http://ilastik.org/license/
+###############################################################################
+import threading
+import weakref
+from collections import OrderedDict
+
+import numpy as np
+
+from volumina.config import cfg
+from volumina.metrics import get_metrics
+from volumina.pixelpipeline.tilestore import _key, _intersects
+
+#*******************************************************************************
+# I d e n t i t y T o k e n s                                                  *
+#*******************************************************************************
+
+class IdentityTokens(object):
+    """
+    Hashable tokens standing for the identity of (possibly unhashable)
+    objects such as numpy arrays or lazyflow slots.
+
+    The same object always gets the same token while it is alive; a token
+    is never reused, so that entries cached for a garbage collected object
+    cannot be mistaken for those of a new object at the same address.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._tokens = {} # id(obj) -> (weakref to obj, token)
+        self._next = 0
+
+    def token(self, obj):
+        with self._lock:
+            entry = self._tokens.get(id(obj))
+            if entry is not None and entry[0]() is obj:
+                return entry[1]
+            self._next += 1
+            ref = weakref.ref(obj, lambda ref, i=id(obj): self._drop(i, ref))
+            self._tokens[id(obj)] = (ref, self._next)
+            return self._next
+
+    def _drop(self, i, ref):
+        with self._lock:
+            entry = self._tokens.get(i)
+            if entry is not None and entry[0] is ref:
+                del self._tokens[i]
+
+identity_tokens = IdentityTokens()
+
+def identityToken(obj):
+    '''Token for the identity of obj, or None if obj cannot be weakly referenced.'''
+    try:
+        return identity_tokens.token(obj)
+    except TypeError:
+        return None
+
+#*******************************************************************************
+# S h a r e d A r r a y C a c h e                                              *
+#*******************************************************************************
+
+class _Fetch(object):
+    # a request in flight, whose result other requesters wait for
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+
+class SharedArrayCache(object):
+    """
+    Process-wide in-memory cache of the arrays requested from datasources.
+
+    Arrays are addressed by content: by the cache key of the datasource
+    (see cachedRequest), which is the same for all datasource objects
+    wrapping the same data, and by the 5D slicing. The views of a
+    VolumeEditor and linked editors showing the same data at the same
+    position therefore fetch it once. Concurrent requests for the same
+    array wait for the first one instead of fetching it again.
+
+    The least recently used arrays are dropped once the total exceeds
+    maxbytes. Masked arrays are not cached, nor are views of larger arrays
+    (e.g. of an in-memory ArraySource): they are cheap to request again,
+    and would keep their whole base array alive. Hits and misses are counted
+    in the metrics as <name>_hits, <name>_misses and <name>_coalesced.
+    """
+    def __init__(self, maxbytes, name='shared_cache'):
+        self.maxbytes = maxbytes
+        self.name = name
+        self._lock = threading.Lock()
+        self._entries = OrderedDict() # (key, slicing key) -> array, LRU first
+        self._bytes = 0
+        self._fetches = {} # (key, slicing key) -> _Fetch
+        # key -> number of invalidations, such that fetches started before
+        # an invalidation do not store outdated data
+        self._generations = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def usedBytes(self):
+        return self._bytes
+
+    def fetch(self, key, slicing, request):
+        '''Result of request, which requests slicing from the data
+        identified by key, unless it is cached or already being fetched.'''
+        entry = (key, _key(slicing))
+        metrics = get_metrics()
+        while True:
+            with self._lock:
+                result = self._entries.get(entry)
+                if result is not None:
+                    self._entries[entry] = self._entries.pop(entry)
+                    metrics.increment(self.name + '_hits')
+                    return result
+                fetch = self._fetches.get(entry)
+                if fetch is None:
+                    fetch = self._fetches[entry] = _Fetch()
+                    generation = self._generations.get(key, 0)
+                    break
+            fetch.done.wait()
+            if fetch.result is not None:
+                metrics.increment(self.name + '_coalesced')
+                return fetch.result
+            # the first request failed, try again with our own
+
+        metrics.increment(self.name + '_misses')
+        result = None
+        try:
+            result = request.wait()
+        finally:
+            with self._lock:
+                del self._fetches[entry]
+                if result is not None and not isinstance(result, np.ma.MaskedArray) \
+                   and not _isView(result) \
+                   and generation == self._generations.get(key, 0):
+                    self._add(entry, result)
+            fetch.result = result
+            fetch.done.set()
+        return result
+
+    def invalidate(self, key, slicing):
+        '''Drop the arrays of key intersecting slicing, where slice(None)
+        matches everything along that axis.'''
+        slicingKey = _key(slicing)
+        with self._lock:
+            self._generations[key] = self._generations.get(key, 0) + 1
+            for entry in [e for e in self._entries
+                          if e[0] == key and _intersects(e[1], slicingKey)]:
+                self._bytes -= self._entries.pop(entry).nbytes
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def _add(self, entry, array):
+        old = self._entries.pop(entry, None)
+        if old is not None:
+            self._bytes -= old.nbytes
+        self._entries[entry] = array
+        self._bytes += array.nbytes
+        while self._bytes > self.maxbytes and self._entries:
+            old_entry, old = self._entries.popitem(False)
+            self._bytes -= old.nbytes
+
+def _isView(array):
+    base = getattr(array, 'base', None)
+    return isinstance(base, np.ndarray) and base.nbytes > array.nbytes
+
+shared_array_cache = None
+
+def get_shared_array_cache():
+    global shared_array_cache
+    if shared_array_cache is None:
+        megabytes = cfg.getint('pixelpipeline', 'shared_cache_megabytes')
+        shared_array_cache = SharedArrayCache(megabytes * 2**20)
+    return shared_array_cache
+
+#*******************************************************************************
+# S h a r e d C a c h e R e q u e s t                                          *
+#*******************************************************************************
+
+class SharedCacheRequest(object):
+    def __init__(self, cache, key, slicing, request):
+        self._cache = cache
+        self._key = key
+        self._slicing = slicing
+        self._request = request
+        self._result = None
+
+    def wait(self):
+        if self._result is None:
+            self._result = self._cache.fetch(self._key, self._slicing, self._request)
+        return self._result
+
+    def getResult(self):
+        return self._result
+
+    def cancel(self):
+        self._request.cancel()
+
+    def submit(self):
+        pass
+
+    def adjustPriority(self, delta):
+        adjust = getattr(self._request, 'adjustPriority', None)
+        if adjust is not None:
+            adjust(delta)
+        return self
+
+    # callback( result = result, **kwargs )
+    def notify(self, callback, **kwargs):
+        t = threading.Thread(target=self._doNotify, args=( callback, kwargs ))
+        t.start()
+
+    def _doNotify(self, callback, kwargs):
+        result = self.wait()
+        callback(result, **kwargs)
+
+def _cacheKey(datasource):
+    cacheKey = getattr(datasource, 'cacheKey', None)
+    return cacheKey() if cacheKey is not None else None
+
+def cachedRequest(datasource, slicing):
+    '''
+    datasource.request(slicing), shared with all other requests for the
+    same data through the process-wide SharedArrayCache.
+
+    Datasources take part by implementing cacheKey(), which returns a
+    hashable identifying their data (e.g. an identityToken() of the
+    underlying array), or None if their results must not be shared.
+    '''
+    request = datasource.request(slicing)
+    cache = get_shared_array_cache()
+    key = _cacheKey(datasource)
+    if key is None or cache.maxbytes <= 0:
+        return request
+    return SharedCacheRequest(cache, key, slicing, request)
+
+def invalidateShared(datasource, slicing):
+    '''Drop the shared arrays of datasource that intersect slicing.'''
+    key = _cacheKey(datasource)
+    if key is not None:
+        get_shared_array_cache().invalidate(key, slicing)
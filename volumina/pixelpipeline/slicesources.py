@@ -24,6 +24,8 @@ from asyncabcs import SourceABC, RequestABC
 import numpy as np
 import volumina
 from volumina.slicingtools import SliceProjection, is_pure_slicing, intersection, sl
+from volumina.pixelpipeline.sharedcache import cachedRequest
+from volumina.pixelpipeline.datasources import supportsStridedReads
 from volumina.colorama import Fore
 
 projectionAlongTXC = SliceProjection( abscissa = 2, ordinate = 3, along = [0,1,4] )
@@ -109,6 +111,9 @@ class SliceSource( QObject ):
         through[index] = value
         self.through = through
 
+    def supportsStridedReads( self ):
+        return supportsStridedReads(self._datasource)
+
     def request( self, slicing2D, along_through=None ):
         '''Return a SliceRequest for a subregion of the slice.
 
@@ -140,7 +145,7 @@ class SliceSource( QObject ):
             volumina.printLock.acquire()
             print Fore.RED + "SliceSource requests '%r' from data source '%s'" % (slicing, self._datasource.name) + Fore.RESET
             volumina.printLock.release()
-        return SliceRequest(self._datasource.request(slicing), self.sliceProjection)
+        return SliceRequest(cachedRequest(self._datasource, slicing), self.sliceProjection)
         
     def setDirty( self, slicing ):
         assert isinstance(slicing, tuple)
@@ -0,0 +1,250 @@
+###############################################################################
+#   volumina: volume slicing and editing library
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the Lesser GNU General Public License
+# as published by the Free Software Foundation; either version 2.1
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# See the files LICENSE.lgpl2 and LICENSE.lgpl3 for full text of the
+# GNU Lesser General Public License version 2.1 and 3 respectively.
+# This information is also available on the ilastik web site at:
+#		   http://ilastik.org/license/
+###############################################################################
+import os
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from volumina.config import cfg
+
+import logging
+logger = logging.getLogger(__name__)
+
+#*******************************************************************************
+# T i l e S t o r e                                                            *
+#*******************************************************************************
+
+class TileStore(object):
+    """
+    On-disk store of the arrays requested from datasources.
+
+    Every array is kept in a .npy file named after its slicing, below a
+    directory per namespace, e.g.
+
+        <directory>/<namespace>/0.1._0.256._256.512._0.1._0.1.npy
+
+    where the namespace identifies a datasource and the version of its
+    data (see DiskCacheSource). The store survives the session; it is
+    indexed on construction and the least recently used files are deleted
+    once the total size exceeds maxbytes. Directories are created private
+    to the user, and files are loaded without unpickling objects.
+
+    Files are written to a temporary file first. Temporary files left over
+    by interrupted writes are deleted once they are older than TMP_GRACE
+    seconds, younger ones may belong to a write in progress in another
+    process.
+    """
+    SUFFIX = '.npy'
+    TMP_SUFFIX = '.tmp'
+    TMP_GRACE = 3600
+
+    def __init__(self, directory, maxbytes):
+        self.directory = directory
+        self.maxbytes = maxbytes
+        self._lock = threading.Lock()
+        self._files = OrderedDict()  # path -> bytes, least recently used first
+        self._bytes = 0
+        # namespace -> {key: path}, see _key
+        self._index = {}
+        if not os.path.isdir(directory):
+            os.makedirs(directory, 0o700)
+        self._scan()
+
+    def __len__(self):
+        return len(self._files)
+
+    def usedBytes(self):
+        return self._bytes
+
+    def get(self, namespace, slicing):
+        '''Return the array stored for slicing, or None.'''
+        with self._lock:
+            path = self._index.get(namespace, {}).get(_key(slicing))
+            if path is None:
+                return None
+            self._files[path] = self._files.pop(path)
+        try:
+            return np.load(path, allow_pickle=False)
+        except (IOError, ValueError):
+            # deleted by another process, truncated, or holding objects
+            with self._lock:
+                self._forget(path)
+            return None
+
+    def put(self, namespace, slicing, array):
+        path = os.path.join(self.directory, namespace, _encode(slicing))
+        tmp = '%s.%d.%d%s' % (path, os.getpid(), threading.current_thread().ident,
+                              self.TMP_SUFFIX)
+        try:
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path), 0o700)
+            with open(tmp, 'wb') as f:
+                np.save(f, np.ascontiguousarray(array))
+            os.rename(tmp, path)
+        except (IOError, OSError):
+            logger.warning("Could not write tile %s" % path, exc_info=True)
+            return
+        with self._lock:
+            self._forget(path)
+            self._add(namespace, _key(slicing), path, os.path.getsize(path))
+            self._evict()
+
+    def invalidate(self, namespace, slicing):
+        '''Delete the arrays of namespace that intersect slicing, where
+        slice(None) matches everything along that axis.'''
+        key = _key(slicing)
+        with self._lock:
+            entries = self._index.get(namespace, {})
+            for stored, path in entries.items():
+                if _intersects(stored, key):
+                    self._delete(path)
+
+    def purge(self, prefix, keep=None):
+        '''Delete all namespaces starting with prefix, except keep.'''
+        with self._lock:
+            for namespace in self._index.keys():
+                if namespace.startswith(prefix) and namespace != keep:
+                    for path in self._index[namespace].values():
+                        self._delete(path)
+                    del self._index[namespace]
+                    nsdir = os.path.join(self.directory, namespace)
+                    self._removeLeftovers(nsdir)
+                    try:
+                        # unless another process is still writing to it
+                        os.rmdir(nsdir)
+                    except OSError:
+                        pass
+
+    def _removeLeftovers(self, nsdir):
+        # temporary files of interrupted writes, see TMP_GRACE
+        expired = time.time() - self.TMP_GRACE
+        try:
+            names = os.listdir(nsdir)
+        except OSError:
+            return
+        for name in names:
+            if not name.endswith(self.TMP_SUFFIX):
+                continue
+            path = os.path.join(nsdir, name)
+            try:
+                if os.stat(path).st_mtime < expired:
+                    os.remove(path)
+            except OSError:
+                pass
+
+    def _scan(self):
+        found = []
+        for namespace in os.listdir(self.directory):
+            nsdir = os.path.join(self.directory, namespace)
+            if not os.path.isdir(nsdir):
+                continue
+            self._removeLeftovers(nsdir)
+            for name in os.listdir(nsdir):
+                path = os.path.join(nsdir, name)
+                if not name.endswith(self.SUFFIX):
+                    continue
+                try:
+                    key = _decode(name)
+                except ValueError:
+                    continue
+                stat = os.stat(path)
+                found.append((stat.st_mtime, namespace, key, path, stat.st_size))
+        for mtime, namespace, key, path, nbytes in sorted(found):
+            self._add(namespace, key, path, nbytes)
+        self._evict()
+
+    def _add(self, namespace, key, path, nbytes):
+        self._index.setdefault(namespace, {})[key] = path
+        self._files[path] = nbytes
+        self._bytes += nbytes
+
+    def _forget(self, path):
+        nbytes = self._files.pop(path, None)
+        if nbytes is None:
+            return
+        self._bytes -= nbytes
+        nsdir, name = os.path.split(path)
+        entries = self._index.get(os.path.basename(nsdir), {})
+        entries.pop(_decode(name), None)
+
+    def _delete(self, path):
+        self._forget(path)
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def _evict(self):
+        while self._bytes > self.maxbytes and self._files:
+            self._delete(next(iter(self._files)))
+
+def _key(slicing):
+    # slices are not hashable
+    return tuple((s.start, s.stop, s.step) for s in slicing)
+
+def _encode(slicing):
+    def fmt(i):
+        return '' if i is None else str(i)
+    return '_'.join('%s.%s.%s' % tuple(fmt(i) for i in s)
+                    for s in _key(slicing)) + TileStore.SUFFIX
+
+def _decode(name):
+    '''Key of the slicing encoded in a file name.'''
+    def parse(i):
+        return None if i == '' else int(i)
+    key = []
+    for s in name[:-len(TileStore.SUFFIX)].split('_'):
+        start, stop, step = s.split('.')
+        key.append((parse(start), parse(stop), parse(step)))
+    return tuple(key)
+
+def _intersects(a, b):
+    for (start1, stop1, step1), (start2, stop2, step2) in zip(a, b):
+        if stop1 is not None and start2 is not None and stop1 <= start2:
+            return False
+        if stop2 is not None and start1 is not None and stop2 <= start1:
+            return False
+    return True
+
+def namespace(cacheId, version=None):
+    '''Directory name for the data of cacheId (any hashable with a stable
+    repr) at the given version.'''
+    name = hashlib.sha1(repr(cacheId)).hexdigest()[:16]
+    if version is None:
+        return name
+    return '%s-%s' % (name, hashlib.sha1(repr(version)).hexdigest()[:8])
+
+tile_store = None
+def get_tile_store():
+    global tile_store
+    if tile_store is None:
+        directory = cfg.get('pixelpipeline', 'disk_cache_directory')
+        if not directory:
+            # private to the user, unlike the system's temporary directory
+            cache = os.environ.get('XDG_CACHE_HOME') or os.path.join('~', '.cache')
+            directory = os.path.join(cache, 'volumina', 'tiles')
+        maxbytes = cfg.getint('pixelpipeline', 'disk_cache_megabytes') * 2**20
+        tile_store = TileStore(os.path.expanduser(directory), maxbytes)
+    return tile_store
@@ -120,9 +120,14 @@ def slicing2rect(slicing):
                  h.stop - h.start,
                  v.stop - v.start)
 
-def rect2slicing(qrect, seq=tuple):
-    result = seq((slice(qrect.x(), qrect.x() + qrect.width()),
-                  slice(qrect.y(), qrect.y() + qrect.height())))
+def rect2slicing(qrect, seq=tuple, step=None):
+    '''Convert a QRect into a pair of slices.
+
+    step -- optional stride of both slices (used to read downsampled data)
+
+    '''
+    result = seq((slice(qrect.x(), qrect.x() + qrect.width(), step),
+                  slice(qrect.y(), qrect.y() + qrect.height(), step)))
     return result
 
 def slicing2shape( slicing ):
@@ -130,9 +135,30 @@ def slicing2shape( slicing ):
     slicing = box(slicing)
     shape = []
     for sl in slicing:
-        shape.append(sl.stop - sl.start)
+        if sl.step is None or sl.step == 1:
+            shape.append(sl.stop - sl.start)
+        else:
+            shape.append(-((sl.start - sl.stop) // sl.step)) # ceil division
     return tuple(shape)
 
+def unstrided( slicing ):
+    '''Split a slicing into the bounding slicing without steps and the
+    slicing that applies the steps to the result of the former.
+
+    For example: (slice(0,8,2), slice(1,3)) => ((slice(0,8), slice(1,3)),
+                                              (slice(None,None,2), slice(None,None,None)))
+
+    '''
+    slicing = box(slicing)
+    bounds = tuple(slice(sl.start, sl.stop) for sl in slicing)
+    steps = tuple(slice(None, None, sl.step) for sl in slicing)
+    return bounds, steps
+
+def is_strided( slicing ):
+    '''For any dimension: step of slice is neither None nor 1'''
+    slicing = box(slicing)
+    return any(sl.step not in (None, 1) for sl in slicing)
+
 def index2slice( slicing ):
     '''Convert integer indices to proper slice instances.
 
@@ -259,6 +285,19 @@ class toolsTest( ut.TestCase ):
         pure = index2slice(sl[3:4,5,:,10])
         self.assertEqual(pure, sl[3:4,5:6,:,10:11])
 
+    def testStridedShape( self ):
+        a = np.zeros((10, 9))
+        for slicing in (sl[0:10:2, 0:9:2], sl[1:10:4, 3:9:3], sl[0:10, 0:9:8]):
+            self.assertEqual(slicing2shape(slicing), a[slicing].shape)
+
+    def testUnstrided( self ):
+        a = np.random.random((10, 9))
+        slicing = sl[1:10:4, 3:9:3]
+        bounds, steps = unstrided(slicing)
+        self.assertFalse(is_strided(bounds))
+        self.assertTrue(is_strided(slicing))
+        self.assertTrue(np.all(a[bounds][steps] == a[slicing]))
+
 class SliceProjectionTest( ut.TestCase ):
     def testArgumentCheck( self ):
         SliceProjection(1,2,[0,3,4])
@@ -21,23 +21,29 @@
 ###############################################################################
 #Python
 import sys
+import math
 import time
 import collections
+import heapq
 import threading
-from collections import defaultdict, OrderedDict
-
-#SciPy
-import numpy
+import weakref
+import multiprocessing
+from collections import OrderedDict
 
 #PyQt
-from PyQt4.QtCore import QRect, QRectF, QMutex, QObject, pyqtSignal
+from PyQt4.QtCore import QPointF, QRect, QRectF, QSize, QMutex, QObject, pyqtSignal
 from PyQt4.QtGui import QImage, QPainter, QTransform
+from qimage2ndarray import byte_view
 
 #volumina
 from patchAccessor import PatchAccessor
 import volumina
 from volumina.pixelpipeline.asyncabcs import IndeterminateRequestError
+from volumina.pixelpipeline.imagepool import get_image_pool
 from volumina.utility import log_exception
+from volumina.config import cfg
+from volumina import metrics
+from volumina.metrics import get_metrics, labelled, layerLabel
 
 from concurrent.futures.thread import ThreadPoolExecutor, _WorkItem
 from concurrent.futures import _base
@@ -51,7 +57,7 @@ logger = logging.getLogger(__name__)
 class RenderTask(_WorkItem):
     def __init__(self, f, prefetch, timestamp,
             tile_provider, ims, transform, tile_nr, stack_id, image_req,
-            cache):
+            cache, generation=None, preview=False, rect=None):
         super(RenderTask, self).__init__(f, self._render, [], {})
 
         self.prefetch = prefetch
@@ -65,6 +71,65 @@ class RenderTask(_WorkItem):
         self.image_req = image_req
         self.timestamp = timestamp
         self.cache = cache
+        # a preview task renders a downsampled version of the layer tile,
+        # which is shown until the full resolution tile is done
+        self.preview = preview
+        # the data rectangle rendered by a partial update of a cached layer
+        # tile, see _TilesCache.setLayerDirtyRectAllStacks(); None for the
+        # whole tile
+        self.rect = rect
+        # identifies the task in the tile provider's in-flight registry;
+        # generation changes whenever the layer's data becomes dirty
+        self.key = (stack_id, ims, tile_nr, generation, preview)
+        self.queued = time.time()
+
+        # register before the task is queued, so that the tile provider can
+        # cancel it until it is done
+        tile_provider._addTask(self)
+
+    def isStale(self):
+        """
+        Whether the tile rendered by this task is of no use anymore, i.e.
+        its stack was evicted from the cache (or the cache was replaced),
+        or it is a regular (not prefetch) task for a stack that is no
+        longer the current one.
+        """
+        if self.cache is not self.tile_provider._cache:
+            return True
+        if not self.prefetch and \
+           self.stack_id != self.tile_provider._current_stack_id:
+            return True
+        with self.cache:
+            if self.stack_id not in self.cache:
+                return True
+            # a preview is of no use once the full resolution tile is done
+            return self.preview and \
+                not self.cache.layerDirty(self.stack_id, self.ims, self.tile_nr)
+
+    def cancel(self):
+        """
+        Cancel the task unless it is already running or done.
+
+        Returns True if the task was cancelled.
+        """
+        if not self.future.cancel():
+            return False
+        self._drop()
+        return True
+
+    def _drop(self):
+        # Abort the underlying request and mark the tile dirty again, so
+        # that it is requested anew once its stack becomes visible.
+        self.tile_provider._removeTask(self)
+        cancel = getattr(self.image_req, 'cancel', None)
+        if cancel is not None:
+            cancel()
+        get_metrics().increment('tasks_cancelled', layerLabel(self.ims))
+        try:
+            with self.cache:
+                self.cache.setTileDirty(self.stack_id, self.tile_nr, True)
+        except KeyError:
+            pass
 
     def _render(self, *args, **kwds):
         """
@@ -77,7 +142,13 @@ class RenderTask(_WorkItem):
         # (If this is a new thread in the threadpool, we need to set the name.)
         if not threading.current_thread().name.startswith("TileProvider"):
             threading.current_thread().name = "TileProvider-" + str( threading.current_thread().ident )
-        
+
+        label = layerLabel(self.ims)
+        get_metrics().record(metrics.QUEUE_WAIT, time.time() - self.queued, label)
+        if self.isStale():
+            self._drop()
+            return
+
         try:
             try:
                 with self.cache:
@@ -87,12 +158,41 @@ class RenderTask(_WorkItem):
                 pass
 
             if self.timestamp > layerTimestamp:
-                img = self.image_req.wait()
-                img = img.transformed(self.transform)
+                start = time.time()
+                with labelled(label):
+                    img = self.image_req.wait()
+                    with get_metrics().timed(metrics.TRANSFORM):
+                        img = _layerImage(self.ims, img, self.transform)
+                if self.preview:
+                    # the upscaled image can be a few pixels too large
+                    size = self.tile_provider.tiling.imageSize(self.tile_nr)
+                    if img.size() != size:
+                        img = img.copy(QRect(0, 0, size.width(), size.height()))
+                    get_metrics().increment('previews_rendered', label)
+                elif self.rect is not None:
+                    # not representative of the time per tile
+                    get_metrics().increment('partial_tiles_rendered', label)
+                else:
+                    self._recordTime(time.time() - start)
+                    get_metrics().increment('tiles_rendered', label)
                 try:
+                    if self.rect is not None:
+                        # patch a copy before claiming the cache
+                        base, updated = self.cache.patchedLayer(self.stack_id,
+                            self.ims, self.tile_nr,
+                            self.tile_provider.tiling.dataRects[self.tile_nr],
+                            self.rect, img)
                     with self.cache:
-                        self.cache.updateTileIfNecessary(self.stack_id,
-                            self.ims, self.tile_nr, self.timestamp, img)
+                        if self.preview:
+                            self.cache.setLayerPreview(self.stack_id,
+                                self.ims, self.tile_nr, img)
+                        elif self.rect is not None:
+                            self.cache.updateTileRectIfNecessary(self.stack_id,
+                                self.ims, self.tile_nr, self.timestamp,
+                                self.rect, base, updated)
+                        else:
+                            self.cache.updateTileIfNecessary(self.stack_id,
+                                self.ims, self.tile_nr, self.timestamp, img)
                 except KeyError:
                     pass
 
@@ -102,6 +202,15 @@ class RenderTask(_WorkItem):
                         self.tile_provider.tiling.imageRects[self.tile_nr]))
         except BaseException:
             sys.excepthook( *sys.exc_info() )
+        finally:
+            self.tile_provider._removeTask(self)
+
+    def _recordTime(self, seconds):
+        layer = getattr(self.ims, '_layer', None)
+        if layer is not None:
+            layer.timePerTile(seconds,
+                              self.tile_provider.tiling.imageRects[self.tile_nr])
+        get_render_pool().recordTaskTime(seconds)
 
     def __lt__(self, other):
         """
@@ -110,19 +219,95 @@ class RenderTask(_WorkItem):
         Regular render tasks have higher priority than prefetch tasks. A task
         with higher timestamp has higher priority.
         """
+        if other is None:
+            # None wakes up the workers (see RenderTaskExecutor.resize) and
+            # goes first
+            return False
         assert isinstance(self, RenderTask) and isinstance(other, RenderTask), \
             "Can't compare {} with {}".format( type(self), type(other) )
         res = cmp(self.prefetch, other.prefetch)
         if res != 0:
-            return res
+            return res < 0
         # note reversed order for timestamp
-        return cmp(other.timestamp, self.timestamp)
+        return cmp(other.timestamp, self.timestamp) < 0
+
+
+def _layerImage(ims, img, transform):
+    """
+    Prepare a layer tile rendered by ims for the tiles cache.
+
+    Tiles are cached in the orientation of the image sources, so transform
+    is the identity except for previews, which are scaled up to the tile
+    size (img is given back to the image pool then). Indexed images get
+    the current palette of ims, which may have changed while they were
+    rendered.
+    """
+    if not transform.isIdentity():
+        out = img.transformed(transform)
+        get_image_pool().release(img)
+        img = out
+    palette = getattr(ims, 'palette', None)
+    if palette is not None and img.format() == QImage.Format_Indexed8:
+        img.setColorTable(palette())
+    return img
+
+def _recolored(stale):
+    """
+    Copies of the layer tile images listed by _TilesCache.staleLayers()
+    with their new palette, as expected by _TilesCache.replaceLayers().
+    """
+    replacements = []
+    for layer_id, tile_id, img, palette in stale:
+        recolored = QImage(img)
+        recolored.setColorTable(palette)
+        replacements.append((layer_id, tile_id, img, recolored))
+    return replacements
+
+def _cpu_count():
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 2
 
 
 class RenderTaskExecutor(ThreadPoolExecutor):
-    def __init__(self, max_workers):
+    '''Thread pool that runs RenderTasks in priority order.
+
+    The number of worker threads can be changed at runtime with resize().
+    With autosize enabled, the pool sizes itself to the work load: it
+    aims at having enough workers to process the queued tasks within
+    DRAIN_TIME seconds, but never more than max_auto_workers (default: the
+    number of CPUs) and never less than min_workers. A task is expected
+    to take the average time per tile of its layer (see
+    Layer.timePerTile), or the measured time per task if its layer was not
+    timed yet. The pool grows immediately and shrinks at most every
+    SHRINK_DELAY seconds. It is not resized before the first task was
+    timed.
+
+    '''
+
+    DRAIN_TIME = 0.25
+    SHRINK_DELAY = 2.0
+
+    def __init__(self, max_workers, autosize=False, min_workers=2,
+                 max_auto_workers=None):
         super(RenderTaskExecutor, self).__init__(max_workers)
         self._work_queue = Queue.PriorityQueue()
+        self._resize_lock = threading.Lock()
+        self.autosize = autosize
+        self._min_workers = min_workers
+        self._max_auto_workers = max_auto_workers or _cpu_count()
+        # exponential moving average of the time per task, seeded with
+        # the first measurement; None as long as no task was timed
+        self._timePerTask = None
+        self._lastShrink = time.time()
+        # the backlog, i.e. the tasks that are neither done nor cancelled:
+        # their number, the sum of the expected seconds of those whose
+        # layer was timed, and the number of the others
+        self._countLock = threading.Lock()
+        self._liveTasks = 0
+        self._liveSeconds = 0.0
+        self._untimedTasks = 0
 
     def submit(self, *args):
         with self._shutdown_lock:
@@ -132,17 +317,150 @@ class RenderTaskExecutor(ThreadPoolExecutor):
             f = _base.Future()
             w = RenderTask(f, *args)
 
+            self._taskQueued(w)
             self._work_queue.put(w)
+            if self.autosize:
+                self._autosize()
             self._adjust_thread_count()
             return f
 
+    def maxWorkers(self):
+        return self._max_workers
+
+    def resize(self, max_workers=None):
+        '''Set the number of worker threads.
+
+        This disables autosizing; pass None to re-enable it.
+
+        '''
+        self.autosize = max_workers is None
+        if max_workers is not None:
+            self._resize(max_workers)
+            with self._shutdown_lock:
+                if not self._shutdown and self._work_queue.qsize():
+                    self._adjust_thread_count()
+
+    def _resize(self, max_workers):
+        assert max_workers > 0
+        with self._resize_lock:
+            self._max_workers = max_workers
+            excess = len(self._threads) - max_workers
+        # wake up idle workers, such that the superfluous ones retire
+        for i in range(excess):
+            self._work_queue.put(None)
+
+    def recordTaskTime(self, seconds):
+        if self._timePerTask is None:
+            self._timePerTask = seconds
+        else:
+            self._timePerTask += 0.1 * (seconds - self._timePerTask)
+
+    def tilesPerSecond(self):
+        '''Estimated throughput of the workers, or None as long as no
+        task was timed.'''
+        if not self._timePerTask:
+            return None
+        return self._max_workers / self._timePerTask
+
+    def queuedTasks(self):
+        '''Number of submitted tasks that are neither done nor cancelled.'''
+        return self._liveTasks
+
+    def suggestedWorkers(self):
+        '''Number of workers that process the queued tasks within
+        DRAIN_TIME seconds, clamped to [min_workers, max_auto_workers],
+        or None as long as no task was timed.'''
+        if self._timePerTask is None:
+            return None
+        with self._countLock:
+            seconds = self._liveSeconds + self._untimedTasks * self._timePerTask
+        wanted = int(math.ceil(seconds / self.DRAIN_TIME))
+        return max(self._min_workers, min(self._max_auto_workers, wanted))
+
+    def _taskQueued(self, task):
+        # count the task into the backlog until its future is done or
+        # cancelled, such that sizing the pool does not walk the queue
+        layer = getattr(task.ims, '_layer', None)
+        seconds = getattr(layer, 'averageTimePerTile', 0.0) or None
+        with self._countLock:
+            self._liveTasks += 1
+            if seconds is None:
+                self._untimedTasks += 1
+            else:
+                self._liveSeconds += seconds
+        task.future.add_done_callback(lambda f: self._taskDone(seconds))
+
+    def _taskDone(self, seconds):
+        with self._countLock:
+            self._liveTasks -= 1
+            if seconds is None:
+                self._untimedTasks -= 1
+            else:
+                self._liveSeconds -= seconds
+            if self._liveTasks == self._untimedTasks:
+                # no rounding errors piling up
+                self._liveSeconds = 0.0
+
+    def _autosize(self):
+        n = self.suggestedWorkers()
+        if n is None:
+            return
+        if n > self._max_workers:
+            self._resize(n)
+        elif n < self._max_workers:
+            now = time.time()
+            if now - self._lastShrink > self.SHRINK_DELAY:
+                self._lastShrink = now
+                self._resize(n)
+
+    def _adjust_thread_count(self):
+        with self._resize_lock:
+            while len(self._threads) < self._max_workers:
+                t = threading.Thread(target=self._work)
+                t.daemon = True
+                self._threads.add(t)
+                t.start()
+
+    def _work(self):
+        thread = threading.current_thread()
+        while True:
+            task = self._work_queue.get(block=True)
+            if task is not None:
+                task.run()
+                del task
+            if self._shutdown:
+                # wake up the other workers
+                self._work_queue.put(None)
+                return
+            with self._resize_lock:
+                if len(self._threads) > self._max_workers:
+                    self._threads.discard(thread)
+                    return
+
+    def purgeCancelled(self):
+        """
+        Remove cancelled tasks from the queue.
+
+        Cancelled tasks are skipped by the worker threads anyway; purging
+        them keeps the queue short after many tasks became stale at once.
+        """
+        q = self._work_queue
+        with q.mutex:
+            q.queue = [w for w in q.queue
+                       if w is None or not w.future.cancelled()]
+            heapq.heapify(q.queue)
+
 
 renderer_pool = None
 
 def get_render_pool():
     global renderer_pool
     if renderer_pool is None:
-        renderer_pool = RenderTaskExecutor(6)
+        n_threads = cfg.getint('pixelpipeline', 'render_threads')
+        if n_threads > 0:
+            renderer_pool = RenderTaskExecutor(n_threads)
+        else:
+            renderer_pool = RenderTaskExecutor(min(6, _cpu_count()), autosize=True)
     return renderer_pool
 
 #*******************************************************************************
@@ -193,6 +511,43 @@ class ImageTile(object):
         self._mutex.unlock()
 
 
+class _TileRects(object):
+    '''Read-only sequence view of one kind of per-tile rectangle of a Tiling.
+
+    The rectangles are computed on first access (see Tiling._rects) instead
+    of being precomputed for all tiles, so that slices with very many tiles
+    are cheap to set up.
+
+    '''
+
+    def __init__(self, tiling, kind):
+        self._tiling = tiling
+        self._kind = kind
+
+    def __len__(self):
+        return len(self._tiling)
+
+    def __getitem__(self, i):
+        n = len(self._tiling)
+        if i < 0:
+            i += n
+        if not 0 <= i < n:
+            raise IndexError("tile index %r out of range" % i)
+        return self._tiling._rects(i)[self._kind]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return "<_TileRects of %d tiles>" % len(self)
+
 class Tiling(object):
     '''Tiling.__init__()
 
@@ -203,28 +558,47 @@ class Tiling(object):
     blockSize  -- base tile size: blockSize x blockSize (default 256)
     overlap    -- overlap between tiles positive number prevents rendering
                   artifacts between tiles for certain zoom levels (default 1)
+    level      -- pyramid level (default 0); at level k each tile covers
+                  (blockSize*2**k)^2 data pixels, but its image is rendered
+                  from data read with a stride of 2**k, i.e. it has at most
+                  blockSize x blockSize pixels. Used for zoomed out views.
+
+    The tile geometry is not stored per tile: tile numbers are computed
+    arithmetically from the patch accessor and the rectangles in
+    imageRectFs, tileRectFs, imageRects and tileRects (in scene coordinates)
+    and dataRectFs and dataRects (in data coordinates) are computed (and
+    memoized) on access. Setting up a tiling or changing its data2scene
+    transform is therefore independent of the number of tiles.
+
+    Tile images are kept in the orientation in which the image sources
+    render them (see imageSize()); imageTransform() maps them to the scene.
+    Changing data2scene (i.e. rotating or swapping the axes of a view)
+    does not change the tile images.
 
     '''
 
+    # indices into the tuples returned by _rects()
+    _IMAGE_RECTF, _TILE_RECTF, _IMAGE_RECT, _TILE_RECT, _DATA_RECTF, _DATA_RECT = range(6)
+
     def __init__(self, sliceShape, data2scene=QTransform(),
                  blockSize=256, overlap=0, overlap_draw=1e-3,
-                 name="Unnamed Tiling"):
+                 name="Unnamed Tiling", level=0):
+        self.level = level
+        self.downsampling = 2**level
         self.blockSize = blockSize
         self.overlap = overlap
         self._patchAccessor = PatchAccessor(sliceShape[0],
                                             sliceShape[1],
-                                            blockSize=self.blockSize)
+                                            blockSize=self.blockSize*self.downsampling)
         self._overlap_draw = overlap_draw
         self._overlap = overlap
 
-        numPatches = self._patchAccessor.patchCount
-
-        self.imageRectFs = [None]*numPatches
-        self.dataRectFs  = [None]*numPatches
-        self.tileRectFs  = [None]*numPatches
-        self.imageRects  = [None]*numPatches
-        self.dataRects   = [None]*numPatches
-        self.tileRects   = [None]*numPatches
+        self.imageRectFs = _TileRects(self, self._IMAGE_RECTF)
+        self.dataRectFs  = _TileRects(self, self._DATA_RECTF)
+        self.tileRectFs  = _TileRects(self, self._TILE_RECTF)
+        self.imageRects  = _TileRects(self, self._IMAGE_RECT)
+        self.dataRects   = _TileRects(self, self._DATA_RECT)
+        self.tileRects   = _TileRects(self, self._TILE_RECT)
         self.sliceShape  = sliceShape
         self.name = name
         self.data2scene = data2scene
@@ -238,49 +612,65 @@ class Tiling(object):
         self._data2scene = data2scene
         self.scene2data, isInvertible = data2scene.inverted()
         assert isInvertible
-
-        for patchNr in range(self._patchAccessor.patchCount):
-            # the patch accessor uses the data coordinate system.
-            # because the patch is drawn on the screen, its holds coordinates
-            # corresponding to Qt's QGraphicsScene's system, which need to be
-            # converted to scene coordinates
-
-            # the image rectangle includes an overlap margin
-            imageRectF = data2scene.mapRect(self._patchAccessor.patchRectF(patchNr, self.overlap))
-
-            # the patch rectangle has per default no overlap
-            patchRectF = data2scene.mapRect(self._patchAccessor.patchRectF(patchNr, 0))
-
-            # add a little overlap when the overlap_draw setting is
-            # activated
-            if self._overlap_draw != 0:
-                patchRectF = QRectF(patchRectF.x() - self._overlap_draw,
-                                    patchRectF.y() - self._overlap_draw,
-                                    patchRectF.width() + 2 * self._overlap_draw,
-                                    patchRectF.height() + 2 * self._overlap_draw)
-
-            patchRect = QRect(round(patchRectF.x()),
-                              round(patchRectF.y()),
-                              round(patchRectF.width()),
-                              round(patchRectF.height()))
-
-            # the image rectangles of neighboring patches can overlap
-            # slightly, to account for inaccuracies in sub-pixel
-            # rendering of many ImagePatch objects
-            imageRect = QRect(round(imageRectF.x()),
-                              round(imageRectF.y()),
-                              round(imageRectF.width()),
-                              round(imageRectF.height()))
-
-            self.imageRectFs[patchNr] = imageRectF
-            self.dataRectFs[ patchNr] = imageRectF
-            self.tileRectFs[ patchNr] = patchRectF
-            self.imageRects[ patchNr] = imageRect
-            self.tileRects[  patchNr] = patchRect
-
+        # rectangles of the previous transform are stale; they are
+        # recomputed lazily by _rects(). The transform and the cache of
+        # its rectangles are replaced by a single assignment, such that
+        # render threads never pair the cache with another transform
+        self._rectCache = (data2scene, {})
+
+    def _rects(self, patchNr):
+        '''(imageRectF, tileRectF, imageRect, tileRect) of tile patchNr'''
+        data2scene, cache = self._rectCache
+        rects = cache.get(patchNr)
+        if rects is not None:
+            return rects
+
+        # the patch accessor uses the data coordinate system.
+        # because the patch is drawn on the screen, its holds coordinates
+        # corresponding to Qt's QGraphicsScene's system, which need to be
+        # converted to scene coordinates
+
+        # the image rectangle includes an overlap margin
+        dataRectF = self._patchAccessor.patchRectF(patchNr, self.overlap)
+        imageRectF = data2scene.mapRect(dataRectF)
+
+        # the patch rectangle has per default no overlap
+        patchRectF = data2scene.mapRect(self._patchAccessor.patchRectF(patchNr, 0))
+
+        # add a little overlap when the overlap_draw setting is
+        # activated
+        if self._overlap_draw != 0:
+            patchRectF = QRectF(patchRectF.x() - self._overlap_draw,
+                                patchRectF.y() - self._overlap_draw,
+                                patchRectF.width() + 2 * self._overlap_draw,
+                                patchRectF.height() + 2 * self._overlap_draw)
+
+        patchRect = QRect(round(patchRectF.x()),
+                          round(patchRectF.y()),
+                          round(patchRectF.width()),
+                          round(patchRectF.height()))
+
+        # the image rectangles of neighboring patches can overlap
+        # slightly, to account for inaccuracies in sub-pixel
+        # rendering of many ImagePatch objects
+        imageRect = QRect(round(imageRectF.x()),
+                          round(imageRectF.y()),
+                          round(imageRectF.width()),
+                          round(imageRectF.height()))
+
+        dataRect = QRect(round(dataRectF.x()),
+                         round(dataRectF.y()),
+                         round(dataRectF.width()),
+                         round(dataRectF.height()))
+
+        rects = (imageRectF, patchRectF, imageRect, patchRect, dataRectF, dataRect)
+        # concurrent render threads may race here; for the same cache they
+        # compute the same value, so whichever assignment wins is fine
+        cache[patchNr] = rects
+        return rects
 
     def boundingRectF(self):
-        if self.tileRectFs:
+        if len(self):
             p = self.tileRectFs[-1]
             br = QRectF(0,0, p.x()+p.width(), p.y()+p.height())
         else:
@@ -288,23 +678,115 @@ class Tiling(object):
         return br
 
     def containsF(self, point):
-        for i, p in enumerate(self.tileRectFs):
-            if p.contains(point):
-                return i
+        p = self.scene2data.map(QPointF(point))
+        return self._patchAccessor.getPatchNumber(p.x(), p.y())
 
     def intersected(self, sceneRect):
         if not sceneRect.isValid():
-            return range(len(self.tileRects))
+            return range(len(self))
 
         # Patch accessor uses data coordinates
-        rect = self.data2scene.inverted()[0].mapRect(sceneRect)
+        rect = self.scene2data.mapRect(QRectF(sceneRect))
         patchNumbers = self._patchAccessor.getPatchesForRect(
                             rect.topLeft().x(), rect.topLeft().y(),
                             rect.bottomRight().x(), rect.bottomRight().y() )
         return patchNumbers
 
+    def imageSize(self, tile_nr):
+        '''Size of the image rendered for a tile.
+
+        The image sources render the region dataRects[tile_nr] of a slice
+        with its first axis as image rows, i.e. the image is the transpose
+        of the data rectangle. For pyramid levels > 0 the size is divided by
+        the downsampling factor (rounded up, just like a strided read of the
+        data).
+
+        '''
+        rect = self.dataRects[tile_nr]
+        size = QSize(rect.height(), rect.width())
+        if self.downsampling > 1:
+            f = self.downsampling
+            size = QSize(-(-size.width() // f), -(-size.height() // f))
+        return size
+
+    def imageTransform(self, tile_nr):
+        '''QTransform from the pixel coordinates of the image of a tile
+        (see imageSize()) to scene coordinates.
+
+        The image is transposed onto dataRects[tile_nr] (stretched by the
+        downsampling factor for pyramid levels > 0) and mapped to the scene
+        by data2scene.
+
+        '''
+        rect = self.dataRects[tile_nr]
+        size = self.imageSize(tile_nr)
+        sx = rect.height() / float(max(size.width(), 1))
+        sy = rect.width() / float(max(size.height(), 1))
+        return QTransform(0, sx, sy, 0, rect.x(), rect.y()) * self._data2scene
+
+    # range of block sizes considered by suggestedBlockSize()
+    MIN_BLOCKSIZE = 128
+    MAX_BLOCKSIZE = 1024
+    # rendering a tile should take between FAST_TILE and SLOW_TILE seconds:
+    # cheaper tiles are dominated by the per request overhead, more
+    # expensive ones delay the first visible result
+    FAST_TILE = 0.005
+    SLOW_TILE = 0.25
+
+    @staticmethod
+    def suggestedBlockSize(sliceShape, chunkShapes=(), timePerTile=None,
+                           blockSize=256):
+        '''Block size (a power of two) for tiling a slice of the given shape.
+
+        chunkShapes  -- 2D chunk shapes (in slice coordinates) of the data
+                        sources; tiles are made large enough to cover the
+                        largest chunk, such that a chunk is not read
+                        repeatedly for several tiles
+        timePerTile  -- measured time (in seconds) to render a tile of
+                        blockSize x blockSize pixels; tiles are resized
+                        (assuming a cost proportional to their area) to take
+                        between FAST_TILE and SLOW_TILE seconds
+
+        The result lies between MIN_BLOCKSIZE and MAX_BLOCKSIZE, and
+        is not larger than needed to cover the slice with a single tile.
+
+        '''
+        def powerOfTwo(n):
+            return 2**int(math.ceil(math.log(max(n, 1), 2)))
+        lower, upper = Tiling.MIN_BLOCKSIZE, Tiling.MAX_BLOCKSIZE
+
+        size = powerOfTwo(blockSize)
+        extents = [max(shape) for shape in chunkShapes if shape and max(shape) > 0]
+        if extents:
+            size = max(size, powerOfTwo(max(extents)))
+        if timePerTile:
+            timePerPixel = timePerTile / float(blockSize**2)
+            while size > lower and timePerPixel * size**2 > Tiling.SLOW_TILE:
+                size //= 2
+            while size < upper and timePerPixel * size**2 < Tiling.FAST_TILE:
+                size *= 2
+        size = min(size, powerOfTwo(max(sliceShape)))
+        return max(lower, min(size, upper))
+
+    @staticmethod
+    def levelForScale(scale, sliceShape, blockSize=256):
+        '''Pyramid level appropriate for drawing a slice at the given scale
+        (screen pixels per data pixel).
+
+        Each level halves the resolution, so the coarsest level that still
+        has at least one data sample per screen pixel is chosen. Levels are
+        capped such that the coarsest level consists of a single tile.
+
+        '''
+        if scale <= 0 or scale >= 1.0:
+            return 0
+        level = int(math.floor(math.log(1.0 / scale, 2)))
+        extent = max(max(sliceShape), 1)
+        max_level = max(0, int(math.ceil(math.log(float(extent) / blockSize, 2))))
+        return max(0, min(level, max_level))
+
     def __len__(self):
-        return len(self.imageRectFs)
+        return self._patchAccessor.patchCount
 
 #*******************************************************************************
 # T i l e d I m a g e L a y e r                                                *
@@ -327,46 +809,394 @@ class TiledImageLayer(object):
         for i in range(len(self._tiling)):
             yield self[i]
 
-class _MultiCache( object ):
-    def __init__( self, first_uid, default_factory=lambda:None,
-                  maxcaches=None ):
-        self._maxcaches = maxcaches
-        self.caches = OrderedDict()
-        self.add( first_uid, default_factory=default_factory)
-
-    def add( self, uid, default_factory=lambda:None ):
-        if uid not in self.caches:
-            cache = defaultdict(default_factory)
-            self.caches[uid] = cache
-        else:
-            raise Exception('MultiCache.add: uid %s is already in use' % str(uid))
+#*******************************************************************************
+# T i l e C a c h e M e m o r y                                                *
+#*******************************************************************************
+
+class TileCacheMemory( object ):
+    """
+    Process-wide accounting of the image bytes held by the tile caches.
+
+    Every image stored in a _TilesCache is registered here under the key
+    (stack_id, layer_id, tile_id) of its owning cache. Entries are kept in
+    least-recently-used order. Whenever the total exceeds maxBytes(), the
+    oldest entries are evicted from whichever cache owns them, so that all
+    views of a session share one memory budget.
+
+    Images of prefetched stacks the user has not visited yet are
+    speculative: they are evicted before any other image, until their stack
+    is visited and they are promoted (see promote()). A speculative image
+    only ever displaces other speculative ones; if there are none left, the
+    budget is exceeded until the next regular image is added, so prefetching
+    must stop when usedBytes() approaches maxBytes().
+    """
+    def __init__( self, maxbytes ):
+        # RLock: the weakref purge callback may be triggered by the garbage
+        # collector while this thread already holds the lock.
+        self._lock = threading.RLock()
+        self._entries = OrderedDict() # (cache ref, key) -> number of bytes
+        self._speculative = OrderedDict() # likewise, evicted first
+        self._nbytes = 0
+        self._speculativeBytes = 0
+        self._maxbytes = maxbytes
+
+    def maxBytes( self ):
+        return self._maxbytes
+
+    def setMaxBytes( self, maxbytes ):
+        with self._lock:
+            self._maxbytes = maxbytes
+            victims = self._popVictims()
+        self._evict(victims)
+
+    def usedBytes( self ):
+        return self._nbytes
+
+    def speculativeBytes( self ):
+        return self._speculativeBytes
+
+    def __len__( self ):
+        return len(self._entries) + len(self._speculative)
+
+    def register( self, cache ):
+        """
+        Return the handle under which the given cache registers its images.
+        Entries are dropped automatically when the cache is garbage collected.
+        """
+        return weakref.ref(cache, self._purge)
+
+    def add( self, ref, key, nbytes, speculative=False ):
+        """
+        Account nbytes for the given entry and mark it most recently used.
+        Returns the entries that must be evicted to stay within the budget.
+        The caller must evict those belonging to its own cache itself, see
+        _TilesCache._evictVictims().
+        """
+        with self._lock:
+            entry = (ref, key)
+            self._pop(entry)
+            if speculative:
+                self._speculative[entry] = nbytes
+                self._speculativeBytes += nbytes
+            else:
+                self._entries[entry] = nbytes
+            self._nbytes += nbytes
+            return self._popVictims(keep=entry)
+
+    def touch( self, ref, key ):
+        with self._lock:
+            entry = (ref, key)
+            for entries in (self._entries, self._speculative):
+                nbytes = entries.pop(entry, None)
+                if nbytes is not None:
+                    entries[entry] = nbytes
+
+    def promote( self, ref, keys ):
+        """
+        Turn the given speculative entries into regular, most recently
+        used ones.
+        """
+        with self._lock:
+            for key in keys:
+                entry = (ref, key)
+                nbytes = self._speculative.pop(entry, None)
+                if nbytes is not None:
+                    self._speculativeBytes -= nbytes
+                    self._entries[entry] = nbytes
+
+    def discard( self, ref, key ):
+        with self._lock:
+            self._pop((ref, key))
+
+    def _pop( self, entry ):
+        nbytes = self._entries.pop(entry, None)
+        if nbytes is None:
+            nbytes = self._speculative.pop(entry, 0)
+            self._speculativeBytes -= nbytes
+        self._nbytes -= nbytes
+
+    def _purge( self, ref ):
+        with self._lock:
+            for entries in (self._entries, self._speculative):
+                for entry in [e for e in entries if e[0] is ref]:
+                    self._pop(entry)
+
+    def _popVictims( self, keep=None ):
+        victims = []
+        pools = (self._speculative, self._entries)
+        if keep in self._speculative:
+            pools = (self._speculative,)
+        for entries in pools:
+            while self._nbytes > self._maxbytes and entries:
+                entry, nbytes = entries.popitem(False) # least recently used
+                if entry == keep:
+                    # never evict the entry that is being added
+                    entries[entry] = nbytes
+                    break
+                self._nbytes -= nbytes
+                if entries is self._speculative:
+                    self._speculativeBytes -= nbytes
+                victims.append(entry)
+        return victims
+
+    def _evict( self, victims ):
+        for ref, key in victims:
+            cache = ref()
+            if cache is not None:
+                cache.evictLater(key)
+
+tile_cache_memory = None
+
+def get_tile_cache_memory():
+    global tile_cache_memory
+    if tile_cache_memory is None:
+        megabytes = cfg.getint('pixelpipeline', 'tile_cache_megabytes')
+        tile_cache_memory = TileCacheMemory(megabytes * 2**20)
+    return tile_cache_memory
+
+#*******************************************************************************
+# S y s t e m M e m o r y                                                      *
+#*******************************************************************************
+
+class SystemMemory( object ):
+    """
+    Free system memory as reported by /proc/meminfo.
+
+    The system is considered under memory pressure while less than
+    minAvailable (a fraction of the total memory) is available. Readings
+    are cached for INTERVAL seconds; on systems without /proc/meminfo there
+    is never any pressure.
+    """
+    INTERVAL = 1.0
+
+    def __init__( self, minAvailable, meminfo='/proc/meminfo' ):
+        self._minAvailable = minAvailable
+        self._meminfo = meminfo
+        self._lock = threading.Lock()
+        self._checked = None
+        self._available = None
+
+    def availableFraction( self ):
+        """Available fraction of the total memory, or None if unknown."""
+        with self._lock:
+            now = time.time()
+            if self._checked is None or now - self._checked >= self.INTERVAL:
+                self._checked = now
+                self._available = self._read()
+            return self._available
+
+    def underPressure( self ):
+        available = self.availableFraction()
+        return available is not None and available < self._minAvailable
+
+    def _read( self ):
+        try:
+            with open(self._meminfo) as f:
+                info = {}
+                for line in f:
+                    fields = line.split()
+                    if len(fields) >= 2:
+                        info[fields[0].rstrip(':')] = int(fields[1])
+        except (IOError, ValueError):
+            return None
+        total = info.get('MemTotal')
+        if not total:
+            return None
+        available = info.get('MemAvailable')
+        if available is None:
+            # kernels before 3.14
+            available = sum(info.get(k, 0) for k in ('MemFree', 'Buffers', 'Cached'))
+        return available / float(total)
+
+system_memory = None
+
+def get_system_memory():
+    global system_memory
+    if system_memory is None:
+        percent = cfg.getint('pixelpipeline', 'prefetch_min_available_percent')
+        system_memory = SystemMemory(percent / 100.0)
+    return system_memory
+
+def _nbytes( img ):
+    if img is None:
+        return 0
+    return img.byteCount()
+
+class _StackState( object ):
+    '''Per stack part of a _TilesCache.
+
+    Dirty flags and timestamps are kept sparsely, for the (layer slot, tile)
+    pairs that were requested, such that a stack costs nothing up front
+    however many tiles a slice has; see _TilesCache for the meaning of the
+    layer generations.
+
+    '''
+    def __init__( self ):
+        # tile_id -> (composited image, progress)
+        self.tiles = {}
+        # (layer_id, tile_id) -> image
+        self.layers = {}
+        # composited tiles that are up to date; all others are dirty
+        self.cleanTiles = set()
+        # (slot, tile_id) -> generation of the cached image; missing
+        # entries are dirty
+        self.layerGeneration = {}
+        # (slot, tile_id) -> timestamp of the latest request; missing
+        # entries were never requested
+        self.layerTimestamp = {}
+        # (slot, tile_id) of dirty layer tiles showing a downsampled preview
+        self.layerPreview = set()
+        # (slot, tile_id) -> data rectangle; a dirty layer tile listed here
+        # is only dirty within the rectangle, its image is valid elsewhere
+        self.dirtyRects = {}
+        # layers whose indexed images still show an outdated palette, they
+        # are recolored once the stack becomes current
+        self.stalePalettes = set()
+        # False for prefetched stacks that were never current
+        self.visited = True
+        # number of times the stack became current
+        self.visits = 0
+
+    def reset( self ):
+        self.tiles.clear()
+        self.layers.clear()
+        self.cleanTiles.clear()
+        self.layerGeneration.clear()
+        self.layerTimestamp.clear()
+        self.layerPreview.clear()
+        self.dirtyRects.clear()
+        self.stalePalettes.clear()
+
+#*******************************************************************************
+# S t a c k E v i c t i o n P o l i c y                                        *
+#*******************************************************************************
+
+class LRUStackPolicy( object ):
+    """
+    Chooses the stack a _TilesCache drops when it holds more than maxstacks
+    stacks: the least recently used one.
+
+    Prefetched stacks that were never visited are always dropped before
+    visited ones; a policy merely orders the stacks within these groups.
+    """
+    def victim( self, stacks, current, added ):
+        """
+        stacks  -- OrderedDict stack_id -> _StackState, least recently used first
+        current -- id of the stack the user looks at
+        added   -- id of the stack that is being added
+
+        Returns the id of the stack to drop, never added, and current only
+        if there is no other stack.
+        """
+        candidates = [stack_id for stack_id in stacks
+                      if stack_id != added and stack_id != current]
+        if not candidates:
+            return current
+        unvisited = [stack_id for stack_id in candidates if not stacks[stack_id].visited]
+        return self._choose(unvisited or candidates, stacks, current)
 
-        # remove oldest cache, if necessary
-        old_uid = None
-        if self._maxcaches and len(self.caches) > self._maxcaches:
-            old_uid, v = self.caches.popitem(False) # removes item in LIFO order
-        return old_uid
+    def _choose( self, candidates, stacks, current ):
+        return candidates[0]
 
-    def touch( self, uid ):
-        c = self.caches[uid]
-        del self.caches[uid]
-        self.caches[uid] = c
+class DistanceStackPolicy( LRUStackPolicy ):
+    """
+    Drops the stack that is least likely to be revisited: the one farthest
+    from the current slicing position in (t, z, c), where frequently
+    visited stacks count as closer. Stack ids are expected to be of the
+    form (sources, ((axis, through), ...)) (see SyncedSliceSources.id);
+    other stacks, and those of other sources, count as infinitely far.
+    Ties are broken in least recently used order.
+    """
+    def __init__( self, weights=(1.0, 1.0, 1.0) ):
+        # weight of a step along each through axis
+        self.weights = weights
+
+    def _choose( self, candidates, stacks, current ):
+        position = _throughs(current)
+        worst, worstScore = None, None
+        for stack_id in candidates:
+            score = self.distance(position, current, stack_id) / (1.0 + stacks[stack_id].visits)
+            if worstScore is None or score > worstScore:
+                worst, worstScore = stack_id, score
+        return worst
+
+    def distance( self, position, current, stack_id ):
+        through = _throughs(stack_id)
+        if position is None or through is None or current[0] is not stack_id[0] \
+           or set(through) != set(position):
+            return float('inf')
+        return sum(self._weight(axis) * abs(through[axis] - position[axis])
+                   for axis in through)
+
+    def _weight( self, axis ):
+        return self.weights[axis] if axis < len(self.weights) else 1.0
+
+def _throughs( stack_id ):
+    # {axis: through} of a stack id, or None
+    try:
+        return dict(stack_id[1])
+    except (TypeError, ValueError, IndexError):
+        return None
+
+STACK_EVICTION_POLICIES = {
+    'lru': LRUStackPolicy,
+    'distance': DistanceStackPolicy,
+}
+
+def get_stack_eviction_policy():
+    """Policy configured as stack_eviction in the pixelpipeline section."""
+    return STACK_EVICTION_POLICIES[cfg.get('pixelpipeline', 'stack_eviction')]()
 
 class _TilesCache( object ):
-    def __init__(self, first_stack_id, sims, maxstacks=None):
+    '''Composited and per layer tile images of the most recently used stacks,
+    together with their dirty flags and request timestamps.
+
+    Layers are assigned slots, such that the per stack state can be keyed
+    by (slot, tile_id). A layer tile is clean if its entry in
+    _StackState.layerGeneration equals the current generation of the
+    layer, i.e. invalidating a layer in all tiles of all stacks merely
+    increments the layer's generation.
+
+    '''
+    # layer_id under which the composited tile of a stack is accounted
+    COMPOSITE = None
+
+    def __init__(self, first_stack_id, sims, maxstacks=None, memory=None,
+                 policy=None):
         self._lock = threading.Lock()
         self._sims = sims
 
-        kwargs = {'first_uid' : first_stack_id,
-                  'maxcaches' : maxstacks}
-        self._tileCache = _MultiCache(default_factory=lambda: (None, 0.), **kwargs)
-        self._tileCacheDirty = _MultiCache(default_factory=lambda: True, **kwargs)
-        self._layerCache = _MultiCache(**kwargs)
-        self._layerCacheDirty = _MultiCache(default_factory=lambda: True, **kwargs)
-        self._layerCacheTimestamp = _MultiCache(default_factory=float, **kwargs)
+        # Images are accounted against a (by default process-wide) byte budget
+        # and evicted individually in LRU order; maxstacks only bounds the
+        # bookkeeping of encountered stacks.
+        self._memory = memory if memory is not None else get_tile_cache_memory()
+        self._ref = self._memory.register(self)
+        self._nbytes = 0
+        self._pendingEvictions = collections.deque()
+        # LRU touches of lock free reads (see peekTile), applied when the
+        # cache is claimed next
+        self._pendingTouches = collections.deque(maxlen=100000)
+
+        # layer_id -> slot, and the current generation of each slot
+        self._slots = {}
+        self._generation = []
+        # layer_id -> latest palette passed to setLayerPalette
+        self._palettes = {}
+
+        self._maxstacks = maxstacks
+        self._policy = policy if policy is not None else get_stack_eviction_policy()
+        self._stacks = OrderedDict()
+        self._stacks[first_stack_id] = _StackState()
+        self._stacks[first_stack_id].visits = 1
+        # the stack visited last
+        self._current = first_stack_id
 
     def __enter__(self):
         self._lock.acquire()
+        while self._pendingEvictions:
+            self._evict(self._pendingEvictions.popleft())
+        while self._pendingTouches:
+            self._memory.touch(self._ref, self._pendingTouches.popleft())
         return self
     
     def __exit__(self, *args):
@@ -375,134 +1205,519 @@ class _TilesCache( object ):
 
     def __contains__( self, stack_id ):
         assert self._lock.locked(), "You must claim the _TileCache via a context manager before calling this function."
-        return stack_id in self._tileCache.caches
+        return stack_id in self._stacks
 
     def __len__( self ):
         assert self._lock.locked(), "You must claim the _TileCache via a context manager before calling this function."
-        return len(self._tileCache.caches)
+        return len(self._stacks)
+
+    def memoryUsage( self ):
+        """Number of image bytes currently held by this cache."""
+        return self._nbytes
+
+    def _slot( self, layer_id ):
+        slot = self._slots.get(layer_id)
+        if slot is None:
+            # the generation goes first, lock free readers (see
+            # peekLayerDirty) may look up the slot at any time
+            self._generation.append(0)
+            slot = self._slots[layer_id] = len(self._slots)
+        return slot
+
+    def _stack( self, stack_id ):
+        # raises KeyError for unknown stacks
+        return self._stacks[stack_id]
+
+    def _isClean( self, stack, slot, tile_id ):
+        return stack.layerGeneration.get((slot, tile_id), -1) == self._generation[slot]
+
+    def _setClean( self, stack, slot, tile_id, b ):
+        if b:
+            stack.layerGeneration[(slot, tile_id)] = self._generation[slot]
+        else:
+            stack.layerGeneration.pop((slot, tile_id), None)
+
+    def _setTileDirty( self, stack, tile_id, b ):
+        if b:
+            stack.cleanTiles.discard(tile_id)
+        else:
+            stack.cleanTiles.add(tile_id)
 
     def tile( self, stack_id, tile_id ):
         assert self._lock.locked(), "You must claim the _TileCache via a context manager before calling this function."
-        return self._tileCache.caches[stack_id][tile_id]
+        stack = self._stack(stack_id)
+        self._memory.touch(self._ref, (stack_id, self.COMPOSITE, tile_id))
+        return stack.tiles.get(tile_id, (None, 0.))
+
+    def peekTile( self, stack_id, tile_id ):
+        """
+        Like tile(), but does not require claiming the cache.
+
+        This is the read path of the paint loop, which therefore never
+        waits for render threads storing their results. Tiles are replaced
+        as a whole, so the result is a consistent (possibly just outdated)
+        snapshot. Raises KeyError for unknown stacks.
+        """
+        stack = self._stacks.get(stack_id)
+        if stack is None:
+            raise KeyError(stack_id)
+        self._pendingTouches.append((stack_id, self.COMPOSITE, tile_id))
+        return stack.tiles.get(tile_id, (None, 0.))
+
+    def peekTileDirty( self, stack_id, tile_id ):
+        """
+        Like tileDirty(), but does not require claiming the cache; see
+        peekTile(). Render threads that mark a tile dirty request a repaint
+        afterwards, so a missed update is picked up by the next paint.
+        """
+        stack = self._stacks.get(stack_id)
+        if stack is None:
+            raise KeyError(stack_id)
+        return tile_id not in stack.cleanTiles
+
+    def peekLayer( self, stack_id, layer_id, tile_id ):
+        """
+        Like layer(), but does not require claiming the cache; see peekTile().
+        """
+        stack = self._stacks.get(stack_id)
+        if stack is None:
+            raise KeyError(stack_id)
+        self._pendingTouches.append((stack_id, layer_id, tile_id))
+        return stack.layers.get((layer_id, tile_id))
+
+    def peekLayerDirty( self, stack_id, layer_id, tile_id ):
+        """
+        Like layerDirty(), but does not require claiming the cache; see
+        peekTileDirty().
+        """
+        stack = self._stacks.get(stack_id)
+        if stack is None:
+            raise KeyError(stack_id)
+        slot = self._slots.get(layer_id)
+        return slot is None or not self._isClean(stack, slot, tile_id)
+
+    def peekLayerDirtyRect( self, stack_id, layer_id, tile_id ):
+        """
+        Like layerDirtyRect(), but does not require claiming the cache; see
+        peekTileDirty().
+        """
+        stack = self._stacks.get(stack_id)
+        if stack is None:
+            raise KeyError(stack_id)
+        slot = self._slots.get(layer_id)
+        if slot is None:
+            return None
+        return stack.dirtyRects.get((slot, tile_id))
+
+    def patchedLayer( self, stack_id, layer_id, tile_id, tileRect, rect, patch ):
+        """
+        Copy patch, the image of the data rectangle rect of a layer tile
+        covering the data rectangle tileRect, into a copy of the cached
+        image of the layer tile.
+
+        Does not require claiming the cache, such that render threads
+        copy images while others may use it. Returns the cached image and
+        the updated copy, to be stored by updateTileRectIfNecessary(); the
+        copy is None if the patch can't be applied.
+        """
+        img = self.peekLayer(stack_id, layer_id, tile_id)
+        if img is None or patch is None:
+            return img, None
+        # images are the transpose of their data rectangle
+        x, y = rect.y() - tileRect.y(), rect.x() - tileRect.x()
+        updated = img.copy()
+        if img.format() == QImage.Format_Indexed8:
+            if patch.format() != QImage.Format_Indexed8:
+                return img, None
+            byte_view(updated)[y:y+patch.height(), x:x+patch.width()] = byte_view(patch)
+        else:
+            p = QPainter(updated)
+            p.setCompositionMode(QPainter.CompositionMode_Source)
+            p.drawImage(x, y, patch)
+            p.end()
+        return img, updated
 
     def setTile( self, stack_id, tile_id, img, stack_visible, stack_occluded ):
         assert self._lock.locked(), "You must claim the _TileCache via a context manager before calling this function."
-        if len(stack_visible) > 0:
-            visible = numpy.asarray(stack_visible)
-            occluded = numpy.asarray(stack_occluded)
-            visibleAndNotOccluded = numpy.logical_and(visible, numpy.logical_not(occluded))
-            if numpy.count_nonzero(visibleAndNotOccluded) > 0:
-                dirty = numpy.asarray([self._layerCacheDirty.caches[stack_id][(ims, tile_id)]
-                                       for ims in self._sims.viewImageSources()])
-                num = numpy.count_nonzero(numpy.logical_and(dirty, visibleAndNotOccluded) == True)
-                denom = float(numpy.count_nonzero(visibleAndNotOccluded))
-                progress = 1.0 - num / denom
-            else:
-                progress = 1.0
-        else:
-            progress = 1.0
-        self._tileCache.caches[stack_id][tile_id] = (img, progress)
+        stack = self._stack(stack_id)
+        progress = 1.0
+        num, denom = 0.0, 0
+        for ims, visible, occluded in zip(self._sims.viewImageSources(),
+                                          stack_visible, stack_occluded):
+            if not visible or occluded:
+                continue
+            denom += 1
+            slot = self._slot(ims)
+            if not self._isClean(stack, slot, tile_id):
+                # a layer tile showing a preview is half done
+                num += 0.5 if (slot, tile_id) in stack.layerPreview else 1.0
+        if denom > 0:
+            progress = 1.0 - num / denom
+        old_img = stack.tiles.get(tile_id, (None, 0.))[0]
+        stack.tiles[tile_id] = (img, progress)
+        self._account(stack_id, self.COMPOSITE, tile_id, old_img, img)
 
     def tileDirty( self, stack_id, tile_id ):
         assert self._lock.locked(), "You must claim the _TileCache via a context manager before calling this function."
-        return self._tileCacheDirty.caches[stack_id][tile_id]
+        return tile_id not in self._stack(stack_id).cleanTiles
 
     def setTileDirty( self, stack_id, tile_id, b):
         assert self._lock.locked(), "You must claim the _TileCache via a context manager before calling this function."
-        self._tileCacheDirty.caches[stack_id][tile_id] = b
+        self._setTileDirty(self._stack(stack_id), tile_id, b)
 
     def setTileDirtyAllStacks( self, tile_id, b):
         assert self._lock.locked(), "You must claim the _TileCache via a context manager before calling this function."
-        for stack_id in self._tileCacheDirty.caches:
-            self._tileCacheDirty.caches[stack_id][tile_id] = b
+        for stack in self._stacks.itervalues():
+            self._setTileDirty(stack, tile_id, b)
+
+    def setStackTilesDirty( self, stack_id ):
+        """
+        Mark all tiles of the given stack as dirty.
+        """
+        assert self._lock.locked(), "You must claim the _TileCache via a context manager before calling this function."
+        self._stack(stack_id).cleanTiles.clear()
 
     def setAllTilesDirty( self ):
         """
         Mark all tiles in all stacks as dirty.
-        For speed, this is done by simply deleting all entries 
-        (by default missing entries are considered dirty).
         """
         assert self._lock.locked(), "You must claim the _TileCache via a context manager before calling this function."
-        for stack_id in self._tileCacheDirty.caches:
-            self._tileCacheDirty.caches[stack_id].clear()
+        for stack in self._stacks.itervalues():
+            stack.cleanTiles.clear()
 
     def layer(self, stack_id, layer_id, tile_id ):
         assert self._lock.locked(), "You must claim the _TileCache via a context manager before calling this function."
-        return self._layerCache.caches[stack_id][(layer_id,tile_id)]
+        stack = self._stack(stack_id)
+        self._memory.touch(self._ref, (stack_id, layer_id, tile_id))
+        return stack.layers.get((layer_id, tile_id))
 
     def setLayer( self, stack_id, layer_id, tile_id, img ):
         assert self._lock.locked(), "You must claim the _TileCache via a context manager before calling this function."
-        self._layerCache.caches[stack_id][(layer_id, tile_id)] = img
-
+        stack = self._stack(stack_id)
+        old_img = stack.layers.get((layer_id, tile_id))
+        if img is None:
+            stack.layers.pop((layer_id, tile_id), None)
+        else:
+            stack.layers[(layer_id, tile_id)] = img
+        self._account(stack_id, layer_id, tile_id, old_img, img)
 
     def layerDirty(self, stack_id, layer_id, tile_id ):
         assert self._lock.locked(), "You must claim the _TileCache via a context manager before calling this function."
-        return self._layerCacheDirty.caches[stack_id][(layer_id, tile_id)]
+        slot = self._slot(layer_id)
+        return not self._isClean(self._stack(stack_id), slot, tile_id)
 
     def setLayerDirty( self, stack_id, layer_id, tile_id, b ):
         assert self._lock.locked(), "You must claim the _TileCache via a context manager before calling this function."
-        self._layerCacheDirty.caches[stack_id][(layer_id, tile_id)] = b
+        slot = self._slot(layer_id)
+        stack = self._stack(stack_id)
+        self._setClean(stack, slot, tile_id, not b)
+        stack.layerPreview.discard((slot, tile_id))
+        stack.dirtyRects.pop((slot, tile_id), None)
 
     def setLayerDirtyAllStacks( self, layer_id, tile_id, b ):
         """
         Mark the given tile as dirty in all stacks.
         """
         assert self._lock.locked(), "You must claim the _TileCache via a context manager before calling this function."
-        for stack_id in self._layerCacheDirty.caches:
-            self._layerCacheDirty.caches[stack_id][(layer_id, tile_id)] = b
+        for stack_id in self._stacks:
+            self.setLayerDirty(stack_id, layer_id, tile_id, b)
+
+    def setLayerDirtyRectAllStacks( self, layer_id, tile_id, rect ):
+        """
+        Mark the data rectangle rect of the given tile as dirty in all
+        stacks.
+
+        Where the layer tile has an up to date (or itself partially dirty)
+        full resolution image, only rect needs to be rendered anew, see
+        layerDirtyRect() and updateTileRectIfNecessary(). Otherwise the
+        whole layer tile becomes dirty.
+        """
+        assert self._lock.locked(), "You must claim the _TileCache via a context manager before calling this function."
+        slot = self._slot(layer_id)
+        for stack_id in self._stacks:
+            stack = self._stack(stack_id)
+            key = (slot, tile_id)
+            clean = self._isClean(stack, slot, tile_id)
+            dirty = stack.dirtyRects.get(key)
+            partial = (clean or dirty is not None) \
+                      and key not in stack.layerPreview \
+                      and (layer_id, tile_id) in stack.layers
+            self.setLayerDirty(stack_id, layer_id, tile_id, True)
+            if partial and not rect.isEmpty():
+                stack.dirtyRects[key] = rect if dirty is None else dirty.united(rect)
+
+    def layerDirtyRect( self, stack_id, layer_id, tile_id ):
+        """
+        The data rectangle to which the dirty region of a layer tile is
+        confined, or None if the whole layer tile must be rendered.
+        """
+        assert self._lock.locked(), "You must claim the _TileCache via a context manager before calling this function."
+        slot = self._slot(layer_id)
+        return self._stack(stack_id).dirtyRects.get((slot, tile_id))
 
     def setLayerDirtyAllTiles(self, layer_id):
         """
         For a given layer, marks all tiles in all stacks as dirty.
-        This is achieved by simply deleting all tiles for the given 
-            layer (by default, missing entries are dirty)
+        This is achieved by incrementing the generation of the layer.
         """ 
         assert self._lock.locked(), "You must claim the _TileCache via a context manager before calling this function."
-        for stack_id in self._layerCacheDirty.caches:
-            dirty_entries = [(l_id, t_id) for (l_id, t_id) in self._layerCacheDirty.caches[stack_id].keys() if l_id == layer_id]
-            #dirty_entries = filter( lambda (l_id, t_id): l_id == layer_id, self._layerCacheDirty.caches[stack_id].keys() )
-            for entry in dirty_entries:
-                del self._layerCacheDirty.caches[stack_id][entry]
+        slot = self._slot(layer_id)
+        self._generation[slot] += 1
+        for stack in self._stacks.itervalues():
+            for key in [key for key in stack.layerPreview if key[0] == slot]:
+                stack.layerPreview.discard(key)
+            for key in [key for key in stack.dirtyRects if key[0] == slot]:
+                del stack.dirtyRects[key]
 
     def layerTimestamp(self, stack_id, layer_id, tile_id ):
         assert self._lock.locked(), "You must claim the _TileCache via a context manager before calling this function."
-        return self._layerCacheTimestamp.caches[stack_id][(layer_id, tile_id)]
+        slot = self._slot(layer_id)
+        return self._stack(stack_id).layerTimestamp.get((slot, tile_id), 0.)
 
     def setLayerTimestamp( self, stack_id, layer_id, tile_id, time):
         assert self._lock.locked(), "You must claim the _TileCache via a context manager before calling this function."
-        self._layerCacheTimestamp.caches[stack_id][(layer_id, tile_id)] = time
+        slot = self._slot(layer_id)
+        self._stack(stack_id).layerTimestamp[(slot, tile_id)] = time
 
 
-    def addStack( self, stack_id ):
+    def addStack( self, stack_id, prefetched=False ):
+        """
+        Add an empty stack, which becomes the current one unless it is
+        prefetched. The images of a prefetched stack are the first to be
+        evicted until the stack is visited (see touchStack()).
+        """
         assert self._lock.locked(), "You must claim the _TileCache via a context manager before calling this function."
-        self._tileCache.add( stack_id )
-        self._tileCacheDirty.add( stack_id, default_factory=lambda:True )
-        self._layerCache.add( stack_id )
-        self._layerCacheDirty.add( stack_id, default_factory=lambda:True )
-        self._layerCacheTimestamp.add( stack_id, default_factory=float )
-
+        if stack_id in self._stacks:
+            raise Exception('_TilesCache.addStack: stack %s is already in use' % str(stack_id))
+        stack = self._stacks[stack_id] = _StackState()
+        stack.visited = not prefetched
+        if not prefetched:
+            stack.visits = 1
+            self._current = stack_id
+
+        if self._maxstacks and len(self._stacks) > self._maxstacks:
+            # drop the stack chosen by the eviction policy and give its
+            # images back to the budget
+            old_stack_id = self._policy.victim(self._stacks, self._current, stack_id)
+            old_stack = self._stacks.pop(old_stack_id)
+            for tile_id, (img, progress) in old_stack.tiles.iteritems():
+                self._account(old_stack_id, self.COMPOSITE, tile_id, img, None)
+            for (layer_id, tile_id), img in old_stack.layers.iteritems():
+                self._account(old_stack_id, layer_id, tile_id, img, None)
 
     def touchStack( self, stack_id ):
+        """
+        Mark the stack as most recently used and visited, i.e. as the
+        current one.
+        """
         assert self._lock.locked(), "You must claim the _TileCache via a context manager before calling this function."
-        self._tileCache.touch( stack_id )
-        self._tileCacheDirty.touch( stack_id )
-        self._layerCache.touch( stack_id )
-        self._layerCacheDirty.touch( stack_id )
-        self._layerCacheTimestamp.touch( stack_id )
-
+        stack = self._stacks[stack_id] = self._stacks.pop(stack_id)
+        if stack_id != self._current:
+            stack.visits += 1
+            self._current = stack_id
+        if not stack.visited:
+            stack.visited = True
+            keys = [(stack_id, self.COMPOSITE, tile_id) for tile_id in stack.tiles]
+            keys += [(stack_id, layer_id, tile_id) for layer_id, tile_id in stack.layers]
+            self._memory.promote(self._ref, keys)
 
     def updateTileIfNecessary( self, stack_id, layer_id, tile_id,
                                req_timestamp, img):
         assert self._lock.locked(), "You must claim the _TileCache via a context manager before calling this function."
-        if req_timestamp > self._layerCacheTimestamp.caches[stack_id][(layer_id, tile_id)]:
-            self._layerCache.caches[stack_id][(layer_id, tile_id)] = img
-            self._layerCacheDirty.caches[stack_id][(layer_id, tile_id)] = False
-            self._layerCacheTimestamp.caches[stack_id][(layer_id, tile_id)] = req_timestamp
-            self._tileCacheDirty.caches[stack_id][tile_id] = True
+        slot = self._slot(layer_id)
+        stack = self._stack(stack_id)
+        key = (slot, tile_id)
+        if req_timestamp > stack.layerTimestamp.get(key, 0.):
+            self.setLayer(stack_id, layer_id, tile_id, img)
+            self._setClean(stack, slot, tile_id, True)
+            stack.layerTimestamp[key] = req_timestamp
+            stack.layerPreview.discard(key)
+            stack.dirtyRects.pop(key, None)
+            stack.cleanTiles.discard(tile_id)
+
+    def updateTileRectIfNecessary( self, stack_id, layer_id, tile_id,
+                                   req_timestamp, rect, img, updated ):
+        """
+        Replace img, the cached image of a partially dirty layer tile, by
+        updated, its copy patched within the data rectangle rect (see
+        patchedLayer()).
+
+        The layer tile becomes clean if rect covers its dirty region.
+        The patch is ignored if the layer tile was invalidated as a whole
+        since, or if a more recent image is cached already. If the patch
+        couldn't be applied (updated is None), the layer tile stays dirty as
+        a whole.
+
+        Returns True if the patch was used.
+        """
+        assert self._lock.locked(), "You must claim the _TileCache via a context manager before calling this function."
+        slot = self._slot(layer_id)
+        stack = self._stack(stack_id)
+        dirty = stack.dirtyRects.get((slot, tile_id))
+        if dirty is None \
+           or req_timestamp <= stack.layerTimestamp.get((slot, tile_id), 0.):
+            return False
+        if img is None or updated is None:
+            # otherwise the tile would be requested in part over and over
+            del stack.dirtyRects[(slot, tile_id)]
+            return False
+        if stack.layers.get((layer_id, tile_id)) is not img:
+            # replaced while the patch was applied; the tile stays dirty
+            # and is requested again
+            return False
+        self.setLayer(stack_id, layer_id, tile_id, updated)
+        stack.layerTimestamp[(slot, tile_id)] = req_timestamp
+        if rect.contains(dirty):
+            self._setClean(stack, slot, tile_id, True)
+            del stack.dirtyRects[(slot, tile_id)]
+        stack.cleanTiles.discard(tile_id)
+        return True
+
+    def setLayerPalette( self, layer_id, palette ):
+        """
+        Record a new color table for the layer's indexed tile images. The
+        images of a stack are recolored via staleLayers() and
+        replaceLayers(), usually once the stack becomes current.
+        """
+        assert self._lock.locked(), "You must claim the _TileCache via a context manager before calling this function."
+        self._palettes[layer_id] = palette
+        for stack in self._stacks.itervalues():
+            stack.stalePalettes.add(layer_id)
+
+    def staleLayers( self, stack_id ):
+        """
+        The indexed layer tile images of the stack whose color table
+        changed (see setLayerPalette()), as a list of (layer_id, tile_id,
+        image, palette), and whether all of the affected images are indexed.
+        Images of other formats are marked dirty, as they must be rendered
+        anew.
+        """
+        assert self._lock.locked(), "You must claim the _TileCache via a context manager before calling this function."
+        stack = self._stack(stack_id)
+        stale = []
+        allIndexed = True
+        while stack.stalePalettes:
+            layer_id = stack.stalePalettes.pop()
+            palette = self._palettes[layer_id]
+            slot = self._slot(layer_id)
+            for (lid, tile_id), img in stack.layers.iteritems():
+                if lid != layer_id:
+                    continue
+                if img.format() != QImage.Format_Indexed8:
+                    allIndexed = False
+                    self._setClean(stack, slot, tile_id, False)
+                elif img.colorTable() != palette:
+                    # else rendered after the palette changed
+                    stale.append((lid, tile_id, img, palette))
+        return stale, allIndexed
+
+    def replaceLayers( self, stack_id, replacements ):
+        """
+        Store the layer tile images given as (layer_id, tile_id, old image,
+        new image) and mark their composited tiles dirty, unless the cached
+        image is no longer the old one.
+        """
+        assert self._lock.locked(), "You must claim the _TileCache via a context manager before calling this function."
+        stack = self._stack(stack_id)
+        for layer_id, tile_id, old, img in replacements:
+            if stack.layers.get((layer_id, tile_id)) is old:
+                stack.layers[(layer_id, tile_id)] = img
+                self._account(stack_id, layer_id, tile_id, old, img)
+                stack.cleanTiles.discard(tile_id)
+
+    def setLayerPreview( self, stack_id, layer_id, tile_id, img ):
+        """
+        Show img, a downsampled rendering of the layer tile, until the full
+        resolution image arrives via updateTileIfNecessary().
+
+        The layer tile stays dirty; img is ignored if the tile is already
+        up to date.
+        """
+        assert self._lock.locked(), "You must claim the _TileCache via a context manager before calling this function."
+        slot = self._slot(layer_id)
+        stack = self._stack(stack_id)
+        if not self._isClean(stack, slot, tile_id):
+            self.setLayer(stack_id, layer_id, tile_id, img)
+            stack.layerPreview.add((slot, tile_id))
+            stack.dirtyRects.pop((slot, tile_id), None)
+            stack.cleanTiles.discard(tile_id)
+
+    def release( self ):
+        """
+        Give all images held by this cache back to the memory budget.
+        Call this when the cache is being replaced.
+        """
+        assert self._lock.locked(), "You must claim the _TileCache via a context manager before calling this function."
+        for stack_id, stack in self._stacks.iteritems():
+            for tile_id, (img, progress) in stack.tiles.iteritems():
+                self._account(stack_id, self.COMPOSITE, tile_id, img, None)
+            for (layer_id, tile_id), img in stack.layers.iteritems():
+                self._account(stack_id, layer_id, tile_id, img, None)
+            stack.reset()
+
+    def evictLater( self, key ):
+        """
+        Evict the entry key=(stack_id, layer_id, tile_id), now if the cache is
+        not claimed by anybody, otherwise the next time it is claimed.
+        Can be called from any thread.
+        """
+        if self._lock.acquire(False):
+            try:
+                self._evict(key)
+            finally:
+                self._lock.release()
+        else:
+            self._pendingEvictions.append(key)
+
+    def _account( self, stack_id, layer_id, tile_id, old_img, img ):
+        key = (stack_id, layer_id, tile_id)
+        self._nbytes += _nbytes(img) - _nbytes(old_img)
+        if old_img is not None and old_img is not img:
+            get_image_pool().release(old_img)
+        if img is None:
+            if old_img is not None:
+                self._memory.discard(self._ref, key)
+            return
+        stack = self._stacks.get(stack_id)
+        speculative = stack is not None and not stack.visited
+        victims = self._memory.add(self._ref, key, _nbytes(img), speculative)
+        for ref, victim_key in victims:
+            if ref is self._ref:
+                self._evict(victim_key)
+            else:
+                cache = ref()
+                if cache is not None:
+                    cache.evictLater(victim_key)
+
+    def _evict( self, key ):
+        """
+        Drop an image that fell out of the memory budget. The entry is marked
+        dirty, so it is requested again once it becomes visible.
+        """
+        stack_id, layer_id, tile_id = key
+        if stack_id not in self._stacks:
+            return
+        stack = self._stack(stack_id)
+        if layer_id is self.COMPOSITE:
+            img, progress = stack.tiles.pop(tile_id, (None, 0.))
+        else:
+            img = stack.layers.pop((layer_id, tile_id), None)
+            key = (self._slot(layer_id), tile_id)
+            stack.layerGeneration.pop(key, None)
+            stack.layerTimestamp.pop(key, None)
+            stack.layerPreview.discard(key)
+            stack.dirtyRects.pop(key, None)
+        stack.cleanTiles.discard(tile_id)
+        if img is not None:
+            self._nbytes -= _nbytes(img)
+            self._memory.discard(self._ref, key)
+            get_image_pool().release(img)
 
 
 class TileProvider( QObject ):
-    Tile = collections.namedtuple('Tile', 'id qimg rectF progress tiling')
+    # transform maps qimg to the scene (see Tiling.imageTransform); rectF is
+    # the scene rectangle covered by it
+    Tile = collections.namedtuple('Tile', 'id qimg rectF progress tiling transform')
     sceneRectChanged = pyqtSignal( QRectF )
 
 
@@ -511,43 +1726,65 @@ class TileProvider( QObject ):
     Keyword Arguments:
     cache_size                -- maximal number of encountered stacks
                                  to cache, i.e. slices if the imagesources
-                                 draw from slicesources (default 10)
-    request_queue_size        -- maximal number of request to queue up (default 100000)
-    n_threads                 -- maximal number of request threads; this determines the
-                                 maximal number of simultaneously running requests
-                                 to the pixelpipeline (default: 2)
+                                 draw from slicesources (default 100);
+                                 the cached images are additionally bounded
+                                 by the global byte budget, see
+                                 get_tile_cache_memory()
+    request_queue_size        -- maximal number of render tasks this provider keeps
+                                 queued or running; when exceeded, the least
+                                 important task is cancelled (default 100000)
+    n_threads                 -- ignored; the render pool is shared by all tile
+                                 providers, its size is taken from the
+                                 configuration or determined automatically, see
+                                 get_render_pool()
     layerIdChange_means_dirty -- layerId changes invalidate the cache; by default only
                                  stackId changes do that (default False)
     parent                    -- QObject
 
     '''
 
-    @property
-    def axesSwapped(self):
-        return self._axesSwapped
-
-    @axesSwapped.setter
-    def axesSwapped(self, value):
-        self._axesSwapped = value
-
     def __init__( self, tiling, stackedImageSources, cache_size=100,
-                  request_queue_size=100000, n_threads=2,
-                  layerIdChange_means_dirty=False, parent=None ):
+                  request_queue_size=100000, n_threads=None,
+                  layerIdChange_means_dirty=False, evictionPolicy=None,
+                  parent=None ):
         QObject.__init__( self, parent = parent )
 
         self.tiling = tiling
-        self.axesSwapped = False
         self._sims = stackedImageSources
         self._cache_size = cache_size
         self._request_queue_size = request_queue_size
         self._n_threads = n_threads
         self._layerIdChange_means_dirty = layerIdChange_means_dirty
+        # decides which stack is dropped once more than cache_size stacks
+        # are cached (see LRUStackPolicy); by default the configured one
+        self._evictionPolicy = evictionPolicy
+
+        # Layers taking at least this long per tile (see
+        # Layer.averageTimePerTile) are rendered progressively: a tile
+        # downsampled by 2**_previewLevels is requested along with the full
+        # resolution one and shown until the latter is done.
+        self._previewThreshold = cfg.getint('pixelpipeline', 'progressive_threshold_ms') / 1000.0
+        self._previewLevels = cfg.getint('pixelpipeline', 'progressive_levels')
+
+        # Direct layers are rendered on the GUI thread only as long as their
+        # tiles are predicted to be done within _frameBudget seconds of the
+        # start of requestRefresh(); the remaining tiles go to the render pool.
+        self._frameBudget = cfg.getint('pixelpipeline', 'direct_frame_budget_ms') / 1000.0
+        self._frameDeadline = None
+
+        # Prefetching is suspended while the images of prefetched stacks
+        # (including those still being rendered) take more than this
+        # fraction of the tile cache memory, or while the system is low on
+        # memory (see SystemMemory).
+        self._prefetchFraction = cfg.getint('pixelpipeline', 'prefetch_cache_percent') / 100.0
 
         self._current_stack_id = self._sims.stackId
         self._cache = _TilesCache(self._current_stack_id, self._sims,
-                                  maxstacks=self._cache_size)
+                                  maxstacks=self._cache_size,
+                                  policy=self._evictionPolicy)
 
         self._sims.layerDirty.connect(self._onLayerDirty)
+        self._sims.paletteChanged.connect(self._onPaletteChanged)
         self._sims.visibleChanged.connect(self._onVisibleChanged)
         self._sims.opacityChanged.connect(self._onOpacityChanged)
         self._sims.sizeChanged.connect(self._onSizeChanged)
@@ -558,6 +1795,46 @@ class TileProvider( QObject ):
 
         self._keepRendering = True
 
+        # render tasks that are queued or running, keyed by RenderTask.key;
+        # a dirty layer tile that is already in flight is not requested
+        # again. Tasks that became stale (see RenderTask.isStale) are
+        # cancelled whenever the current stack changes or stacks get evicted
+        self._tasks = {}
+        self._tasksLock = threading.Lock()
+        # number of prefetch tasks in self._tasks
+        self._prefetchTasks = 0
+
+        # The layer whose opacity or visibility changed last, and per tile
+        # of the current stack the composites of the layers below and above
+        # it (see _blendTile). They count against the tile cache budget;
+        # tiles evicted from it (see evictLater) are dropped on the next
+        # blend.
+        self._splitLayer = None
+        self._splitTiles = {}
+        self._splitRef = get_tile_cache_memory().register(self)
+        self._splitEvictions = collections.deque()
+
+        # Opacity, visibility and order changes invalidate the composited
+        # tiles of the current stack only; a stack whose recorded appearance
+        # is older than self._appearance is invalidated once it becomes
+        # current.
+        self._appearance = 0
+        self._compositeAppearance = {}
+
+        # ims -> {tile_no: generation}; the generation of a layer tile is
+        # incremented whenever its data becomes dirty, the entry for
+        # None counts the layer-wide invalidations
+        self._dataGenerations = weakref.WeakKeyDictionary()
+
+    def cacheMemoryUsage( self ):
+        '''Number of image bytes currently cached by this tile provider.
+
+        All tile providers share one memory budget, see
+        get_tile_cache_memory().
+
+        '''
+        return self._cache.memoryUsage()
+
     def getTiles( self, rectF ):
         '''Get tiles in rect and request a refresh.
 
@@ -571,14 +1848,14 @@ class TileProvider( QObject ):
         tile_nos = self.tiling.intersected( rectF )
         stack_id = self._current_stack_id
         for tile_no in tile_nos:
-            with self._cache:
-                qimg, progress = self._cache.tile(stack_id, tile_no)
+            qimg, progress = self._cache.peekTile(stack_id, tile_no)
             yield TileProvider.Tile(
                 tile_no,
                 qimg,
                 QRectF(self.tiling.imageRects[tile_no]),
                 progress,
-                self.tiling)
+                self.tiling,
+                self.tiling.imageTransform(tile_no))
 
     def waitForTiles(self, rectF=QRectF()):
         """
@@ -600,9 +1877,13 @@ class TileProvider( QObject ):
 
         '''
         tile_nos = self.tiling.intersected( rectF )
-        for tile_no in tile_nos:
-            stack_id = self._current_stack_id
-            self._refreshTile( stack_id, tile_no )
+        self._frameDeadline = time.time() + self._frameBudget
+        try:
+            for tile_no in tile_nos:
+                stack_id = self._current_stack_id
+                self._refreshTile( stack_id, tile_no )
+        finally:
+            self._frameDeadline = None
 
     def prefetch( self, rectF, through ):
         '''Request fetching of tiles in advance.
@@ -615,25 +1896,42 @@ class TileProvider( QObject ):
 
         '''
         if self._cache_size > 1:
-            stack_id = (self._current_stack_id[0], enumerate(through))
+            if not self._prefetchAllowed():
+                get_metrics().increment('prefetch_throttled')
+                return
+            # a tuple (rather than an iterator) keeps the stack id stable
+            # between calls and can be passed to every tile request
+            stack_id = (self._current_stack_id[0], tuple(enumerate(through)))
             with self._cache:
-                if stack_id not in self._cache:
-                    self._cache.addStack(stack_id)
+                added = stack_id not in self._cache
+                if added:
+                    self._cache.addStack(stack_id, prefetched=True)
                     self._cache.touchStack( self._current_stack_id )
+            if added:
+                # adding the stack may have evicted another one
+                self._cancelStaleTasks()
             tile_nos = self.tiling.intersected( rectF )
             for tile_no in tile_nos:
                 self._refreshTile( stack_id, tile_no, prefetch=True )
 
+    def _prefetchAllowed( self ):
+        if get_system_memory().underPressure():
+            return False
+        memory = self._cache._memory
+        pending = self._prefetchTasks * 4 * self.tiling.blockSize**2
+        if memory.usedBytes() + pending >= memory.maxBytes():
+            # prefetched tiles never displace viewed ones, see
+            # TileCacheMemory._popVictims
+            return False
+        speculative = memory.speculativeBytes() + pending
+        return speculative < self._prefetchFraction * memory.maxBytes()
+
     def _refreshTile( self, stack_id, tile_no, prefetch=False ):
-        if not self.axesSwapped:
-            transform = QTransform(0,1,0,1,0,0,1,1,1)
-        else:
-            transform = QTransform().rotate(90).scale(1,-1)
-        transform *= self.tiling.data2scene
+        # layer tiles are cached as rendered by the image sources
+        transform = QTransform()
 
         try:
-            with self._cache:
-                tile_dirty = self._cache.tileDirty( stack_id, tile_no )
+            tile_dirty = self._cache.peekTileDirty( stack_id, tile_no )
             if tile_dirty:
                 if not prefetch:
                     with self._cache:
@@ -646,64 +1944,280 @@ class TileProvider( QObject ):
 
                 # refresh dirty layer tiles
                 for ims in self._sims.viewImageSources():
-                    with self._cache:
-                        layer_dirty = self._cache.layerDirty(stack_id, ims, tile_no)
+                    partialRect = None
+                    layer_dirty = self._cache.peekLayerDirty(stack_id, ims, tile_no)
+                    if layer_dirty:
+                        partialRect = self._partialRect(stack_id, ims, tile_no)
                     if layer_dirty \
                        and not self._sims.isOccluded(ims) \
                        and self._sims.isVisible(ims):
 
-                        rect = self.tiling.imageRects[tile_no]
-                        dataRect = self.tiling.scene2data.mapRect(rect)
+                        synchronous = ims.direct and not prefetch
+                        if synchronous and not self._fitsFrameBudget(ims):
+                            synchronous = False
+                            get_metrics().increment('direct_tiles_deferred', layerLabel(ims))
+                        if not synchronous:
+                            generation = self._dataGeneration(ims, tile_no)
+                            if self._isInFlight((stack_id, ims, tile_no, generation, False), prefetch):
+                                continue
+
+                        dataRect = partialRect
+                        if dataRect is None:
+                            dataRect = self.tiling.dataRects[tile_no]
                         try:
-                            ims_req = ims.request(dataRect, stack_id[1])
+                            if self.tiling.level:
+                                ims_req = ims.request(dataRect, stack_id[1],
+                                                      level=self.tiling.level)
+                            else:
+                                ims_req = ims.request(dataRect, stack_id[1])
                         except IndeterminateRequestError:
                             sys.excepthook( *sys.exc_info() )
                         else:
-                            if ims.direct and not prefetch:
+                            if synchronous:
                                 # The ImageSource 'ims' is fast (it has the
                                 # direct flag set to true) so we process
                                 # the request synchronously here. This
                                 # improves the responsiveness for layers
                                 # that have the data readily available.
                                 start = time.time()
-                                img = ims_req.wait()
-    
-                                img = img.transformed(transform)
+                                label = layerLabel(ims)
+                                with labelled(label):
+                                    img = ims_req.wait()
+                                    with get_metrics().timed(metrics.TRANSFORM):
+                                        img = _layerImage(ims, img, transform)
                                 stop = time.time()
-    
-                                ims._layer.timePerTile(stop-start,
-                                                       self.tiling.imageRects[tile_no])
-    
-                                with self._cache:
-                                    self._cache.updateTileIfNecessary(
-                                        stack_id, ims, tile_no, time.time(), img )
+                                if partialRect is not None:
+                                    get_metrics().increment('partial_tiles_rendered', label)
+                                    base, updated = self._cache.patchedLayer(
+                                        stack_id, ims, tile_no,
+                                        self.tiling.dataRects[tile_no], partialRect, img )
+                                    with self._cache:
+                                        self._cache.updateTileRectIfNecessary(
+                                            stack_id, ims, tile_no, time.time(),
+                                            partialRect, base, updated )
+                                else:
+                                    get_metrics().increment('tiles_rendered', label)
+                                    ims._layer.timePerTile(stop-start,
+                                                           self.tiling.imageRects[tile_no])
+                                    with self._cache:
+                                        self._cache.updateTileIfNecessary(
+                                            stack_id, ims, tile_no, time.time(), img )
                                 img = self._renderTile( stack_id, tile_no )
                                 with self._cache:
                                     self._cache.setTile(stack_id, tile_no,
                                                         img, self._sims.viewVisible(),
                                                         self._sims.viewOccluded() )
-                            else:
+                            elif self._makeRoomForTask(prefetch):
                                 pool = get_render_pool()
                                 pool.submit(prefetch, time.time(),
                                         self, ims, transform, tile_no,
-                                        stack_id, ims_req, self._cache)
+                                        stack_id, ims_req, self._cache,
+                                        generation, False, partialRect)
+                                if not prefetch and partialRect is None and self._wantsPreview(ims):
+                                    self._requestPreview(stack_id, ims, tile_no,
+                                                         dataRect, transform,
+                                                         generation)
         except KeyError:
             pass
 
-    def _renderTile( self, stack_id, tile_nr): 
-        qimg = None
-        p = None
-        for i, v in enumerate(reversed(self._sims)):
+    # A layer tile whose dirty region (see _onLayerDirty) covers at most
+    # this fraction of it is updated by rendering only that region.
+    PARTIAL_UPDATE_FRACTION = 0.5
+
+    def _partialRect( self, stack_id, ims, tile_no ):
+        '''The data rectangle to render for the dirty layer tile if it is
+        updated partially, else None.'''
+        if self.tiling.level:
+            return None
+        rect = self._cache.peekLayerDirtyRect(stack_id, ims, tile_no)
+        if rect is None:
+            return None
+        tileRect = self.tiling.dataRects[tile_no]
+        if rect.width() * rect.height() > \
+           self.PARTIAL_UPDATE_FRACTION * tileRect.width() * tileRect.height():
+            return None
+        return rect
+
+    def _fitsFrameBudget( self, ims ):
+        '''Whether a tile of the direct layer ims is predicted (by the
+        layer's average time per tile) to be rendered before the deadline
+        of the current frame.'''
+        if self._frameDeadline is None:
+            return True
+        return time.time() + ims._layer.averageTimePerTile <= self._frameDeadline
+
+    def _wantsPreview( self, ims ):
+        # a preview only arrives early if it reads less data than the full
+        # resolution tile, see ImageSource.supportsStridedReads
+        layer = getattr(ims, '_layer', None)
+        return self._previewLevels > 0 and layer is not None and \
+               layer.averageTimePerTile >= self._previewThreshold and \
+               ims.supportsStridedReads()
+
+    def _requestPreview( self, stack_id, ims, tile_no, dataRect, transform,
+                         generation ):
+        '''Request a downsampled version of a layer tile, which is scaled
+        up to the tile size and shown until the full resolution tile is
+        rendered.
+
+        The preview task is submitted after the full resolution one, so it
+        has higher priority (see RenderTask.__lt__).
+
+        '''
+        if self._isInFlight((stack_id, ims, tile_no, generation, True), False) \
+           or not self._makeRoomForTask(False):
+            return
+        level = self.tiling.level + self._previewLevels
+        try:
+            ims_req = ims.request(dataRect, stack_id[1], level=level)
+        except IndeterminateRequestError:
+            return
+        f = 2**self._previewLevels
+        get_render_pool().submit(False, time.time(),
+                self, ims, transform * QTransform.fromScale(f, f), tile_no,
+                stack_id, ims_req, self._cache, generation, True)
+
+    def _addTask( self, task ):
+        with self._tasksLock:
+            old = self._tasks.get(task.key)
+            if old is not None and old.prefetch:
+                self._prefetchTasks -= 1
+            if task.prefetch:
+                self._prefetchTasks += 1
+            self._tasks[task.key] = task
+
+    def _removeTask( self, task ):
+        with self._tasksLock:
+            if self._tasks.get(task.key) is task:
+                del self._tasks[task.key]
+                if task.prefetch:
+                    self._prefetchTasks -= 1
+
+    def _isInFlight( self, key, prefetch ):
+        '''Whether the layer tile identified by key is already requested.
+
+        A queued prefetch task is cancelled (and False is returned) if the
+        tile is now needed for display, so that it is resubmitted with
+        regular priority. A stale task does not count, as it may already
+        be running for a replaced cache (see _onSizeChanged).
+
+        '''
+        with self._tasksLock:
+            task = self._tasks.get(key)
+        if task is None or task.isStale():
+            return False
+        if task.prefetch and not prefetch and task.cancel():
+            return False
+        return True
+
+    def _dataGeneration( self, ims, tile_no ):
+        generations = self._dataGenerations.get(ims)
+        if generations is None:
+            return (0, 0)
+        return (generations.get(None, 0), generations.get(tile_no, 0))
+
+    def _bumpDataGeneration( self, ims, tile_no=None ):
+        generations = self._dataGenerations.setdefault(ims, {})
+        if tile_no is None:
+            # the per tile counters are superseded by the layer-wide one
+            generations = self._dataGenerations[ims] = {None: generations.get(None, 0) + 1}
+        else:
+            generations[tile_no] = generations.get(tile_no, 0) + 1
+
+    def _makeRoomForTask( self, prefetch ):
+        '''Keep at most request_queue_size render tasks around.
+
+        If the limit is reached, the least important task is cancelled in
+        favor of the new one. A new task is always more recent than the
+        queued ones, so it is only rejected (returns False) if it is a
+        prefetch task while all queued tasks are regular ones.
+
+        '''
+        with self._tasksLock:
+            if len(self._tasks) < self._request_queue_size:
+                return True
+            queued = [task for task in self._tasks.itervalues()
+                      if not task.future.running()]
+        if not queued:
+            return True
+        worst = max(queued)
+        if prefetch and not worst.prefetch:
+            return False
+        worst.cancel()
+        return True
+
+    def _cancelStaleTasks( self ):
+        with self._tasksLock:
+            tasks = self._tasks.values()
+        cancelled = [task for task in tasks if task.isStale() and task.cancel()]
+        if cancelled:
+            get_render_pool().purgeCancelled()
+
+    def _renderTile( self, stack_id, tile_nr ):
+        with get_metrics().timed(metrics.COMPOSITE):
+            return self._blendTile( stack_id, tile_nr )
+
+    def _blendTile( self, stack_id, tile_nr ):
+        # ((visible, opacity, image source), patch) from bottom to top
+        layers = []
+        for v in reversed(self._sims):
             visible, layerOpacity, layerImageSource = v
-            if not visible:
-                continue
+            patch = None
+            if visible:
+                patch = self._cache.peekLayer(stack_id, layerImageSource, tile_nr)
+            layers.append((v, patch))
+
+        sources = [layer[0][2] for layer in layers]
+        if stack_id != self._current_stack_id or self._splitLayer not in sources:
+            return self._composite(layers, tile_nr, 0xffffffff)
+
+        # The layer whose opacity or visibility was changed last is blended
+        # between cached composites of the layers below (on the white
+        # background) and above it (on a transparent background). As
+        # 'source over' compositing is associative, this equals compositing
+        # all layers, but needs only two blends per tile.
+        k = sources.index(self._splitLayer)
+        signature = [k] + [layer for i, layer in enumerate(layers) if i != k]
+        while self._splitEvictions:
+            self._releaseSplitTile(self._splitEvictions.popleft())
+        partials = self._splitTiles.get(tile_nr)
+        if partials is None or not self._sameSignature(partials[0], signature):
+            below = self._composite(layers[:k], tile_nr, 0xffffffff)
+            above = self._composite(layers[k+1:], tile_nr, 0)
+            partials = (signature, below, above)
+            self._storeSplitTile(tile_nr, partials)
+        signature, below, above = partials
+
+        (visible, layerOpacity, layerImageSource), patch = layers[k]
+        if below is None and patch is None and above is None:
+            return None
+        qimg = self._compositeImage(tile_nr)
+        if below is None:
+            qimg.fill(0xffffffff)
+        p = QPainter(qimg)
+        if below is not None:
+            p.setCompositionMode(QPainter.CompositionMode_Source)
+            p.drawImage(0,0, below)
+            p.setCompositionMode(QPainter.CompositionMode_SourceOver)
+        if patch is not None:
+            p.setOpacity(layerOpacity)
+            p.drawImage(0,0, patch)
+        if above is not None:
+            p.setOpacity(1.0)
+            p.drawImage(0,0, above)
+        p.end()
+        return qimg
 
-            with self._cache:
-                patch = self._cache.layer(stack_id, layerImageSource, tile_nr )
+    def _composite( self, layers, tile_nr, background ):
+        '''Blend ((visible, opacity, ims), patch) pairs onto an image filled
+        with background, or return None if there is no patch to blend.'''
+        qimg = None
+        p = None
+        for (visible, layerOpacity, layerImageSource), patch in layers:
             if patch is not None:
                 if qimg is None:
-                    qimg = QImage(self.tiling.imageRects[tile_nr].size(), QImage.Format_ARGB32_Premultiplied)
-                    qimg.fill(0xffffffff) # Use a hex constant instead.
+                    qimg = self._compositeImage(tile_nr)
+                    qimg.fill(background)
                     p = QPainter(qimg)
                 p.setOpacity(layerOpacity)
                 p.drawImage(0,0, patch)
@@ -712,6 +2226,70 @@ class TileProvider( QObject ):
             p.end()
 
         return qimg
+
+    def _compositeImage( self, tile_nr ):
+        size = self.tiling.imageSize(tile_nr)
+        return get_image_pool().acquire(size.width(), size.height(),
+                                        QImage.Format_ARGB32_Premultiplied)
+
+    @staticmethod
+    def _sameSignature( a, b ):
+        # patches are compared by identity; comparing QImages compares pixels
+        if len(a) != len(b) or a[0] != b[0]:
+            return False
+        for (v1, patch1), (v2, patch2) in zip(a[1:], b[1:]):
+            if patch1 is not patch2 or v1[0] != v2[0] or v1[1] != v2[1] \
+               or v1[2] is not v2[2]:
+                return False
+        return True
+
+    def _setSplitLayer( self, ims ):
+        if ims is not self._splitLayer:
+            self._splitLayer = ims
+            self._releaseSplitTiles()
+
+    def _storeSplitTile( self, tile_nr, partials ):
+        self._releaseSplitTile(tile_nr)
+        self._splitTiles[tile_nr] = partials
+        signature, below, above = partials
+        nbytes = _nbytes(below) + _nbytes(above)
+        if nbytes:
+            victims = get_tile_cache_memory().add(self._splitRef, tile_nr, nbytes)
+            get_tile_cache_memory()._evict(victims)
+
+    def _releaseSplitTile( self, tile_nr ):
+        partials = self._splitTiles.pop(tile_nr, None)
+        if partials is None:
+            return
+        get_tile_cache_memory().discard(self._splitRef, tile_nr)
+        signature, below, above = partials
+        for img in (below, above):
+            if img is not None:
+                get_image_pool().release(img)
+
+    def _releaseSplitTiles( self ):
+        for tile_nr in self._splitTiles.keys():
+            self._releaseSplitTile(tile_nr)
+        self._splitEvictions.clear()
+
+    def evictLater( self, tile_nr ):
+        '''Drop the partial composites of the tile (see _blendTile), which
+        fell out of the tile cache budget. Can be called from any thread.'''
+        self._splitEvictions.append(tile_nr)
+
+    def _invalidateComposites( self ):
+        '''Mark the composited tiles dirty after the appearance of the
+        stack (opacities, visibility, order) changed.
+
+        Only the tiles of the current stack are marked right away, the
+        other cached stacks are marked once they become current (see
+        _onStackIdChanged).
+
+        '''
+        self._appearance += 1
+        self._compositeAppearance[self._current_stack_id] = self._appearance
+        with self._cache:
+            self._cache.setStackTilesDirty(self._current_stack_id)
     
     def _onLayerDirty(self, dirtyImgSrc, dataRect ):
         sceneRect = self.tiling.data2scene.mapRect(dataRect)
@@ -729,50 +2307,101 @@ class TileProvider( QObject ):
             with self._cache:
                 for ims in self._sims.viewImageSources():
                     self._cache.setLayerDirtyAllTiles(ims)
+                    self._bumpDataGeneration(ims)
                 if visibleAndNotOccluded:
                     self._cache.setAllTilesDirty()
         else:
-            # Slow path: Mark intersecting tiles as dirty.
+            # Slow path: Mark intersecting tiles as dirty. Only the dirty
+            # part of the layer tiles is rendered again, see _partialRect.
             with self._cache:
                 for tile_no in self.tiling.intersected(sceneRect):
+                    tileDataRect = dataRect.intersected(self.tiling.dataRects[tile_no])
                     for ims in self._sims.viewImageSources():
-                        self._cache.setLayerDirtyAllStacks(ims, tile_no, True)
+                        self._cache.setLayerDirtyRectAllStacks(ims, tile_no, tileDataRect)
+                        self._bumpDataGeneration(ims, tile_no)
                     if visibleAndNotOccluded:
                         self._cache.setTileDirtyAllStacks(tile_no, True)
         if visibleAndNotOccluded:
             self.sceneRectChanged.emit( QRectF(sceneRect) )
 
     def _onStackIdChanged( self, oldId, newId ):
+        stale = self._compositeAppearance.get(newId, 0) != self._appearance
         with self._cache:
             if newId in self._cache:
                 self._cache.touchStack( newId )
             else:
                 self._cache.addStack( newId )
+            if stale:
+                self._cache.setStackTilesDirty( newId )
+            if len(self._compositeAppearance) > 2 * len(self._cache):
+                self._compositeAppearance = dict(
+                    (stack_id, appearance) for stack_id, appearance
+                    in self._compositeAppearance.iteritems()
+                    if stack_id in self._cache)
+        self._recolorStaleLayers(newId)
+        self._compositeAppearance[newId] = self._appearance
+        self._setSplitLayer(None)
         self._current_stack_id = newId
+        self._cancelStaleTasks()
         self.sceneRectChanged.emit(QRectF())
 
     def _onLayerIdChanged( self, ims, oldId, newId ):
         if self._layerIdChange_means_dirty:
             self._onLayerDirty( ims, QRect() )
 
-    def _onVisibleChanged(self, ims, visible):
+    def _onPaletteChanged(self, ims):
+        if ims not in self._sims.viewImageSources():
+            return
+        visibleAndNotOccluded = self._sims.isVisible( ims ) \
+                                and not self._sims.isOccluded( ims )
+        with self._cache:
+            self._cache.setLayerPalette(ims, ims.palette())
+        if not self._recolorStaleLayers(self._current_stack_id):
+            # some tiles were rendered in ARGB32, render them anew
+            with self._cache:
+                self._cache.setLayerDirtyAllTiles(ims)
+                self._bumpDataGeneration(ims)
+                if visibleAndNotOccluded:
+                    self._cache.setAllTilesDirty()
+        if visibleAndNotOccluded:
+            self.sceneRectChanged.emit(QRectF())
+
+    def _recolorStaleLayers( self, stack_id ):
+        '''Give the indexed layer tiles of the stack their current palette
+        (see _TilesCache.setLayerPalette). The images are copied while the
+        cache is free. Returns False if some of them are not indexed.'''
         with self._cache:
-            self._cache.setAllTilesDirty()
+            stale, allIndexed = self._cache.staleLayers(stack_id)
+        if stale:
+            recolored = _recolored(stale)
+            with self._cache:
+                self._cache.replaceLayers(stack_id, recolored)
+        return allIndexed
+
+    def _onVisibleChanged(self, ims, visible):
+        self._setSplitLayer(ims)
+        self._invalidateComposites()
         if not self._sims.isOccluded( ims ):
             self.sceneRectChanged.emit(QRectF())
 
     def _onOpacityChanged(self, ims, opacity):
-        with self._cache:
-            self._cache.setAllTilesDirty()
+        self._setSplitLayer(ims)
+        self._invalidateComposites()
         if self._sims.isVisible( ims ) and not self._sims.isOccluded( ims ):
             self.sceneRectChanged.emit(QRectF())
 
     def _onSizeChanged(self):
+        with self._cache:
+            self._cache.release()
         self._cache = _TilesCache(self._current_stack_id, self._sims,
-                                  maxstacks=self._cache_size)
+                                  maxstacks=self._cache_size,
+                                  policy=self._evictionPolicy)
+        self._setSplitLayer(None)
+        self._releaseSplitTiles()
+        self._cancelStaleTasks()
         self.sceneRectChanged.emit(QRectF())
 
     def _onOrderChanged(self):
-        with self._cache:
-            self._cache.setAllTilesDirty()
+        self._releaseSplitTiles()
+        self._invalidateComposites()
         self.sceneRectChanged.emit(QRectF())